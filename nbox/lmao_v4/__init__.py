@@ -1,3 +1,7 @@
 from nbox.lmao_v4.common import get_lmao_stub, get_git_details, get_project, get_tracker_log, LMAO_RM_PREFIX, ExperimentConfig
 from nbox.lmao_v4.tracker import Tracker
+from nbox.lmao_v4.shipper import LogShipper, BackpressurePolicy
+from nbox.lmao_v4.wal import LogWAL
+from nbox.lmao_v4.aggregate import LogAggregator, AggregateStat
+from nbox.lmao_v4.export import export_tracker_logs, iter_tracker_logs, ExportFormat
 from nbox.lmao_v4.cli import LmaoCLI
\ No newline at end of file
@@ -0,0 +1,195 @@
+"""
+Client side aggregation for the tracker logs. When a training loop logs thousands of times a second most of those
+logs are noise on the chart, the `LogAggregator` folds them into one summary log per window (every N logs or T
+seconds, whichever comes first) so the RPCs and the storage go down by the size of the window.
+
+- Number keys: the mean is kept under the same key so the charts look the same, the other stats are logged as
+  `<key>.<stat>` eg. `loss.min`, `loss.max`, `loss.last`, `loss.count`
+- x-axis keys (`step` and `epoch` by default): only the last value is kept under the same key, so the summary sits
+  on a real step of the window and not on a fractional mean
+- Text keys: a uniform sample (reservoir) of the values in the window, `<key>` and `<key>.1`, `<key>.2` ...
+- `LatencyHistogram` keeps percentiles of a stream (eg. request latencies) in a fixed number of log buckets
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import math
+import time
+import random
+import threading
+from typing import List
+
+from nbox.lmao_v4.proto.logs_pb2 import TrackerLog
+
+
+class AggregateStat:
+  MEAN = "mean"
+  MIN = "min"
+  MAX = "max"
+  LAST = "last"
+  COUNT = "count"
+
+  def all():
+    return [AggregateStat.MEAN, AggregateStat.MIN, AggregateStat.MAX, AggregateStat.LAST, AggregateStat.COUNT]
+
+
+class LogAggregator:
+  def __init__(
+    self,
+    steps: int = 0,
+    seconds: float = 0.,
+    stats: List[str] = AggregateStat.all(),
+    text_samples: int = 1,
+    x_keys: List[str] = ("step", "epoch"),
+  ):
+    """
+    Args:
+      steps (int): close the window after these many logs, 0 to not count
+      seconds (float): close the window after these many seconds, 0 to not time. The time is checked when a log
+        comes in, the last window is closed on `flush`
+      stats (List[str]): stats for the number keys, from `AggregateStat.all()`
+      text_samples (int): values to keep per text key
+      x_keys (List[str]): number keys that are the x-axis of the charts, summarised as their last value
+    """
+    if steps <= 0 and seconds <= 0:
+      raise ValueError("One of steps or seconds is required")
+    for s in stats:
+      if s not in AggregateStat.all():
+        raise ValueError(f"Invalid stat: {s}, must be one of {AggregateStat.all()}")
+    self.steps = steps
+    self.seconds = seconds
+    self.stats = list(stats)
+    self.text_samples = max(1, text_samples)
+    self.x_keys = set(x_keys)
+
+    self._lock = threading.Lock()
+    self._reset()
+
+  def __repr__(self):
+    return f"LogAggregator(steps={self.steps}, seconds={self.seconds}, in_window={self._n})"
+
+  def _reset(self):
+    self._n = 0
+    self._start = time.monotonic()
+    self._numbers = {} # key -> [count, sum, min, max, last]
+    self._texts = {} # key -> [seen, samples]
+
+  def add(self, log: TrackerLog) -> TrackerLog:
+    """Fold a log in the window, returns the summary if this closed the window else `None`"""
+    with self._lock:
+      if self._n and self.seconds > 0 and time.monotonic() - self._start >= self.seconds:
+        # the time ran out before this log came in, it starts the next window
+        out = self._summary()
+        self._fold(log)
+        return out
+      self._fold(log)
+      if self.steps > 0 and self._n >= self.steps:
+        return self._summary()
+    return None
+
+  def flush(self) -> TrackerLog:
+    """Close the current window, returns `None` if it is empty"""
+    with self._lock:
+      if not self._n:
+        return None
+      return self._summary()
+
+  def _fold(self, log: TrackerLog):
+    if not self._n:
+      self._start = time.monotonic()
+    self._n += 1
+    for k, v in zip(log.number_keys, log.number_values):
+      s = self._numbers.get(k)
+      if s is None:
+        self._numbers[k] = [1, v, v, v, v]
+        continue
+      s[0] += 1
+      s[1] += v
+      if v < s[2]:
+        s[2] = v
+      if v > s[3]:
+        s[3] = v
+      s[4] = v
+    for k, v in zip(log.text_keys, log.text_values):
+      s = self._texts.get(k)
+      if s is None:
+        self._texts[k] = [1, [v]]
+        continue
+      s[0] += 1
+      if len(s[1]) < self.text_samples:
+        s[1].append(v)
+      else:
+        j = random.randrange(s[0])
+        if j < self.text_samples:
+          s[1][j] = v
+
+  def _summary(self) -> TrackerLog:
+    out = TrackerLog()
+    for k, (count, total, vmin, vmax, last) in self._numbers.items():
+      if k in self.x_keys:
+        out.number_keys.append(k)
+        out.number_values.append(last)
+        continue
+      for stat in self.stats:
+        if stat == AggregateStat.MEAN:
+          out.number_keys.append(k)
+          out.number_values.append(total / count)
+          continue
+        out.number_keys.append(f"{k}.{stat}")
+        out.number_values.append({
+          AggregateStat.MIN: vmin,
+          AggregateStat.MAX: vmax,
+          AggregateStat.LAST: last,
+          AggregateStat.COUNT: count,
+        }[stat])
+    for k, (_, samples) in self._texts.items():
+      for i, v in enumerate(samples):
+        out.text_keys.append(k if i == 0 else f"{k}.{i}")
+        out.text_values.append(v)
+    self._reset()
+    return out
+
+
+class LatencyHistogram:
+  # 16 buckets per power of two and a percentile is the middle of its bucket, so it is at most half a bucket
+  # (1/64 of the power of two) away from the real value: within 3.125% at the bottom of each power, less above
+  SUB_BUCKETS = 16
+
+  def __init__(self):
+    self.reset()
+
+  def __repr__(self):
+    return f"LatencyHistogram(count={self.count}, p50={self.quantile(0.5)}, p99={self.quantile(0.99)})"
+
+  def reset(self):
+    self.count = 0
+    self.sum = 0
+    self.max = 0
+    self._buckets = {}
+
+  def add(self, value: float):
+    if value > 0:
+      m, e = math.frexp(value) # value = m * 2**e, 0.5 <= m < 1
+      b = e * self.SUB_BUCKETS + int((m - 0.5) * 2 * self.SUB_BUCKETS)
+    else:
+      b = -1 << 30
+    self._buckets[b] = self._buckets.get(b, 0) + 1
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+  def quantile(self, q: float) -> float:
+    """value below which `q` fraction of the values are, the middle of the bucket"""
+    if not self.count:
+      return 0.
+    rank = q * self.count
+    seen = 0
+    for b in sorted(self._buckets):
+      seen += self._buckets[b]
+      if seen >= rank:
+        if b < -1 << 29:
+          return 0.
+        e, s = divmod(b, self.SUB_BUCKETS)
+        return min(self.max, (0.5 + (s + 0.5) / (2 * self.SUB_BUCKETS)) * 2. ** e)
+    return self.max
@@ -3,8 +3,6 @@ NimbleBox LMAO is our general purpose observability tool for any kind of computa
 """
 
 from typing import Optional
-from dateparser import parse as parse_date
-from google.protobuf.timestamp_pb2 import Timestamp
 
 from nbox.utils import logger
 from nbox.auth import secret, AuthConfig
@@ -14,6 +12,7 @@ from nbox import messages as mpb
 from nbox.lmao_v4.proto.project_pb2 import ListProjectsRequest, ListProjectsResponse
 from nbox.lmao_v4.proto.logs_pb2 import TrackerLogRequest, TrackerLogResponse
 from nbox.lmao_v4 import common
+from nbox.lmao_v4.export import parse_time, export_tracker_logs, ExportFormat
 
 class ProjectRpc:
   """LMAO Project RPC as CLI. Work in progress"""
@@ -58,28 +57,18 @@ def serving_logs(
   req = TrackerLogRequest(
     project_id = project_id,
     tracker_id = tracker_id,
-    keys = [key,]
+    keys = [key,] if key else [],
   )
 
   # date things
   if after:
-    after_parsed = parse_date(after, settings={'TIMEZONE': 'UTC'})
-    if after_parsed is None:
-      raise ValueError(f"Invalid date format for `after` argument: {after}")
-    t = Timestamp()
-    t.FromDatetime(after_parsed)
-    req.after.CopyFrom(t)
-    logger.info(f"Will get logs from after: {after_parsed}")
+    req.after.CopyFrom(parse_time(after, "after"))
+    logger.info(f"Will get logs from after: {req.after.ToDatetime()}")
   if before:
-    before_parsed = parse_date(before, settings={'TIMEZONE': 'UTC'})
-    if before_parsed is None:
-      raise ValueError(f"Invalid date format for `before` argument: {before}")
-    t = Timestamp()
-    t.FromDatetime(before_parsed)
-    req.before.CopyFrom(t)
-    logger.info(f"Will get logs from before: {before_parsed}")
+    req.before.CopyFrom(parse_time(before, "before"))
+    logger.info(f"Will get logs from before: {req.before.ToDatetime()}")
   if after and before:
-    if after_parsed > before_parsed:
+    if req.after.ToNanoseconds() > req.before.ToNanoseconds():
       raise ValueError(f"`after` date cannot be greater than `before` date")
 
   # limit things
@@ -87,7 +76,7 @@ def serving_logs(
     raise ValueError("`limit` cannot be negative")
   req.limit = int(limit)
 
-  logs: TrackerLogResponse = stub.get_serving_log(req)
+  logs: TrackerLogResponse = stub.GetTrackerLogs(req)
   logs_json = mpb.message_to_json(
     message = logs,
     including_default_value_fields = False,
@@ -101,7 +90,53 @@ def serving_logs(
   with open(f, "w") as _f:
     _f.write(logs_json)
 
+
+def export_logs(
+  project_id: str,
+  tracker_id: str,
+  f: str,
+  key: str = "",
+  after: Optional[str] = "",
+  before: Optional[str] = "",
+  page_size: int = 1000,
+  format: str = ExportFormat.NDJSON,
+  resume: bool = True,
+):
+  """
+  Export all the logs of a tracker in a time range, page by page. Use this for anything that is too big for
+  `serving`, running it again continues from where it stopped.
+
+  ```bash
+  nbx lmao export '229dj92' '0283-nice-summer' logs.ndjson --after 'last 7 days'
+  nbx lmao export '229dj92' '0283-nice-summer' logs/ --key 'latency' --format parquet
+  ```
+
+  Args:
+    project_id: ID of the project to which the tracker belongs.
+    tracker_id: ID of the tracker to export.
+    f: NDJSON file or folder for the Parquet parts.
+    key: Key of the log to get, all keys if not provided.
+    after: Return only logs after this timestamp.
+    before: Return only logs before this timestamp.
+    page_size: Number of logs in one request.
+    format: 'ndjson' or 'parquet'.
+    resume: Continue from the last export to the same `f`.
+  """
+  total = export_tracker_logs(
+    project_id = project_id,
+    tracker_id = tracker_id,
+    f = f,
+    keys = [key,] if key else [],
+    after = after,
+    before = before,
+    page_size = page_size,
+    format = format,
+    resume = resume,
+  )
+  print(f"Exported {total} logs to {f}")
+
 # add all the CLIs at the bottom here:
 class LmaoCLI:
   rpc = ProjectRpc
   serving = serving_logs
+  export = export_logs
@@ -4,7 +4,7 @@ import json
 import collections
 from git import Repo
 from functools import lru_cache
-from typing import Union, Dict, Any
+from typing import Union, Dict, Any, List, Sequence
 
 from nbox.auth import inside_pod, secret
 from nbox.init import MetadataInjectInterceptor, WorkspaceIdInjectInterceptor
@@ -68,6 +68,68 @@ def get_tracker_log(log: dict) -> TrackerLog:
   return out
 
 
+def get_tracker_logs(logs: Union[List[dict], Dict[str, Sequence]]) -> List[TrackerLog]:
+  """Bulk version of `get_tracker_log`, each key is validated once for the whole batch.
+
+  Args:
+    logs: either a list of dicts (same as `get_tracker_log`) or a dict of columns where every column is a list or
+      an array (anything with `.tolist()` eg. NumPy, torch) of the same length, one log per row
+  """
+  if isinstance(logs, collections.abc.Mapping):
+    columns = flatten(logs)
+    if not columns:
+      return []
+    number_keys, number_cols, text_keys, text_cols = [], [], [], []
+    n = None
+    for k, col in columns.items():
+      if valid_key_regex.match(k) is None:
+        raise ValueError(f"Invalid key '{k}', allowed letters digits and '_-'")
+      if hasattr(col, "tolist"):
+        col = col.tolist() # numpy scalars -> python, in C
+      if isinstance(col, (str, bytes)) or not isinstance(col, collections.abc.Sequence):
+        raise ValueError(f"Column '{k}' must be a list or an array, got '{type(col)}'")
+      if n is None:
+        n = len(col)
+      elif len(col) != n:
+        raise ValueError(f"All the columns must be of the same length, '{k}' has {len(col)} and not {n}")
+      types = set(map(type, col))
+      if types <= {float, int}:
+        number_keys.append(k)
+        number_cols.append(col)
+      elif types == {str}:
+        text_keys.append(k)
+        text_cols.append(col)
+      else:
+        raise ValueError(f"Invalid types {types} for key '{k}'")
+    number_rows = zip(*number_cols) if number_cols else [()] * n
+    text_rows = zip(*text_cols) if text_cols else [()] * n
+    return [
+      TrackerLog(number_keys = number_keys, number_values = nv, text_keys = text_keys, text_values = tv)
+      for nv, tv in zip(number_rows, text_rows)
+    ]
+
+  out = []
+  valid = set() # keys that passed the regex
+  for log in logs:
+    nk, nv, tk, tv = [], [], [], []
+    for k, v in flatten(log).items():
+      if k not in valid:
+        if valid_key_regex.match(k) is None:
+          raise ValueError(f"Invalid key '{k}', allowed letters digits and '_-'")
+        valid.add(k)
+      t = type(v)
+      if t is float or t is int:
+        nk.append(k)
+        nv.append(v)
+      elif t is str:
+        tk.append(k)
+        tv.append(v)
+      else:
+        raise ValueError(f"Invalid type '{t}' for key '{k}'")
+    out.append(TrackerLog(number_keys = nk, number_values = nv, text_keys = tk, text_values = tv))
+  return out
+
+
 # there are some legacy functions that were built for lmao_v2, in some cases retrofitted for v4
 
 def get_git_details(folder):
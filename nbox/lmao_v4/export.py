@@ -0,0 +1,239 @@
+"""
+Streaming export of the tracker logs. `GetTrackerLogs` returns everything in the range in one response so a long
+range does not fit in memory, the exporter walks the range in pages of `page_size` logs (keyset on the timestamp,
+`after` moves to the last timestamp seen) and writes every page to the output before asking for the next one.
+
+- `ndjson`: one JSON object per log `{"log_id", "timestamp", <key>: <value>, ...}` appended to a single file
+- `parquet`: same rows, one part file per page in a folder, needs `pyarrow`
+- A `<f>.cursor` file is written after every page, running the same export again continues from it. For NDJSON
+  the file is cut back to the size in the cursor first so a page is never written twice, if the file is missing or
+  shorter than that the export starts over
+- Logs with the same time are paged with the log ids seen at that time. If more of them share one time than the
+  server returns in one call the export raises instead of stopping early (the tracker gives every log its own time)
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import os
+import re
+import json
+from uuid import uuid4
+from datetime import datetime
+from typing import Dict, Iterable, List, Union
+
+from google.protobuf.timestamp_pb2 import Timestamp
+
+from nbox.utils import logger
+from nbox.lmao_v4.common import get_lmao_stub
+from nbox.lmao_v4.proto.logs_pb2 import TrackerLogRequest, TrackerLogResponse, RecordColumn
+
+
+class ExportFormat:
+  NDJSON = "ndjson"
+  PARQUET = "parquet"
+
+  def all():
+    return [ExportFormat.NDJSON, ExportFormat.PARQUET]
+
+
+def parse_time(value: Union[str, datetime, Timestamp], name: str = "time") -> Timestamp:
+  """`value` can be anything `dateparser` understands eg. '2021-01-01 12:00:00' or 'last 12 hours'"""
+  if isinstance(value, Timestamp):
+    return value
+  if isinstance(value, str):
+    from dateparser import parse as parse_date
+    parsed = parse_date(value, settings = {'TIMEZONE': 'UTC'})
+    if parsed is None:
+      raise ValueError(f"Invalid date format for `{name}` argument: {value}")
+    value = parsed
+  t = Timestamp()
+  t.FromDatetime(value)
+  return t
+
+
+def response_to_records(resp: TrackerLogResponse) -> List[Dict]:
+  """Turn the columns in the response into one dict per log, sorted by the time"""
+  records = {}
+  for col in resp.data:
+    is_text = col.value_type == RecordColumn.DataType.STRING
+    for item in col.rows:
+      r = records.get(item.log_id)
+      if r is None:
+        r = records[item.log_id] = {"log_id": item.log_id, "_ns": item.timestamp.ToNanoseconds()}
+      r[col.key] = item.text if is_text else item.number
+  return sorted(records.values(), key = lambda r: (r["_ns"], r["log_id"]))
+
+
+def iter_tracker_logs(
+  project_id: str,
+  tracker_id: str,
+  keys: List[str] = [],
+  after: Union[str, datetime, Timestamp] = "",
+  before: Union[str, datetime, Timestamp] = "",
+  page_size: int = 1000,
+  cursor: Dict = None,
+  stub = None,
+) -> Iterable[List[Dict]]:
+  """Pages of records (see `response_to_records`), each record also has the timestamp in nanoseconds as `_ns`.
+
+  Args:
+    project_id (str): project the tracker is in
+    tracker_id (str): tracker to export
+    keys (List[str]): keys to export, all if empty
+    after: only the logs after this time
+    before: only the logs before this time
+    page_size (int): logs asked for in one call
+    cursor (Dict): `{"after_ns": int, "log_ids": [...]}` from the last page to continue from, it is updated in
+      place after every page
+    stub: `LMAOStub`, the default one if not given
+  """
+  stub = stub or get_lmao_stub()
+  if page_size < 1:
+    raise ValueError("`page_size` must be positive")
+  req = TrackerLogRequest(project_id = project_id, tracker_id = tracker_id, keys = [k for k in keys if k])
+  if before:
+    req.before.CopyFrom(parse_time(before, "before"))
+  cursor = cursor if cursor is not None else {}
+  if "after_ns" not in cursor:
+    cursor["after_ns"] = parse_time(after, "after").ToNanoseconds() if after else None
+    cursor["log_ids"] = []
+  if after and req.HasField("before") and cursor["after_ns"] is not None and cursor["after_ns"] > req.before.ToNanoseconds():
+    raise ValueError(f"`after` date cannot be greater than `before` date")
+
+  limit = page_size
+  while True:
+    req.limit = limit
+    req.ClearField("after")
+    if cursor["after_ns"] is not None:
+      # one ns back so the logs with the same time as the last one are not skipped, they are deduped below
+      req.after.FromNanoseconds(cursor["after_ns"] - 1)
+    resp: TrackerLogResponse = stub.GetTrackerLogs(req)
+    if resp is None:
+      raise RuntimeError(f"Could not get the logs for tracker '{tracker_id}'")
+    records = response_to_records(resp)
+    seen = set(cursor["log_ids"])
+    page = [r for r in records if r["log_id"] not in seen]
+    if not page:
+      if len(records) >= limit:
+        # a full page of logs with the same time as the last one, ask for more
+        limit *= 2
+        continue
+      if limit > page_size and _has_logs_after(stub, req, cursor["after_ns"]):
+        # the server gave less than asked only because it caps the page, the logs after these cannot be reached
+        raise RuntimeError(
+          f"More than {len(records)} logs of tracker '{tracker_id}' have the same time {_ns_to_iso(cursor['after_ns'])}"
+          f" and the server does not return more than {len(records)} logs in one call, cannot page past them"
+        )
+      return
+    last_ns = page[-1]["_ns"]
+    if last_ns != cursor["after_ns"]:
+      seen = set()
+    seen.update(r["log_id"] for r in page if r["_ns"] == last_ns)
+    cursor["after_ns"] = last_ns
+    cursor["log_ids"] = sorted(seen)
+    limit = page_size
+    yield page
+
+
+def _has_logs_after(stub, req: TrackerLogRequest, ns: int) -> bool:
+  probe = TrackerLogRequest()
+  probe.CopyFrom(req)
+  probe.limit = 1
+  probe.after.FromNanoseconds(ns)
+  resp: TrackerLogResponse = stub.GetTrackerLogs(probe)
+  if resp is None:
+    raise RuntimeError(f"Could not get the logs for tracker '{req.tracker_id}'")
+  return any(col.rows for col in resp.data)
+
+
+_PART_RE = re.compile(r"^part-(\d{6})\.parquet$")
+
+
+def _ns_to_iso(ns: int) -> str:
+  t = Timestamp()
+  t.FromNanoseconds(ns)
+  return t.ToJsonString()
+
+
+def export_tracker_logs(
+  project_id: str,
+  tracker_id: str,
+  f: str,
+  keys: List[str] = [],
+  after: Union[str, datetime, Timestamp] = "",
+  before: Union[str, datetime, Timestamp] = "",
+  page_size: int = 1000,
+  format: str = ExportFormat.NDJSON,
+  resume: bool = True,
+  stub = None,
+) -> int:
+  """Export the logs of a tracker to a file page by page, the memory used is one page. Returns the number of logs
+  written in this run.
+
+  Args:
+    f (str): the NDJSON file, or the folder for the Parquet parts
+    format (str): one of `ExportFormat.all()`
+    resume (bool): continue from `<f>.cursor` if it exists, else start over
+
+  The other arguments are same as `iter_tracker_logs`.
+  """
+  if format not in ExportFormat.all():
+    raise ValueError(f"Invalid format: {format}, must be one of {ExportFormat.all()}")
+  if format == ExportFormat.PARQUET:
+    try:
+      import pyarrow as pa
+      import pyarrow.parquet as pq
+    except ImportError:
+      raise ImportError("Parquet export needs pyarrow, install it with `pip install pyarrow`")
+
+  cursor_fp = f.rstrip("/") + ".cursor"
+  cursor = {}
+  if resume and os.path.exists(cursor_fp):
+    with open(cursor_fp, "r") as _f:
+      cursor = json.load(_f)
+    if format == ExportFormat.NDJSON and (not os.path.exists(f) or os.path.getsize(f) < cursor.get("offset", 0)):
+      # the pages in the cursor are not in the file anymore, continuing would leave a hole of NUL bytes
+      logger.warning(f"{f} is missing or shorter than {cursor_fp} says, starting the export over")
+      cursor = {}
+    else:
+      logger.info(f"Continuing the export from {_ns_to_iso(cursor['after_ns'])}")
+  cursor.setdefault("offset", 0)
+  cursor.setdefault("part", 0)
+
+  if format == ExportFormat.NDJSON:
+    out = open(f, "ab" if cursor["offset"] else "wb")
+    out.truncate(cursor["offset"]) # anything after the last saved page
+  else:
+    os.makedirs(f, exist_ok = True)
+    for x in os.listdir(f):
+      m = _PART_RE.match(x)
+      if m and int(m.group(1)) >= cursor["part"]:
+        os.remove(os.path.join(f, x)) # from an earlier run
+    out = None
+
+  total = 0
+  try:
+    for page in iter_tracker_logs(project_id, tracker_id, keys, after, before, page_size, cursor, stub):
+      for r in page:
+        r["timestamp"] = _ns_to_iso(r.pop("_ns"))
+      if out is not None:
+        out.write("".join(json.dumps(r) + "\n" for r in page).encode("utf-8"))
+        out.flush()
+        os.fsync(out.fileno())
+        cursor["offset"] = out.tell()
+      else:
+        pq.write_table(pa.Table.from_pylist(page), os.path.join(f, f"part-{cursor['part']:06d}.parquet"))
+        cursor["part"] += 1
+      total += len(page)
+
+      # the cursor is saved only after the page is on the disk
+      tmp = f"{cursor_fp}.{uuid4().hex}.tmp"
+      with open(tmp, "w") as _f:
+        json.dump(cursor, _f)
+      os.replace(tmp, cursor_fp)
+      logger.debug(f"Exported {total} logs till {_ns_to_iso(cursor['after_ns'])}")
+  finally:
+    if out is not None:
+      out.close()
+  logger.info(f"Exported {total} logs to {f}")
+  return total
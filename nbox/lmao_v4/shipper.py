@@ -0,0 +1,275 @@
+"""
+Background shipping for the tracker logs. `Tracker.log` only puts the log in a bounded queue and returns, a
+daemon thread takes the logs out in batches (by count or by time, whichever comes first) and sends them. The
+training step never waits on the network unless the queue is full and the policy is to `block`.
+
+- When the queue is full the `BackpressurePolicy` decides: `block` the caller till there is space, `drop_oldest`
+  to keep the latest logs or `sample` to keep a uniform sample (reservoir) of everything that came in
+- Logs that fail to send go back to the front of the queue in the same order and are retried with a backoff
+- `flush()` waits till everything put so far is sent, `close()` flushes and stops the thread, it is also called
+  when the interpreter exits
+- In a forked child (eg. the server workers) the shipper starts empty, the logs queued before the fork are sent by
+  the parent, and the thread is started again on the first call
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import os
+import time
+import random
+import atexit
+import weakref
+import threading
+from collections import deque
+from typing import Any, Callable, List
+
+from nbox.utils import logger
+
+
+class BackpressurePolicy:
+  BLOCK = "block"
+  DROP_OLDEST = "drop_oldest"
+  SAMPLE = "sample"
+  SPILL = "spill" # only with a `refill`, the items are kept somewhere else (eg. `LogWAL`) and read back later
+
+  def all():
+    return [BackpressurePolicy.BLOCK, BackpressurePolicy.DROP_OLDEST, BackpressurePolicy.SAMPLE, BackpressurePolicy.SPILL]
+
+
+# the live shippers, their thread does not exist in a forked child
+_SHIPPERS = weakref.WeakSet()
+
+def _after_fork_in_child():
+  for shipper in list(_SHIPPERS):
+    shipper._after_fork()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child = _after_fork_in_child)
+
+
+class LogShipper:
+  def __init__(
+    self,
+    send: Callable[[List[Any]], List[Any]],
+    batch_size: int = 100,
+    flush_interval: float = 1.,
+    max_queue: int = 10_000,
+    policy: str = BackpressurePolicy.BLOCK,
+    max_backoff: float = 30.,
+    name: str = "nbx-log-shipper",
+    refill: Callable[[Any, int], List[Any]] = None,
+  ):
+    """
+    Args:
+      send (Callable): `send(batch) -> failed`, sends a batch and returns the items that could not be sent
+      batch_size (int): max items in one batch
+      flush_interval (float): seconds after which a partial batch is sent
+      max_queue (int): max items waiting to be sent
+      policy (str): what to do when the queue is full, one of `BackpressurePolicy.all()`
+      max_backoff (float): max seconds to wait between retries when the sends are failing
+      refill (Callable): `refill(last, n) -> items`, with the `spill` policy this gives back up to `n` items that
+        came after `last` (the newest item that was in the queue, `None` if there was none)
+    """
+    if policy not in BackpressurePolicy.all():
+      raise ValueError(f"Invalid policy: {policy}, must be one of {BackpressurePolicy.all()}")
+    if (policy == BackpressurePolicy.SPILL) != (refill is not None):
+      raise ValueError("refill is required for the spill policy and only used with it")
+    self.send = send
+    self.batch_size = max(1, batch_size)
+    self.flush_interval = flush_interval
+    self.max_queue = max(1, max_queue)
+    self.policy = policy
+    self.max_backoff = max_backoff
+    self.refill = refill
+
+    self.sent = 0
+    self.dropped = 0
+    self._queue = deque()
+    self._cond = threading.Condition()
+    self._in_flight = 0
+    self._overflow = 0 # items seen while full, for the reservoir
+    self._flush_requested = False
+    self._closed = False
+    self._spilled = False # items after `_last` are not in the queue and have to be refilled
+    self._last = None
+    self._name = name
+    self._thread = None
+    self._start()
+    atexit.register(self.close)
+    _SHIPPERS.add(self)
+
+  def __repr__(self):
+    return f"LogShipper(queued={len(self._queue)}, sent={self.sent}, dropped={self.dropped}, policy='{self.policy}')"
+
+  def __len__(self):
+    return len(self._queue) + self._in_flight
+
+  def _start(self):
+    # called with the lock held or before anyone else has the shipper
+    if self._thread is None and not self._closed:
+      self._thread = threading.Thread(target = self._run, name = self._name, daemon = True)
+      self._thread.start()
+
+  def _after_fork(self):
+    # only the thread that forked is copied and it may have been holding the lock. The items queued are the
+    # parent's, it sends them, and the thread is started on the next call and not here so that the other fork
+    # handlers (eg. the `LogWAL` of the same tracker) are done before it runs
+    self._cond = threading.Condition()
+    self._queue = deque()
+    self._in_flight = 0
+    self._overflow = 0
+    self._flush_requested = False
+    self._spilled = False
+    self._last = None
+    self.sent = 0
+    self.dropped = 0
+    self._thread = None
+
+  def put(self, item: Any) -> bool:
+    """Queue an item, returns `False` if it was dropped"""
+    with self._cond:
+      self._start()
+      return self._put(item)
+
+  def put_many(self, items: List[Any]) -> int:
+    """Queue the items taking the lock once, returns how many were not dropped"""
+    with self._cond:
+      self._start()
+      return sum(self._put(x) for x in items)
+
+  def _put(self, item: Any) -> bool:
+    if self._closed:
+      raise RuntimeError("LogShipper is closed")
+    if self._spilled or (len(self._queue) >= self.max_queue and self.policy == BackpressurePolicy.SPILL):
+      # once spilled everything after it waits for the refill, so the order is kept
+      self._spilled = True
+      self._cond.notify_all()
+      return False
+    if len(self._queue) >= self.max_queue:
+      if self.policy == BackpressurePolicy.BLOCK:
+        while len(self._queue) >= self.max_queue and not self._closed:
+          self._cond.wait()
+      elif self.policy == BackpressurePolicy.DROP_OLDEST:
+        self._queue.popleft()
+        self.dropped += 1
+      else:
+        # reservoir sampling over everything that came in while the queue was full
+        self._overflow += 1
+        self.dropped += 1
+        j = random.randrange(self.max_queue + self._overflow)
+        if j >= self.max_queue:
+          return False
+        self._queue[j] = item
+        return True
+    self._queue.append(item)
+    self._last = item
+    if len(self._queue) >= self.batch_size:
+      self._cond.notify_all()
+    return True
+
+  def spill(self, last: Any = None):
+    """Mark that the items after `last` are waiting to be refilled, eg. the ones left from an earlier run"""
+    with self._cond:
+      self._start()
+      self._spilled = True
+      self._last = last
+      self._cond.notify_all()
+
+  def flush(self, timeout: float = None) -> bool:
+    """Block till everything queued so far is sent, returns `False` on timeout"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with self._cond:
+      self._start()
+      self._flush_requested = True
+      self._cond.notify_all()
+      while self._queue or self._in_flight or self._spilled:
+        if self._thread is None or not self._thread.is_alive():
+          return False
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          return False
+        self._cond.wait(remaining)
+      self._flush_requested = False
+    return True
+
+  def close(self, timeout: float = 10.):
+    """Flush and stop the background thread, anything that could not be sent within `timeout` is dropped"""
+    if self._closed:
+      return
+    if not self.flush(timeout):
+      logger.warning(f"Could not send {len(self)} logs before closing")
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+    if self._thread is not None:
+      self._thread.join(timeout = 1.)
+    atexit.unregister(self.close)
+
+  def _refill(self):
+    # called with the lock held, the producers wait while the items are read back
+    n = self.max_queue - len(self._queue)
+    items = self.refill(self._last, n)
+    self._queue.extend(items)
+    if items:
+      self._last = items[-1]
+    if len(items) < n:
+      self._spilled = False # caught up
+
+  def _next_batch(self) -> List[Any]:
+    with self._cond:
+      deadline = time.monotonic() + self.flush_interval
+      while not self._closed:
+        if self._spilled and len(self._queue) < self.batch_size:
+          self._refill()
+        if len(self._queue) >= self.batch_size or (self._queue and self._flush_requested):
+          break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          if self._queue:
+            break
+          deadline = time.monotonic() + self.flush_interval
+          remaining = self.flush_interval
+        self._cond.wait(remaining)
+      n = min(len(self._queue), self.batch_size)
+      batch = [self._queue.popleft() for _ in range(n)]
+      self._in_flight = n
+      if not self._queue:
+        self._overflow = 0
+      self._cond.notify_all() # space for the blocked producers
+      return batch
+
+  def _run(self):
+    backoff = 0.
+    while True:
+      batch = self._next_batch()
+      if not batch:
+        if self._closed:
+          return
+        continue
+      try:
+        failed = self.send(batch) or []
+      except Exception as e:
+        logger.warning(f"Failed to send {len(batch)} logs: {e}")
+        failed = batch
+      with self._cond:
+        self.sent += len(batch) - len(failed)
+        # back at the front in the same order, older than anything that came in meanwhile
+        self._queue.extendleft(reversed(failed))
+        if len(self._queue) > self.max_queue and self.policy == BackpressurePolicy.SPILL:
+          # the newest ones are still in the spill, they are read back after the new `_last`
+          while len(self._queue) > self.max_queue:
+            self._queue.pop()
+          self._last = self._queue[-1]
+          self._spilled = True
+        while len(self._queue) > self.max_queue and self.policy != BackpressurePolicy.BLOCK:
+          self._queue.pop() if self.policy == BackpressurePolicy.SAMPLE else self._queue.popleft()
+          self.dropped += 1
+        self._in_flight = 0
+        self._cond.notify_all()
+        if failed and self._closed:
+          return
+      if failed:
+        backoff = min(self.max_backoff, max(0.5, backoff * 2))
+        time.sleep(backoff)
+      else:
+        backoff = 0.
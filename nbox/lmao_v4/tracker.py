@@ -1,18 +1,58 @@
 import os
 import grpc
-from typing import Union, Dict, List, Any
+import json
+import time
+import weakref
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+from typing import Union, Dict, List, Any, Tuple
 
 from nbox import utils as U
 from nbox.auth import secret, NBX_JOB_TYPE, NBX_DEPLOY_TYPE
 from nbox.utils import logger, lo
 from nbox.relics import Relics
+from nbox.relics.utils import get_relic_file
+from nbox.relics.sync import ManifestEntry
+from nbox.relics.transfer import file_md5
 
 from google.protobuf.struct_pb2 import Struct
 
 from nbox.lmao_v4.proto.project_pb2 import Project as ProjectProto
 from nbox.lmao_v4.proto.tracker_pb2 import Tracker as TrackerProto, TrackerType, InitTrackerRequest, NBX as NBXType
-from nbox.lmao_v4.proto.logs_pb2 import TrackerLogId
-from nbox.lmao_v4.common import get_lmao_stub, get_tracker_log
+from nbox.lmao_v4.proto.logs_pb2 import TrackerLog
+from nbox.lmao_v4.common import get_lmao_stub, get_tracker_log, get_tracker_logs
+from nbox.lmao_v4.shipper import LogShipper, BackpressurePolicy
+from nbox.lmao_v4.wal import LogWAL
+from nbox.lmao_v4.aggregate import LogAggregator, AggregateStat
+
+
+# what was saved with `Tracker.save_file`, kept in the tracker's folder in the relic
+SAVED_MANIFEST = ".nbx_saved.json"
+
+
+def _saved_name(fp: str, root: str) -> str:
+  # the relative path is the name, same as `Relics.put`. Files outside the current folder are named from the
+  # folder that was passed so the name does not carry the absolute path
+  rel = os.path.relpath(fp)
+  if rel.startswith(".."):
+    rel = os.path.relpath(fp, os.path.dirname(os.path.abspath(root.rstrip("/"))))
+  return rel.replace(os.sep, "/")
+
+
+# the live trackers, see `Tracker._after_fork`
+_TRACKERS = weakref.WeakSet()
+
+def _after_fork_in_child():
+  # the gRPC channel of the parent cannot be used in a child
+  get_lmao_stub.cache_clear()
+  for tracker in list(_TRACKERS):
+    tracker._after_fork()
+
+if hasattr(os, "register_at_fork"):
+  # registered after the ones of the shipper and the WAL (imported above), so those run first
+  os.register_at_fork(after_in_child = _after_fork_in_child)
 
 
 class Tracker():
@@ -24,8 +64,39 @@ class Tracker():
       live_tracker: bool = False,
       config: Dict[str, Any] = {},
       *,
-      buffer_size: int = 10
+      buffer_size: int = 100,
+      flush_interval: float = 1.,
+      max_queue: int = 10_000,
+      backpressure: str = "",
+      wal: bool = True,
+      wal_folder: str = "",
+      aggregate_steps: int = 0,
+      aggregate_seconds: float = 0.,
+      aggregate_stats: List[str] = AggregateStat.all(),
+      text_samples: int = 1,
+      aggregate_x_keys: List[str] = ("step", "epoch"),
     ):
+    """
+    Args:
+      project_id (Union[str, ProjectProto]): The project to track in
+      tracker_id (Union[str, TrackerProto]): An existing tracker, a new one is created if not given
+      live_tracker (bool): Create a LIVE tracker instead of an EXPERIMENT one
+      config (Dict[str, Any]): config stored with a new tracker
+      buffer_size (int): max logs sent in one batch by the background shipper
+      flush_interval (float): seconds after which a partial batch is sent
+      max_queue (int): max logs waiting to be sent
+      backpressure (str): what `log` does when the queue is full, one of `BackpressurePolicy.all()`. By default
+        `spill` with the WAL (the logs that do not fit wait on the disk) and `block` without it. The WAL only works
+        with `spill`, pass `wal=False` for the others
+      wal (bool): write every log to a local write-ahead log first, the logs that were not delivered are sent
+        when the connection comes back or when this tracker is loaded again
+      wal_folder (str): where to keep the WAL, by default `~/.nbx/.cache/lmao/wal/<tracker_id>`
+      aggregate_steps (int): send one summary log for every these many logs, see `LogAggregator`
+      aggregate_seconds (float): send one summary log for every these many seconds, see `LogAggregator`
+      aggregate_stats (List[str]): stats kept for the number keys when aggregating, from `AggregateStat.all()`
+      text_samples (int): values kept for each text key when aggregating
+      aggregate_x_keys (List[str]): number keys that are the x-axis of the charts, the summary has their last value
+    """
     self.stub = get_lmao_stub()
     self.project_pb = project_id
     if type(project_id) != ProjectProto:
@@ -59,9 +130,48 @@ class Tracker():
     ))
 
     self.relic = Relics(id = self.project_pb.relic_id, prefix = self.tracker_pb.save_location)
+    self._last_ns = 0 # timestamp of the last log, every log gets a later one
+    self._ts_lock = threading.Lock()
+    self._saved = None # name -> ManifestEntry of the files saved so far, loaded on the first save
+    self._save_pool = None
+    self._save_lock = threading.Lock()
     self.total_logged_elements = 0
     self.buffer_size = buffer_size
-    self.pending_log_buffer = [] # this is for the rolling buffer when 
+    self.aggregator = None
+    if aggregate_steps > 0 or aggregate_seconds > 0:
+      self.aggregator = LogAggregator(aggregate_steps, aggregate_seconds, aggregate_stats, text_samples, aggregate_x_keys)
+    if not backpressure:
+      backpressure = BackpressurePolicy.SPILL if wal else BackpressurePolicy.BLOCK
+    if wal and backpressure != BackpressurePolicy.SPILL:
+      # dropped logs would never be acked and the WAL would send them again on the next load
+      raise ValueError(f"backpressure='{backpressure}' cannot be used with the WAL, pass wal=False or leave it empty")
+    if not wal and backpressure == BackpressurePolicy.SPILL:
+      raise ValueError("backpressure='spill' needs the WAL, pass wal=True")
+    self.wal = None
+    if wal:
+      self.wal = LogWAL(wal_folder or os.path.join(U.env.NBOX_HOME_DIR(), ".cache", "lmao", "wal", self.tracker_pb.id))
+    self.shipper = LogShipper(
+      self._send_logs,
+      batch_size = buffer_size,
+      flush_interval = flush_interval,
+      max_queue = max_queue,
+      policy = backpressure,
+      name = f"nbx-tracker-{self.tracker_pb.id}",
+      refill = self._refill_logs if self.wal is not None else None,
+    )
+    if self.wal is not None and len(self.wal):
+      logger.info(f"Sending {len(self.wal)} logs left in the WAL from an earlier run")
+      self.shipper.spill()
+    _TRACKERS.add(self)
+
+  def _after_fork(self):
+    # in a forked child eg. a server worker, by now the shipper is empty and the WAL is in a folder of its own
+    self.stub = get_lmao_stub()
+    self._ts_lock = threading.Lock()
+    self._save_pool = None
+    self._save_lock = threading.Lock()
+    if self.wal is not None and len(self.wal):
+      self.shipper.spill() # left in that folder by an earlier run
 
   def __repr__(self) -> str:
     return (f"    project: {self.project_pb.id}\n"
@@ -114,59 +224,217 @@ class Tracker():
     self.tracker_pb.update_keys.extend(("nbx_group_id", "nbx_instance_id", "type"))
     self.tracker_pb: TrackerProto = self.stub.UpdateTracker(self.tracker_pb)
 
+  def _send_logs(self, items: List[Tuple[int, TrackerLog]]) -> List[Tuple[int, TrackerLog]]:
+    # there is no batch RPC, so the batch goes out as concurrent calls on the same channel and costs one round
+    # trip instead of one per log. Returns the ones that failed, the shipper retries them.
+    futures = [self.stub.PutTrackerLog.future(x) for _, x in items]
+    failed = []
+    for item, fut in zip(items, futures):
+      try:
+        fut.result()
+      except grpc.RpcError as e:
+        logger.debug(f"Failed to log: {e}")
+        failed.append(item)
+    if self.wal is not None and len(failed) < len(items):
+      self.wal.ack(seq for (seq, _), fut in zip(items, futures) if fut.exception() is None)
+    return failed
+
+  def _refill_logs(self, last: Tuple[int, TrackerLog], n: int) -> List[Tuple[int, TrackerLog]]:
+    after = self.wal.watermark if last is None else last[0]
+    return [(seq, TrackerLog.FromString(data)) for seq, data in self.wal.read(after, n)]
+
   def log(self, log: Dict[str, Union[int, float, str]], *, log_id: str = "") -> str:
+    """Log a dictionary of numbers and strings, this only queues the log and returns immediately. The logs
+    are sent in batches by a background thread, call `flush` to wait for them to be sent.
+
+    Args:
+      log (Dict[str, Union[int, float, str]]): the values to log, nested dicts are flattened with '.'
+      log_id (str): a UUID for this log, one is generated if not given
+
+    Returns:
+      str: the log_id, when aggregating this log is folded in a summary that has its own log_id
+    """
     if self.tracker_pb.status == TrackerProto.Status.COMPLETED:
       raise ValueError("Cannot log to a completed tracker")
+    if log_id:
+      if not U.is_valid_uuid(log_id):
+        raise ValueError(f"log_id must be a UUID, got: {log_id}")
+    else:
+      # generated here so that a retried log is the same log
+      log_id = str(uuid4())
     tracker_log = get_tracker_log(log)
-    if log_id == "":
-      U.is_valid_uuid(log_id)
+    tracker_log.log_id = log_id
+    self._put_logs([tracker_log])
+    return log_id
+
+  def log_many(self, logs: Union[List[Dict[str, Union[int, float, str]]], Dict[str, Any]], *, step = None) -> List[str]:
+    """Log many rows in one call, eg. per-sample losses from an eval loop. Same as calling `log` for each row but
+    the keys are validated once and the logs are written and queued in bulk.
+
+    ```python
+    tracker.log_many([{"loss": 0.1}, {"loss": 0.2}])
+
+    # columns, lists or arrays (NumPy, torch, ...) of the same length
+    tracker.log_many({"loss": losses, "eval": {"acc": accs}}, step = np.arange(len(losses)))
+    ```
+
+    Args:
+      logs: a list of dicts or a dict of columns, nested dicts are flattened with '.'
+      step: optional list or array of step indices, logged as the `step` key of each row. The rows cannot have a
+        `step` key of their own then
+
+    Returns:
+      List[str]: the log_id of each row
+    """
+    if self.tracker_pb.status == TrackerProto.Status.COMPLETED:
+      raise ValueError("Cannot log to a completed tracker")
+    tracker_logs = get_tracker_logs(logs)
+    if step is not None:
+      if hasattr(step, "tolist"):
+        step = step.tolist()
+      if len(step) != len(tracker_logs):
+        raise ValueError(f"Got {len(step)} steps for {len(tracker_logs)} logs")
+      for tracker_log, s in zip(tracker_logs, step):
+        if "step" in tracker_log.number_keys or "step" in tracker_log.text_keys:
+          raise ValueError("Got `step` both as an argument and as a key in the logs, pass only one")
+        tracker_log.number_keys.append("step")
+        tracker_log.number_values.append(s)
+    log_ids = [str(uuid4()) for _ in tracker_logs]
+    for tracker_log, log_id in zip(tracker_logs, log_ids):
       tracker_log.log_id = log_id
-    tracker_log.project_id = self.tracker_pb.project_id
-    tracker_log.tracker_id = self.tracker_pb.id
-    self.pending_log_buffer.append(log)
+    self._put_logs(tracker_logs)
+    return log_ids
+
+  def _put_logs(self, tracker_logs: List[TrackerLog]):
+    if self.aggregator is not None:
+      # only the summaries are sent, with their own log_id
+      summaries = []
+      for tracker_log in tracker_logs:
+        summary = self.aggregator.add(tracker_log)
+        if summary is not None:
+          summary.log_id = str(uuid4())
+          summaries.append(summary)
+      tracker_logs = summaries
+      if not tracker_logs:
+        return
+    self._ship_logs(tracker_logs)
 
-    try:
-      for log in self.pending_log_buffer:
-        log_id: TrackerLogId = self.stub.PutTrackerLog(tracker_log)
-        self.total_logged_elements += 1
-    except grpc.RpcError as e:
-      logger.warning(f"Failed to log: {log}")
-      self.pending_log_buffer.append(log)
-      return ""
+  def _ship_logs(self, tracker_logs: List[TrackerLog]):
+    # when it was logged, not when it was sent. Every log gets its own timestamp at least a microsecond after the
+    # last one so the rows of a batch keep their order and the exports that page on the time never see a tie
+    with self._ts_lock:
+      start = max(time.time_ns() // 1000 * 1000, self._last_ns + 1000)
+      self._last_ns = start + (len(tracker_logs) - 1) * 1000
+    for i, tracker_log in enumerate(tracker_logs):
+      tracker_log.project_id = self.tracker_pb.project_id
+      tracker_log.tracker_id = self.tracker_pb.id
+      tracker_log.timestamp.FromNanoseconds(start + i * 1000)
+    if self.wal is not None:
+      seqs = self.wal.append_many([x.SerializeToString() for x in tracker_logs])
+    else:
+      seqs = [0] * len(tracker_logs)
+    queued = self.shipper.put_many(list(zip(seqs, tracker_logs)))
+    # with the WAL nothing is dropped, the ones that did not fit in the queue are read back from the disk
+    self.total_logged_elements += len(tracker_logs) if self.wal is not None else queued
 
-    return log_id.log_id
+  def flush(self, timeout: float = None) -> bool:
+    """Wait till all the logs so far are sent, returns `False` on timeout. This closes the aggregation window."""
+    self._flush_aggregator()
+    return self.shipper.flush(timeout)
+
+  def _flush_aggregator(self):
+    if self.aggregator is None:
+      return
+    summary = self.aggregator.flush()
+    if summary is not None:
+      summary.log_id = str(uuid4())
+      self._ship_logs([summary])
 
   def end(self):
     """End the tracker to declare it complete. This will then trigger all the post end operations"""
     if self.tracker_pb.status == TrackerProto.Status.COMPLETED:
       raise ValueError("Cannot end a completed tracker")
     logger.info(f"Ending project ('{self.tracker_pb.project_id}') tracker: '{self.tracker_pb.id}'")
+    self._flush_aggregator()
+    if self._save_pool is not None:
+      self._save_pool.shutdown(wait = True) # the files saved in the background
+    self.shipper.close()
+    if self.wal is not None:
+      self.wal.close()
     self.tracker_pb.status = TrackerProto.Status.COMPLETED
     self.tracker_pb.update_keys.append("status")
     self.tracker_pb = self.stub.UpdateTracker(self.tracker_pb)
 
-  def save_file(self, *files: List[str]):
-    """
+  def save_file(self, *files: List[str], wait: bool = True, dedup: bool = True):
+    """Save files to the tracker, the files are uploaded concurrently and a file whose content (MD5) was already
+    saved under the tracker, with any name, is skipped. So saving the whole checkpoints folder every epoch only
+    uploads the new checkpoints, `.nbx_saved.json` has the MD5 of every name saved.
+
     Args:
       files: The list of files to save. This can be a list of files or a list of folders. If a folder is passed, all the files in the folder will be uploaded.
+      wait (bool): if `False` the upload runs in the background and a `Future` is returned, do not change the files
+        till it is done. The saves (waiting or not) run one after the other in the order they are called
+      dedup (bool): skip the files whose content is same as a file saved before
+
+    Returns:
+      List[str] or Future: the local paths of the files that are saved, including the skipped ones
     """
     logger.info(f"Saving files: {files}")
     # manage all the complexity of getting the list of RelicFile
     all_files = []
     for folder_or_file in files:
       if os.path.isfile(folder_or_file):
-        all_files.append(folder_or_file)
+        all_files.append((folder_or_file, _saved_name(folder_or_file, folder_or_file)))
       elif os.path.isdir(folder_or_file):
-        all_files.extend(U.get_files_in_folder(folder_or_file, abs_path=False))
+        all_files.extend((f, _saved_name(f, folder_or_file)) for f in U.get_files_in_folder(folder_or_file, abs_path=False))
       else:
         raise Exception(f"File or Folder not found: {folder_or_file}")
+    # every save goes through the one worker so the manifest is only ever touched by one save at a time
+    with self._save_lock:
+      if self._save_pool is None:
+        self._save_pool = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = f"nbx-save-{self.tracker_pb.id}")
+      fut = self._save_pool.submit(self._save_files, all_files, dedup)
+    return fut.result() if wait else fut
 
-    # when we add something cool we can use this
-    logger.debug(f"Storing {len(all_files)} files")
+  def _save_files(self, all_files: List[Tuple[str, str]], dedup: bool) -> List[str]:
     relic = self.get_relic()
-    for f in all_files:
-      relic.put(f)
-    return all_files
+    if self._saved is None:
+      self._saved = {}
+      if relic.has(SAVED_MANIFEST):
+        with tempfile.TemporaryDirectory() as td:
+          fp = os.path.join(td, SAVED_MANIFEST)
+          relic.get_from(fp, SAVED_MANIFEST)
+          with open(fp, "r") as f:
+            self._saved = {k: ManifestEntry.from_dict(v) for k, v in json.load(f).items()}
+
+    items, entries = [], {}
+    saved_md5 = {e.md5 for e in self._saved.values() if e.md5}
+    for lp, name in all_files:
+      st = os.stat(lp)
+      entry = ManifestEntry(st.st_size, int(st.st_mtime), file_md5(lp))
+      if dedup and entry.md5 in saved_md5:
+        # the content is already under the tracker, only the name is noted in the manifest
+        if self._saved.get(name) is None or self._saved[name].to_dict() != entry.to_dict():
+          entries[name] = entry
+        continue
+      saved_md5.add(entry.md5) # the same content twice in this save is uploaded once
+      relic_file = get_relic_file(lp, relic.username, relic.workspace_id)
+      relic_file.relic_name = relic.relic_name
+      relic_file.name = name
+      items.append((lp, relic_file))
+      entries[name] = entry
+
+    logger.debug(f"Storing {len(items)} files, {len(all_files) - len(items)} are already saved")
+    if items:
+      relic._upload_relic_files(items, desc = f"Saving {len(items)} files")
+    if entries:
+      self._saved.update(entries)
+      with tempfile.TemporaryDirectory() as td:
+        fp = os.path.join(td, SAVED_MANIFEST)
+        with open(fp, "w") as f:
+          json.dump({k: v.to_dict() for k, v in self._saved.items()}, f)
+        relic.put_to(fp, SAVED_MANIFEST)
+    return [lp for lp, _ in all_files]
 
   def add_files(self, *files: List[str]):
     logger.warning("Tracker.add_files is deprecated, please use save_file instead")
@@ -0,0 +1,254 @@
+"""
+Write-ahead log for the tracker logs. Every log is appended to a local segment file before it is sent, so when the
+LMAO endpoint is unreachable (or the process dies) nothing is lost, the logs that were not acknowledged are sent
+again in order when the connection comes back or when the tracker is loaded again.
+
+- A segment is a flat file of records `[seq: u64][size: u32][crc32: u32][serialized TrackerLog]`, a new segment
+  is started every `segment_size` bytes and named after its first `seq`
+- Acknowledgements move a watermark (all the records `<= watermark` are delivered) that is kept in the `ACK`
+  file, segments that are fully below the watermark are deleted
+- A record that was half written when the process died fails the CRC and is ignored along with everything
+  after it in that segment
+- A WAL folder belongs to one process at a time (an flock on its `LOCK` file). When another process already has
+  it, eg. the other DDP ranks or serving workers logging to the same tracker, the first free one of `folder.1`,
+  `folder.2`, ... is used instead, so the processes never share the sequence numbers or the `ACK` file. When the
+  processes start again each one takes one of these folders and sends what was left in it. Without `fcntl`
+  (windows) there is no lock and the folder must not be shared
+- A forked child (eg. a server worker) does not write to the parent's segment, it moves to a folder of its own
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import os
+import zlib
+import struct
+import weakref
+import threading
+from uuid import uuid4
+from bisect import bisect_right
+from typing import Iterable, List, Tuple
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+from nbox.utils import logger
+
+MiB = 1 << 20
+
+_HEADER = struct.Struct("<QII")
+_SUFFIX = ".wal"
+
+
+def _try_flock(folder: str):
+  """the open `LOCK` file of the `folder` if this process could lock it, `None` if another process holds it"""
+  f = open(os.path.join(folder, "LOCK"), "a")
+  if fcntl is None:
+    return f
+  try:
+    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except OSError:
+    f.close()
+    return None
+  return f
+
+
+# the open WALs, a forked child must not append to the segments of its parent
+_WALS = weakref.WeakSet()
+
+def _after_fork_in_child():
+  for wal in list(_WALS):
+    wal._after_fork()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child = _after_fork_in_child)
+
+
+class LogWAL:
+  def __init__(self, folder: str, segment_size: int = 8 * MiB, fsync: bool = False):
+    """
+    Args:
+      folder (str): where the segments are kept, one folder per tracker. `folder.1`, `folder.2`, ... are used
+        when another process has it open
+      segment_size (int): size after which a new segment is started
+      fsync (bool): fsync after every append, survives a machine crash and not only a process crash but is
+        much slower
+    """
+    self.root = folder
+    self.segment_size = segment_size
+    self.fsync = fsync
+    self._lock = threading.Lock()
+    self._open()
+    _WALS.add(self)
+
+  def _open(self):
+    # take the first folder that is not held by another process and continue from what is in it
+    i = 0
+    while True:
+      folder = self.root if i == 0 else f"{self.root}.{i}"
+      os.makedirs(folder, exist_ok = True)
+      self._flock = _try_flock(folder)
+      if self._flock is not None:
+        break
+      i += 1
+    if i:
+      logger.info(f"WAL {self.root} is open in another process, using {folder}")
+    self.folder = folder
+    self._ack_fp = os.path.join(folder, "ACK")
+    self.watermark = 0
+    if os.path.exists(self._ack_fp):
+      with open(self._ack_fp, "r") as f:
+        self.watermark = int(f.read().strip() or 0)
+    self._acked = set() # acked above the watermark
+    self._segments = sorted(int(x[:-len(_SUFFIX)]) for x in os.listdir(folder) if x.endswith(_SUFFIX))
+
+    # continue after the last valid record. A trailing segment can be empty or wholly torn (crash right after it
+    # was created), it holds nothing and its name would be taken again by the next append, so it is removed and
+    # the one before it is scanned. A segment is named after its first seq, so the floor keeps the seqs that are
+    # already on disk from being reused even if nothing valid is left
+    self.last_seq = self.watermark
+    if self._segments:
+      self.last_seq = max(self.last_seq, self._segments[-1] - 1)
+    while self._segments:
+      found = False
+      for seq, _ in self._scan(self._segments[-1]):
+        self.last_seq = max(self.last_seq, seq)
+        found = True
+      if found:
+        break
+      os.remove(self._path(self._segments.pop()))
+    self._fd = None
+    self._fd_size = 0
+    self._read_cursor = (-1, "", 0) # (seq, segment filepath, offset after it) for sequential reads
+
+  def __repr__(self):
+    return f"LogWAL({self.folder}, last_seq={self.last_seq}, watermark={self.watermark}, segments={len(self._segments)})"
+
+  def __len__(self):
+    """number of records not acknowledged yet"""
+    return self.last_seq - self.watermark - len(self._acked)
+
+  def _path(self, first_seq: int) -> str:
+    return os.path.join(self.folder, f"{first_seq:020d}{_SUFFIX}")
+
+  def _scan(self, first_seq: int, offset: int = 0) -> Iterable[Tuple[int, bytes]]:
+    fp = self._path(first_seq)
+    try:
+      f = open(fp, "rb")
+    except FileNotFoundError:
+      return
+    with f:
+      f.seek(offset)
+      while True:
+        head = f.read(_HEADER.size)
+        if len(head) < _HEADER.size:
+          return
+        seq, size, crc = _HEADER.unpack(head)
+        data = f.read(size)
+        if len(data) < size or zlib.crc32(data) != crc:
+          logger.warning(f"Ignoring the corrupt tail of WAL segment {fp} at offset {f.tell()}")
+          return
+        yield seq, data
+
+  def append(self, data: bytes) -> int:
+    """Append a record and return its sequence number"""
+    return self.append_many([data])[0]
+
+  def append_many(self, datas: List[bytes]) -> List[int]:
+    """Append the records with a single write and return their sequence numbers"""
+    if not datas:
+      return []
+    with self._lock:
+      first = self.last_seq + 1
+      if self._fd is None or self._fd_size >= self.segment_size:
+        if self._fd is not None:
+          os.close(self._fd)
+        self._segments.append(first)
+        self._fd = os.open(self._path(first), os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0), 0o644)
+        self._fd_size = 0
+      buf = bytearray()
+      for i, data in enumerate(datas):
+        buf += _HEADER.pack(first + i, len(data), zlib.crc32(data))
+        buf += data
+      view = memoryview(buf)
+      while view:
+        n = os.write(self._fd, view) # unbuffered, in the page cache even if the process dies right after
+        view = view[n:]
+      if self.fsync:
+        os.fsync(self._fd)
+      self._fd_size += len(buf)
+      self.last_seq = first + len(datas) - 1
+    return list(range(first, first + len(datas)))
+
+  def read(self, after: int, limit: int) -> List[Tuple[int, bytes]]:
+    """Read up to `limit` records with `seq > after` in order"""
+    out = []
+    with self._lock:
+      # under the lock so that a record being appended is never read half written
+      if not self._segments:
+        return out
+      i = max(0, bisect_right(self._segments, max(after, self.watermark) + 1) - 1)
+      offset = 0
+      if self._read_cursor[0] == after and self._read_cursor[1] == self._path(self._segments[i]):
+        offset = self._read_cursor[2] # continue where the last read stopped instead of scanning again
+      for first in self._segments[i:]:
+        pos = offset
+        for seq, data in self._scan(first, offset):
+          pos += _HEADER.size + len(data)
+          if seq <= after:
+            continue
+          out.append((seq, data))
+          if len(out) == limit:
+            break
+        if out:
+          self._read_cursor = (out[-1][0], self._path(first), pos)
+        if len(out) == limit:
+          break
+        offset = 0
+    return out
+
+  def ack(self, seqs: Iterable[int]):
+    """Mark the records as delivered, moves the watermark and deletes the segments below it"""
+    with self._lock:
+      self._acked.update(s for s in seqs if s > self.watermark)
+      w = self.watermark
+      while w + 1 in self._acked:
+        w += 1
+        self._acked.discard(w)
+      if w == self.watermark:
+        return
+      self.watermark = w
+      tmp = f"{self._ack_fp}.{uuid4().hex}.tmp"
+      with open(tmp, "w") as f:
+        f.write(str(w))
+      os.replace(tmp, self._ack_fp)
+
+      # compaction, a segment is done when the next one starts at or below the watermark + 1
+      while len(self._segments) > 1 and self._segments[1] <= w + 1:
+        os.remove(self._path(self._segments.pop(0)))
+      if self._segments and w >= self.last_seq and self._fd_size >= self.segment_size:
+        # everything is delivered and the active segment is full, start fresh on the next append
+        os.close(self._fd)
+        self._fd = None
+        os.remove(self._path(self._segments.pop(0)))
+
+  def _after_fork(self):
+    # the fd and the lock are shared with the parent, closing the copies here does not release the parent's lock
+    # so `_open` moves on to the next free folder
+    self._lock = threading.Lock()
+    if self._flock is None:
+      return # closed
+    if self._fd is not None:
+      os.close(self._fd)
+    self._flock.close()
+    self._open()
+
+  def close(self):
+    with self._lock:
+      if self._fd is not None:
+        os.close(self._fd)
+        self._fd = None
+      if self._flock is not None:
+        self._flock.close() # releases the folder for the next process
+        self._flock = None
@@ -0,0 +1,285 @@
+"""
+The local map engine, this is what `Operator.map` uses for the operators that run on this machine (`UNSET` and
+`WRAP_FN`). A fixed set of worker processes is started once, each one gets the operator once (forked from the
+parent, or imported when `fork` is not available) and then the inputs are streamed to them in chunks.
+
+- at most `2 * workers` chunks are in flight so a generator of millions of inputs does not end up in memory
+- `imap` gives the outputs in the order of the inputs, `imap_unordered` as soon as each chunk is done
+- the first error in an operator call is raised in the parent and the remaining chunks are cancelled
+- chunks with more than `shm_threshold` bytes of buffers (numpy arrays, arrow buffers, bytearrays, ...) go through
+  `multiprocessing.shared_memory` instead of the pipe: the parent writes the pickle frames (see `U.py_to_frames`) to
+  a segment once and the worker builds the arguments as views on it, without any copy. The parent removes the
+  segment when the chunk is done. Outputs come back the same way and are copied once out of the segment
+
+```python
+with LocalMapPool(op, workers = 8) as pool:
+  for out in pool.imap_unordered(inputs, chunksize = 64):
+    ...
+```
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import os
+import sys
+import importlib
+import multiprocessing
+from collections import deque
+from itertools import islice
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Iterable, Iterator, List, Tuple
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import nbox.utils as U
+from nbox.utils import logger
+from nbox.nbxlib import operator_spec as ospec
+
+# the operator in this worker process, set once by `_init_worker`
+_WORKER_OP = None
+
+# segments in this process that could not be closed because something kept a view on them
+_HELD = []
+
+# the first out-of-band buffer starts on this boundary in the segment
+_SHM_ALIGN = 64
+
+
+class _Frames:
+  """The pickle frames of an object that goes between the processes, either inline in `data` or in the shared
+  memory segment `name`"""
+  def __init__(self, data: bytes = None, name: str = None, offset: int = 0, size: int = 0):
+    self.data = data
+    self.name = name
+    self.offset = offset
+    self.size = size
+
+  def __repr__(self):
+    if self.name is None:
+      return f"_Frames(inline, {len(self.data)} bytes)"
+    return f"_Frames({self.name}, {self.size} bytes)"
+
+  def open(self) -> Tuple[Any, SharedMemory]:
+    """Load the object with its buffers as views on the segment, the segment must stay open while they are used"""
+    if self.name is None:
+      return U.py_from_buffer(self.data), None
+    shm = SharedMemory(self.name)
+    return U.py_from_buffer(shm.buf[self.offset:self.offset + self.size]), shm
+
+  def read(self) -> Any:
+    """Load a copy of the object and remove the segment"""
+    if self.name is None:
+      return U.py_from_buffer(self.data)
+    shm = SharedMemory(self.name)
+    try:
+      # same offset in the copy so the buffers keep their alignment
+      buf = bytearray(self.offset + self.size)
+      buf[:] = shm.buf[:self.offset + self.size]
+    finally:
+      _free(shm)
+    return U.py_from_buffer(memoryview(buf)[self.offset:])
+
+  def unlink(self):
+    if self.name is not None:
+      try:
+        _free(SharedMemory(self.name))
+      except FileNotFoundError:
+        pass
+
+
+def _dump(obj: Any, threshold: int) -> Tuple[_Frames, SharedMemory]:
+  """`_Frames` to send `obj` to another process and the segment if one was made. The frames are inline when the
+  buffers in `obj` are less than `threshold` bytes."""
+  frames = U.py_to_frames(obj)
+  if sum(f.nbytes for f in frames[2:]) < threshold:
+    return _Frames(data = b"".join(frames)), None
+  size = sum(f.nbytes for f in frames)
+  offset = -(frames[0].nbytes + frames[1].nbytes) % _SHM_ALIGN
+  shm = SharedMemory(create = True, size = offset + size)
+  pos = offset
+  for f in frames:
+    shm.buf[pos:pos + f.nbytes] = f
+    pos += f.nbytes
+  return _Frames(name = shm.name, offset = offset, size = size), shm
+
+
+def _close(shm: SharedMemory) -> bool:
+  try:
+    shm.close()
+    return True
+  except BufferError:
+    return False # something still has a view on it, the mapping goes away with the process
+
+
+def _free(shm: SharedMemory):
+  if not _close(shm):
+    _HELD.append(shm) # so it is not closed again by the garbage collector
+  try:
+    shm.unlink()
+  except FileNotFoundError:
+    pass
+
+
+def _init_worker(op, location):
+  global _WORKER_OP
+  if op is None:
+    # spawned worker, import the operator just like the remote runs do
+    folder, module, name, init = location
+    if folder not in sys.path:
+      sys.path.insert(0, folder)
+    op = getattr(importlib.import_module(module), name)
+    if init:
+      op = op()
+  _WORKER_OP = op
+
+
+def _run_chunk(chunk, shm_threshold: int = 0):
+  shm = None
+  if isinstance(chunk, _Frames):
+    chunk, shm = chunk.open()
+  try:
+    out = [_WORKER_OP(x) for x in chunk]
+    # on windows a segment is gone once the worker closes it, there the outputs go over the pipe
+    if shm_threshold and os.name == "posix":
+      out, out_shm = _dump(out, shm_threshold)
+      if out_shm is not None:
+        _close(out_shm) # the parent reads and removes it
+    return out
+  finally:
+    del chunk
+    if shm is not None and not _close(shm):
+      _HELD.append(shm)
+    # the operator may have let go of the earlier ones
+    _HELD[:] = [x for x in _HELD if not _close(x)]
+
+
+def _result(fut: Future) -> List[Any]:
+  out = fut.result()
+  return out.read() if isinstance(out, _Frames) else out
+
+
+def _discard(fut: Future):
+  # outputs that will not be read, remove their segment
+  if not fut.cancelled() and fut.exception() is None and isinstance(fut.result(), _Frames):
+    fut.result().unlink()
+
+
+class LocalMapPool:
+  def __init__(self, op, workers: int = -1, chunksize: int = 0, shm_threshold: int = 1 << 20):
+    """
+    Args:
+      op (Operator): `UNSET` or `WRAP_FN` operator to call once per input
+      workers (int): number of processes, -1 for the number of CPUs
+      chunksize (int): inputs sent to a worker in one go, by default picked from the number of inputs. Bigger
+        chunks are better for many cheap calls, smaller ones balance slow calls better
+      shm_threshold (int): chunks (inputs or outputs) with at least these many bytes of buffers go through shared
+        memory, 0 to always use the pipe
+    """
+    if op._op_type not in [ospec.OperatorType.UNSET, ospec.OperatorType.WRAP_FN]:
+      raise ValueError(f"LocalMapPool runs UNSET and WRAP_FN operators, got: {op._op_type}")
+    if chunksize < 0 or shm_threshold < 0:
+      raise ValueError("chunksize and shm_threshold cannot be negative")
+    self.workers = (os.cpu_count() or 1) if workers == -1 else workers
+    if self.workers < 1:
+      raise ValueError("workers must be at least 1 or -1")
+    self.chunksize = chunksize
+    self.shm_threshold = shm_threshold
+    if shm_threshold and os.name == "posix":
+      # start it before the workers so they share it, else each worker would start its own and remove the
+      # segments it opened when it exits
+      resource_tracker.ensure_running()
+
+    if "fork" in multiprocessing.get_all_start_methods():
+      # the workers get the operator as it is in the parent, including the state built after __init__
+      ctx = multiprocessing.get_context("fork")
+      initargs = (op, None)
+    else:
+      ctx = multiprocessing.get_context("spawn")
+      _, folder, file, name = ospec.get_operator_location(op)
+      initargs = (None, (folder, file.split(".")[0], name, op._op_type == ospec.OperatorType.UNSET))
+    self._pool = ProcessPoolExecutor(self.workers, mp_context = ctx, initializer = _init_worker, initargs = initargs)
+    self._name = op.__qualname__ if op._op_type == ospec.OperatorType.WRAP_FN else op.__class__.__qualname__
+
+  def __repr__(self):
+    return f"LocalMapPool({self._name}, workers={self.workers})"
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def close(self):
+    """Stop the worker processes, the pool cannot be used after this"""
+    self._pool.shutdown(wait = True)
+
+  def _chunksize(self, inputs: Iterable[Any]) -> int:
+    if self.chunksize:
+      return self.chunksize
+    if not hasattr(inputs, "__len__"):
+      return 1
+    # same as multiprocessing.Pool.map, about 4 chunks per worker
+    return max(1, -(-len(inputs) // (self.workers * 4)))
+
+  def _submit(self, chunk: List[Any]) -> Future:
+    if not self.shm_threshold:
+      return self._pool.submit(_run_chunk, chunk)
+    chunk, shm = _dump(chunk, self.shm_threshold)
+    fut = self._pool.submit(_run_chunk, chunk, self.shm_threshold)
+    if shm is not None:
+      fut.add_done_callback(lambda _: _free(shm))
+    return fut
+
+  def _chunks(self, inputs: Iterable[Any], chunksize: int) -> Iterator[List[Any]]:
+    it = iter(inputs)
+    while True:
+      chunk = list(islice(it, chunksize))
+      if not chunk:
+        return
+      yield chunk
+
+  def imap(self, inputs: Iterable[Any], chunksize: int = 0) -> Iterator[Any]:
+    """Call the operator once per input (one positional argument each), yields the outputs in the same order as
+    the inputs. The inputs are pulled as the workers free up."""
+    chunks = self._chunks(inputs, chunksize or self._chunksize(inputs))
+    pending = deque()
+    try:
+      for chunk in chunks:
+        pending.append(self._submit(chunk))
+        if len(pending) < self.workers * 2:
+          continue
+        yield from _result(pending.popleft())
+      while pending:
+        yield from _result(pending.popleft())
+    finally:
+      # on an error or when the caller stops early
+      for fut in pending:
+        if not fut.cancel():
+          fut.add_done_callback(_discard)
+
+  def imap_unordered(self, inputs: Iterable[Any], chunksize: int = 0) -> Iterator[Any]:
+    """Same as `imap` but the outputs are yielded as soon as their chunk is done, so they are not in the order
+    of the inputs. Best when the calls take different times."""
+    chunks = self._chunks(inputs, chunksize or self._chunksize(inputs))
+    pending = set()
+    done = set()
+    try:
+      for chunk in chunks:
+        pending.add(self._submit(chunk))
+        while len(pending) >= self.workers * 2:
+          done, pending = wait(pending, return_when = FIRST_COMPLETED)
+          while done:
+            yield from _result(done.pop())
+      while pending:
+        done, pending = wait(pending, return_when = FIRST_COMPLETED)
+        while done:
+          yield from _result(done.pop())
+    finally:
+      for fut in pending | done:
+        if not fut.cancel():
+          fut.add_done_callback(_discard)
+
+  def map(self, inputs: Iterable[Any], chunksize: int = 0) -> List[Any]:
+    """`imap` collected in a list"""
+    logger.debug(f"Mapping {self._name} over {self.workers} workers")
+    return list(self.imap(inputs, chunksize))
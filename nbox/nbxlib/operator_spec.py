@@ -12,11 +12,7 @@ import os
 import inspect
 from enum import Enum
 from typing import Union
-from threading import Thread, Lock
-from time import sleep
 
-import nbox.utils as U
-from nbox.utils import logger
 from nbox.hyperloop.common.common_pb2 import Resource
 
 
@@ -74,7 +70,8 @@ class _ServingSpec:
     rpc_fn_name,
     fn_spec,
     workspace_id,
-    track_io: bool = False
+    track_io: bool = False,
+    client = None,
   ):
     self.type = OperatorType.SERVING
     self.serving_id = serving_id
@@ -82,6 +79,7 @@ class _ServingSpec:
     self.fn_spec = fn_spec
     self.workspace_id = workspace_id
     self.track_io = track_io
+    self.client = client # `ServingClient`
 
   def __repr__(self):
     return f"[{self.type} {self.serving_id} {self.workspace_id}]"
@@ -124,96 +122,6 @@ def get_operator_location(_op):
   return fp, folder, file, name
 
 
-class _LocalMapFuture:
-  def __init__(self, result_folder, tag):
-    self.fp = U.join(result_folder, tag + "_output")
-
-  def __repr__(self) -> str:
-    return f"_LocalMapFuture ({self.fp})"
-
-  def wait(self):
-    while not self.done():
-      sleep(0.1)
-
-  def done(self):
-    os.path.exists(self.fp)
-
-  def result(self):
-    if not self.done():
-      logger.error("Cannot get result before it is done")
-      return None
-    return U.from_pickle(self.fp)
-
-
-class _LocalMapPooler:
-  def __init__(self, folder, file, name, n_workers = 10):
-    self.folder = folder
-    self.file = file
-    self.name = name
-    self.n_workers = n_workers
-    
-    # things to manage the processes
-    self.items = []
-    self.processes = []
-    self.running = {}
-    self.completed = 0
-    self._mutex = Lock()
-    self._break = False
-
-    self.event_loop = Thread(target = self._event_loop, daemon = True)
-
-  def __repr__(self):
-    return f"_LocalMapPooler ({self.n_workers:03d} workers) running '{self.folder}/{self.file}::{self.name}'"
-
-  def _there_is_space(self):
-    return len(self.processes) < self.n_workers
-
-  def _event_loop(self):
-    # this sees what is in the queue if any slot is finished and runs it
-    while True:
-      with self._mutex:
-        n_items = len(self.items)
-        _break = self._break
-      print(_break, n_items)
-      if _break:
-        return
-      if not n_items:
-        sleep(0.1)
-
-      status = [p.poll() for p in self.processes]
-      success = [x == 0 for x in status]
-      errored = [x is not None and x != 0 for x in status]
-      completed = sum([s is not None for s in status])
-      logger.debug(f"done: [{completed}/{len(status)}], success: {sum(success)}, errored: {sum(errored)}")
-
-      pending = n_items - completed
-      while pending and self._there_is_space():
-        with self._mutex:
-          try:
-            (tag, fn) = self.items.pop(0)
-          except IndexError:
-            break
-
-        print("Processing tag", tag)
-        p = fn()
-        self.processes.append(p)
-        pending -= 1
-
-  def submit(self, tag, fn, result_folder) -> _LocalMapFuture:
-    self.items.append((tag, fn))
-    fut = _LocalMapFuture(result_folder, tag)
-    return fut
-
-  def start(self):
-    self.event_loop.start()
-
-  def stop(self):
-    with self._mutex:
-      self._break = True
-    self.event_loop.join()
-
-
-
 DEFAULT_RESOURCE = Resource(
   cpu = "128m",         # 100mCPU
   memory = "256Mi",     # MiB
@@ -14,6 +14,7 @@ try:
   import uvicorn
 
   from fastapi import FastAPI
+  from fastapi import Request
   from fastapi.responses import JSONResponse, Response
   from fastapi.middleware.cors import CORSMiddleware
 except ImportError:
@@ -27,7 +28,9 @@ from typing import Any, Dict, Callable
 from nbox.version import __version__
 from nbox.operator import Operator
 from nbox.nbxlib.operator_spec import OperatorType
-from nbox.utils import py_from_bs64, py_to_bs64, logger, lo
+from nbox.utils import py_from_bs64, py_to_bs64, py_to_frames, py_from_buffer, logger, lo
+from nbox.nbxlib.serving_pool import ServingConfig, OperatorExecutor, ServingBusy
+from nbox.nbxlib.serving_workers import PreforkServer
 
 class SupportedServingTypes():
   NBOX = "nbox"
@@ -38,13 +41,49 @@ class SupportedServingTypes():
     return [getattr(SupportedServingTypes, x) for x in dir(SupportedServingTypes) if not x.startswith("__") and not x == "all"]
 
 
+UVICORN_LOG_CONFIG = {
+  "version": 1,
+  "disable_existing_loggers": False,
+  "formatters": {
+      "default": {
+          "()": "uvicorn.logging.DefaultFormatter",
+          "fmt": "%(levelprefix)s %(message)s",
+          "use_colors": None,
+      },
+      "access": {
+          "()": "uvicorn.logging.AccessFormatter",
+          "fmt": '%(levelprefix)s %(client_addr)s - "%(request_line)s" %(status_code)s',  # noqa: E501
+      },
+  },
+  "handlers": {
+      "default": {
+          "formatter": "default",
+          "class": "logging.StreamHandler",
+          "stream": "ext://sys.stderr",
+      },
+      "access": {
+          "formatter": "access",
+          "class": "logging.StreamHandler",
+          "stream": "ext://sys.stdout",
+      },
+  },
+  "loggers": {
+      "uvicorn": {"handlers": ["default"], "level": "INFO"},
+      "uvicorn.error": {"level": "INFO"},
+      "uvicorn.access": {"handlers": ["access"], "level": "INFO", "propagate": False},
+  },
+}
+
+
 def serve_operator(
   op_or_app: Operator,
   serving_type: str,
   host: str = "0.0.0.0",
   port: int = 8000,
   *,
-  model_name: str = ""
+  model_name: str = "",
+  config: ServingConfig = None,
+  **config_kwargs,
 ):
   """
   Serve an operator or a FastAPI app on a given host and port.
@@ -53,6 +92,8 @@ def serve_operator(
     op_or_app: The operator or FastAPI app to serve.
     host: The host to serve on.
     port: The port to serve on.
+    config: How the operator is served (workers, pools, batching), if not given it is built from `config_kwargs` eg.
+      `serve_operator(op, "nbox", max_workers = 4, max_queue = 16)`
   """
   # TODO: @yashbonde server can behave like a proxy to a different running server so it can be flask app or anything
   # https://stackoverflow.com/questions/70610266/proxy-an-external-website-using-python-fast-api-not-supporting-query-params
@@ -60,6 +101,7 @@ def serve_operator(
     logger.error("To run servers you will need to install the relevant dependencies:")
     logger.error("  pip install -U nbox[serving]")
     raise ImportError("fastapi not installed")
+  config = config or ServingConfig(**config_kwargs)
 
   app = FastAPI()
   app.add_middleware(
@@ -83,11 +125,19 @@ def serve_operator(
   if type(op_or_app) == Operator:
     # a special route for Operators to communicate with each other
     async def who_are_you():
-      return {"name": op_or_app.__qualname__, "nbox_version": __version__, "rest_api_style": "rest_{p}"}
+      return {
+        "name": op_or_app.__qualname__,
+        "nbox_version": __version__,
+        "rest_api_style": "rest_{p}",
+        "bin_api_style": "bin_{p}", # see `get_fastapi_bin_fn`
+      }
     app.add_api_route("/who_are_you", who_are_you, methods=["GET"], response_class=JSONResponse)
 
-    for route, fn in get_fastapi_routes(op_or_app):
+    executor = OperatorExecutor(config)
+    for route, fn in get_fastapi_routes(op_or_app, executor):
       app.add_api_route(route, fn, methods=["POST"], response_class=JSONResponse)
+    app.router.on_startup.append(executor.start)
+    app.router.on_shutdown.append(executor.shutdown)
   
   elif serving_type == SupportedServingTypes.FASTAPI:
     # app.mount("/x", op_or_app)
@@ -109,49 +159,38 @@ def serve_operator(
   # print all the endpoints
   logger.info(lo("Here are all the endpoints:\n", "\n".join([f"  {route.path}" for route in app.routes])))
 
+  if config.workers > 1:
+    # load once and fork, the model is shared between the workers
+    worker_init = None
+    if config.worker_init and type(op_or_app) == Operator:
+      worker_init = op_or_app.remote_init
+    server = PreforkServer(
+      app,
+      host = host,
+      port = port,
+      workers = config.workers,
+      worker_init = worker_init,
+      graceful_timeout = config.graceful_timeout,
+      log_config = UVICORN_LOG_CONFIG,
+    )
+    server.serve()
+    return
+
   # run the server with uvicorn and 
   uvicorn.run(
     app,
     host = host,
     port = port,
-    log_config = {
-      "version": 1,
-      "disable_existing_loggers": False,
-      "formatters": {
-          "default": {
-              "()": "uvicorn.logging.DefaultFormatter",
-              "fmt": "%(levelprefix)s %(message)s",
-              "use_colors": None,
-          },
-          "access": {
-              "()": "uvicorn.logging.AccessFormatter",
-              "fmt": '%(levelprefix)s %(client_addr)s - "%(request_line)s" %(status_code)s',  # noqa: E501
-          },
-      },
-      "handlers": {
-          "default": {
-              "formatter": "default",
-              "class": "logging.StreamHandler",
-              "stream": "ext://sys.stderr",
-          },
-          "access": {
-              "formatter": "access",
-              "class": "logging.StreamHandler",
-              "stream": "ext://sys.stdout",
-          },
-      },
-      "loggers": {
-          "uvicorn": {"handlers": ["default"], "level": "INFO"},
-          "uvicorn.error": {"level": "INFO"},
-          "uvicorn.access": {"handlers": ["access"], "level": "INFO", "propagate": False},
-      },
-    }
+    log_config = UVICORN_LOG_CONFIG,
   )
 
 
-def get_fastapi_routes(op: Operator):
+def get_fastapi_routes(op: Operator, executor: OperatorExecutor = None):
   """To keep seperation of responsibility the paths are scoped out like all the functions are
-  in the `/method_{...}` and all the custom python code is in `/nbx_py_rpc`"""
+  in the `/method_{...}` and all the custom python code is in `/nbx_py_rpc`. All the routes share the `executor`
+  so the concurrency limits are for the whole operator. Each of them also has a `/bin_{...}` twin that takes and
+  returns `py_to_frames` instead of base64 inside JSON."""
+  executor = executor or OperatorExecutor()
   if op._op_type == OperatorType.WRAP_CLS:
     routes = []
     # add functions that the user has exposed
@@ -163,35 +202,42 @@ def get_fastapi_routes(op: Operator):
         continue
       fn = getattr(wrap_class, p)
       # TODO:@yashbonde >>> replace /method_{p} with /pyrpc/{p} and /method_{p}_rest with /rest/{p}
-      routes.append((f"/method_{p}", get_fastapi_fn(fn)))
-      routes.append((f"/rest_{p}", get_fastapi_fn(fn, _rest = True)))
+      routes.append((f"/method_{p}", get_fastapi_fn(fn, executor = executor)))
+      routes.append((f"/rest_{p}", get_fastapi_fn(fn, _rest = True, executor = executor)))
+      routes.append((f"/bin_{p}", get_fastapi_bin_fn(fn, executor)))
 
     # add functions that the python itself can support
-    routes.append((f"/nbx_py_rpc", nbx_py_rpc(op)))
+    routes.append((f"/nbx_py_rpc", nbx_py_rpc(op, executor)))
+    routes.append((f"/bin_nbx_py_rpc", nbx_py_rpc(op, executor, _binary = True)))
   elif op._op_type in [OperatorType.JOB, OperatorType.SERVING]:
     raise RuntimeError("Cannot serve a job or serving operator")
   else:
     routes = [
-      ("/forward", get_fastapi_fn(op.forward)),
-      ("/forward_rest", get_fastapi_fn(op.forward, _rest = True)),
+      ("/forward", get_fastapi_fn(op.forward, executor = executor)),
+      ("/forward_rest", get_fastapi_fn(op.forward, _rest = True, executor = executor)),
+      ("/bin_forward", get_fastapi_bin_fn(op.forward, executor)),
     ]
   return routes
 
 
 # builder method is used to progrmatically generate api routes related information for the fastapi app
-def get_fastapi_fn(fn, _rest = False) -> Callable:
+def get_fastapi_fn(fn, _rest = False, executor: OperatorExecutor = None) -> Callable:
   """This function is used to generate a fastapi route for a given function, it will take in a function
   and return a function that can be used as a fastapi route
 
   Args:
     fn (Callable): function to be used as a fastapi route
     _rest (bool, optional): if the function is a REST endpoint. Defaults to False.
+    executor (OperatorExecutor, optional): runs `fn` without blocking the event loop, a new one if not given
 
   Returns:
     Callable: a function that can be used as a fastapi route
   """
   from pydantic import create_model
 
+  executor = executor or OperatorExecutor()
+  executor.register(fn)
+
   # we use inspect signature instead of writing our own ast thing
   signature = inspect.signature(fn)
   data_dict = {}
@@ -225,8 +271,10 @@ def get_fastapi_fn(fn, _rest = False) -> Callable:
       return {"error": str(e)}
 
     try:
-      out = fn(**data)
+      out = await executor.run(fn, data)
       return {"success": True, "value": py_to_bs64(out)}
+    except ServingBusy as e:
+      return _busy(response, e)
     except Exception as e:
       response.status_code = 500
       return {"success": False, "message": str(e)}
@@ -236,13 +284,15 @@ def get_fastapi_fn(fn, _rest = False) -> Callable:
     # need to add serialisation to this function because user won't by default send in a serialised object
     data = req.dict()
     try:
-      out = fn(**data)
+      out = await executor.run(fn, data)
       try:
         _ = json.dumps(out)
       except:
         response.status_code = 500
         return {"success": False, "message": "Function output cannot be serialised to JSON"}
       return {"success": True, "value": out}
+    except ServingBusy as e:
+      return _busy(response, e)
     except Exception as e:
       response.status_code = 500
       return {"success": False, "message": str(e)}
@@ -250,14 +300,108 @@ def get_fastapi_fn(fn, _rest = False) -> Callable:
   return generic_fwd_rest if _rest else generic_fwd
 
 
-def nbx_py_rpc(op: Operator):
+BIN_CONTENT_TYPE = "application/octet-stream"
+
+
+def get_fastapi_bin_fn(fn, executor: OperatorExecutor = None) -> Callable:
+  """Binary twin of `get_fastapi_fn`: the body is the kwargs dict written with `py_to_frames` (pickle protocol 5)
+  and the response is `{"success", "value" | "message"}` written the same way. Large buffers like numpy arrays or
+  tensors are sent as raw bytes, there is no base64 or JSON on the way."""
+  executor = executor or OperatorExecutor()
+  executor.register(fn)
+
+  async def generic_fwd_bin(request: Request):
+    response = Response(media_type = BIN_CONTENT_TYPE)
+    try:
+      data = py_from_buffer(await _read_body(request))
+      if not isinstance(data, dict):
+        raise TypeError(f"Expected the kwargs dict, got {type(data)}")
+    except Exception as e:
+      logger.error(f"Failed to load the binary request: {e}")
+      response.status_code = 400
+      return _bin_response({"success": False, "message": str(e)}, response)
+
+    try:
+      out = await executor.run(fn, data)
+      return _bin_response({"success": True, "value": out}, response)
+    except ServingBusy as e:
+      return _bin_response(_busy(response, e), response)
+    except Exception as e:
+      response.status_code = 500
+      return _bin_response({"success": False, "message": str(e)}, response)
+
+  return generic_fwd_bin
+
+
+async def _read_body(request) -> bytearray:
+  # straight in one writable buffer, so the arrays loaded from it are views on it and not read-only
+  if request.headers.get("content-type", "") != BIN_CONTENT_TYPE:
+    raise ValueError(f"Content-Type must be {BIN_CONTENT_TYPE}")
+  size = request.headers.get("content-length")
+  if size is None:
+    return bytearray(await request.body())
+  buf = bytearray(int(size))
+  view = memoryview(buf)
+  i = 0
+  async for chunk in request.stream():
+    if i + len(chunk) > len(buf):
+      raise ValueError("Body is larger than the Content-Length")
+    view[i:i + len(chunk)] = chunk
+    i += len(chunk)
+  if i != len(buf):
+    raise ValueError(f"Body ended at {i} of {len(buf)} bytes")
+  return buf
+
+
+def _bin_response(out: Dict, response) -> Response:
+  try:
+    body = b"".join(py_to_frames(out))
+  except Exception as e:
+    response.status_code = 500
+    body = b"".join(py_to_frames({"success": False, "message": f"Failed to serialise the output: {e}"}))
+  return Response(
+    content = body,
+    status_code = response.status_code,
+    headers = {k: v for k, v in response.headers.items() if k.lower() not in ("content-length", "content-type")},
+    media_type = BIN_CONTENT_TYPE,
+  )
+
+
+def _busy(response, e: ServingBusy):
+  # the client should back off and try again, see `ServingConfig.max_queue`
+  response.status_code = 429
+  response.headers["Retry-After"] = "1"
+  return {"success": False, "message": f"Too many requests: {e}"}
+
+
+def nbx_py_rpc(op: Operator, executor: OperatorExecutor = None, _binary = False):
   base_model = create_model("nbx_py_rpc", rpc_name = (str, ""), key = (str, ""), value = (str, ""),)
   _nbx_py_rpc = NbxPyRpc(op)
+  executor = executor or OperatorExecutor()
+
+  async def forward_bin(request: Request):
+    response = Response(media_type = BIN_CONTENT_TYPE)
+    try:
+      data = py_from_buffer(await _read_body(request))
+    except Exception as e:
+      response.status_code = 400
+      return _bin_response({"success": False, "message": str(e)}, response)
+    try:
+      out = await executor.run(_nbx_py_rpc, {"data": data, "response": response, "_binary": True})
+    except ServingBusy as e:
+      out = _busy(response, e)
+    return _bin_response(out, response)
+
+  if _binary:
+    return forward_bin
 
   async def forward(req: base_model, response: Response):
     # no need to add serialisation because the NbPyRpc class will handle it
     data = req.dict()
-    return _nbx_py_rpc(data, response)
+    try:
+      return await executor.run(_nbx_py_rpc, {"data": data, "response": response})
+    except ServingBusy as e:
+      return _busy(response, e)
 
   return forward
 
@@ -281,6 +425,9 @@ class NbxPyRpc(Operator):
   }
   ```
 
+  On `/bin_nbx_py_rpc` the same request and response are sent with `py_to_frames` and the key and value are the
+  python objects themselves.
+
   we should also add some routes to support a subset of important language features:
 
   - `__getattr__`: obtain any value by doing: `obj.x`
@@ -302,21 +449,31 @@ class NbxPyRpc(Operator):
     super().__init__()
     self.wrapped_cls = op
 
-  def forward(self, data, response) -> Dict[str, str]:
+  def forward(self, data, response, _binary = False) -> Dict[str, str]:
+    # with `_binary` the key and value are python objects and the value in the response is left as is, the
+    # caller sends it with `py_to_frames`
     response: Response = response
     _k = set(tuple(data.keys())) - set(["rpc_name", "key", "value"])
     if _k:
       response.status_code = 400
       return {"success": False, "message": f"invalid keys: {_k}"}
     rpc_name = data.get("rpc_name", "")
+    key = data.get("key", "")
+    value = data.get("value", "")
+    if not _binary:
+      if key:
+        key = py_from_bs64(key)
+      if value:
+        value = py_from_bs64(value)
+
     fn_map = {
       "__getattr__": (self.fn_getattr, key),
       "__getitem__": (self.fn_getitem, key),
       "__setitem__": (self.fn_setitem, key, value),
       "__delitem__": (self.fn_delitem, key),
-      "__iter__": (self.fn_iter),
-      "__next__": (self.fn_next),
-      "__len__": (self.fn_len),
+      "__iter__": (self.fn_iter,),
+      "__next__": (self.fn_next,),
+      "__len__": (self.fn_len,),
       "__contains__": (self.fn_contains, key),
     }
     _items = fn_map.get(rpc_name, None)
@@ -324,52 +481,44 @@ class NbxPyRpc(Operator):
       response.status_code = 400
       return {"success": False, "message": f"invalid rpc_name: {rpc_name}"}
 
-    key = data.get("key", "")
-    value = data.get("value", "")
-
-    if key:
-      key = py_from_bs64(key)
-    if value:
-      value = py_from_bs64(value)
-
     fn, *args = _items
     try:
       out = fn(*args)
-      return out
     except Exception as e:
       response.status_code = 500
       return {"success": False, "message": str(e)}
+    if "value" in out and not _binary:
+      out["value"] = py_to_bs64(out["value"])
+    return out
+
+  @property
+  def wrapped(self):
+    return self.wrapped_cls._op_spec.wrap_obj
 
   def fn_getattr(self, key):
     if key.startswith("_"):
       return {"success": False, "message": f"cannot access private attributes starting with '_'"}
-    out = getattr(self.wrapped_cls._op_wrap, key)
-    return {"success": True, "value": py_to_bs64(out)}
+    return {"success": True, "value": getattr(self.wrapped, key)}
 
   def fn_getitem(self, key):
-    out = self.wrapped_cls._op_wrap[key]
-    return {"success": True, "value": py_to_bs64(out)}
+    return {"success": True, "value": self.wrapped[key]}
 
   def fn_setitem(self, key, value):
-    self.wrapped_cls._op_wrap[key] = value
+    self.wrapped[key] = value
     return {"success": True}
 
   def fn_delitem(self, key):
-    del self.wrapped_cls._op_wrap[key]
+    del self.wrapped[key]
     return {"success": True}
 
   def fn_iter(self):
-    out = iter(self.wrapped_cls._op_wrap)
-    return {"success": True, "value": py_to_bs64(out)}
+    return {"success": True, "value": iter(self.wrapped)}
 
   def fn_next(self):
-    out = next(self.wrapped_cls._op_wrap)
-    return {"success": True, "value": py_to_bs64(out)}
+    return {"success": True, "value": next(self.wrapped)}
 
   def fn_len(self):
-    out = len(self.wrapped_cls._op_wrap)
-    return {"success": True, "value": py_to_bs64(out)}
+    return {"success": True, "value": len(self.wrapped)}
 
   def fn_contains(self, key):
-    out = key in self.wrapped_cls._op_wrap
-    return {"success": True, "value": py_to_bs64(out)}
+    return {"success": True, "value": key in self.wrapped}
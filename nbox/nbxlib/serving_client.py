@@ -0,0 +1,355 @@
+"""
+Clients for a served operator, these are what `Operator.from_serving` uses under the hood.
+
+- `ServingClient` is thread safe: one keep-alive connection pool (`pool_size` connections) is shared by all the
+  threads, `map` fans out over a thread pool
+- Calls that fail before reaching the serving (the connection could not be made) or with a retryable status (429,
+  502, 503, 504 by default) are retried with an exponential backoff and full jitter, `Retry-After` is respected.
+  A 500 is the operator raising an error so it is not retried unless asked to. Read timeouts and connections that
+  drop after the request was sent are only retried with `retry_read_timeouts`, the call may already be running
+  on the serving and a slow `__setitem__` or any call that is not idempotent would run twice
+- The arguments go as pickle frames on the `/bin_{...}` routes (see `get_fastapi_bin_fn`) if the serving has them,
+  else as base64 inside JSON
+- `AsyncServingClient` is the asyncio counterpart, `amap` fans out thousands of calls with bounded concurrency
+
+```python
+client = AsyncServingClient(ServingClient(url, headers = {"NBX-KEY": token}).connect(), max_concurrency = 128)
+outputs = await client.amap(inputs)
+```
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import time
+import random
+import asyncio
+import threading
+import requests
+from functools import partial
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Tuple
+
+import nbox.utils as U
+from nbox.utils import logger
+
+BIN_CONTENT_TYPE = "application/octet-stream"
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class _Required:
+  def __repr__(self):
+    return "<required>"
+
+REQ = _Required()
+
+
+class ServingError(Exception):
+  """raised when the serving answers with an error, `status_code` is the HTTP status"""
+  def __init__(self, message: str, status_code: int = None):
+    super().__init__(message)
+    self.status_code = status_code
+
+
+def _not_sent(e: requests.RequestException) -> bool:
+  """`True` if `e` happened before the request could reach the serving, so sending it again is always safe"""
+  if isinstance(e, requests.ConnectTimeout):
+    return True
+  if not isinstance(e, requests.ConnectionError) or not e.args:
+    return False
+  # connection refused, DNS, ... come wrapped in a MaxRetryError
+  return isinstance(getattr(e.args[0], "reason", e.args[0]), NewConnectionError)
+
+
+class ServingClient:
+  def __init__(
+    self,
+    url: str,
+    headers: Dict[str, str] = {},
+    *,
+    pool_size: int = 32,
+    retries: int = 3,
+    backoff: float = 0.1,
+    max_backoff: float = 10.,
+    retry_statuses: Tuple[int] = RETRY_STATUSES,
+    retry_read_timeouts: bool = False,
+    timeout: float = None,
+    binary: bool = True,
+  ):
+    """
+    Args:
+      url (str): URL of the serving
+      headers (Dict[str, str]): sent with every request eg. the auth headers
+      pool_size (int): keep-alive connections to the serving, also the threads in `map`
+      retries (int): retries after the first attempt
+      backoff (float): seconds before the first retry, doubled every retry
+      max_backoff (float): max seconds between two retries
+      retry_statuses (Tuple[int]): HTTP statuses that are retried
+      retry_read_timeouts (bool): also retry the read timeouts and the connections dropped after the request was
+        sent, only for operators where running a call twice is fine
+      timeout (float): seconds to wait for the serving to answer, `None` waits forever
+      binary (bool): use the binary routes if the serving has them
+    """
+    if pool_size < 1:
+      raise ValueError("pool_size must be >= 1")
+    self.url = url.rstrip("/") + "/"
+    self.pool_size = pool_size
+    self.retries = max(0, retries)
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.retry_statuses = tuple(retry_statuses)
+    self.retry_read_timeouts = retry_read_timeouts
+    self.timeout = timeout
+    self.binary = binary
+
+    self.session = requests.Session()
+    self.session.headers.update(headers)
+    # block instead of opening extra connections that are thrown away, so the keep-alive works under load
+    adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size, pool_block = True)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+
+    self.name = None
+    self.fn_spec = None
+    self._lock = threading.Lock()
+
+  def __repr__(self):
+    return f"ServingClient({self.url}, name={self.name}, binary={self.binary}, pool_size={self.pool_size})"
+
+  def __call__(self, *args, **kwargs):
+    return self.call("forward", *args, **kwargs)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def close(self):
+    self.session.close()
+
+  def connect(self) -> 'ServingClient':
+    """Load the functions from the OpenAPI spec and the details from `/who_are_you`, called on the first call"""
+    with self._lock:
+      if self.fn_spec is not None:
+        return self
+      r = self._request("get", "openapi.json")
+      try:
+        data = r.json()
+      except Exception:
+        logger.error(r.content)
+        raise
+      fn_spec = {}
+      for p, v in data["paths"].items():
+        if p.startswith("/method_"):
+          fn_name = p[8:]
+        elif p == "/forward":
+          fn_name = "forward"
+        else:
+          continue
+        ref_path = v["post"]["requestBody"]["content"]["application/json"]["schema"]["$ref"].split("/")[1:]
+        out = data
+        for x in ref_path:
+          out = out[x]
+        fn_spec[fn_name] = out["properties"]
+
+      try:
+        info = self._request("get", "who_are_you").json()
+      except Exception as e:
+        logger.error(f"Error: {e}")
+        raise ValueError("Unable to connect to the serving, you are probably not connected to a nbox serving")
+      self.name = info["name"]
+      # older servings only have the JSON routes
+      self.binary = self.binary and "bin_api_style" in info
+      self.fn_spec = fn_spec
+    return self
+
+  def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+    """The request with the retries, returns the last response if the statuses are not ok"""
+    for attempt in range(self.retries + 1):
+      r = None
+      try:
+        r = self.session.request(method, self.url + path, timeout = self.timeout, **kwargs)
+        if r.status_code not in self.retry_statuses:
+          return r
+        err = ServingError(f"{method.upper()} /{path}: {r.status_code}", r.status_code)
+      except (requests.ConnectionError, requests.Timeout) as e:
+        if not (self.retry_read_timeouts or _not_sent(e)):
+          raise
+        err = e
+      if attempt == self.retries:
+        if r is not None:
+          return r
+        raise err
+      delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+      retry_after = r.headers.get("Retry-After", "") if r is not None else ""
+      if r is not None:
+        r.close()
+      if retry_after.isdigit():
+        delay = max(delay, float(retry_after))
+      delay = random.uniform(0, delay) # full jitter so the clients do not come back together
+      logger.debug(f"Retrying /{path} in {delay:.2f}s ({attempt + 1}/{self.retries}): {err}")
+      time.sleep(delay)
+
+  def _get_kwargs(self, method: str, args, kwargs) -> Dict[str, Any]:
+    # the arguments like on the local machine, checked against the spec before sending
+    args_dict = {k: v.get("default", REQ) for k, v in self.fn_spec[method].items()}
+    data = {}
+    for i, k in enumerate(args_dict):
+      if len(args) == i:
+        break
+      data[k] = args[i]
+    if len(args) > len(args_dict):
+      raise ValueError(f"'{method}' takes {len(args_dict)} arguments, got {len(args)}")
+    data.update(kwargs)
+    unknown_args = set(data) - set(args_dict)
+    if unknown_args:
+      raise ValueError(f"Unknown arguments: {unknown_args}")
+    missing_args = {k for k, v in args_dict.items() if k not in data and v is REQ}
+    if missing_args:
+      raise ValueError(f"Missing required arguments: {missing_args}")
+    return data
+
+  def call(self, method: str, *args, **kwargs) -> Any:
+    """Call `method` on the serving, `forward` for the function operators. The python RPCs like `__getitem__`
+    take the key and the value as `args`"""
+    if self.fn_spec is None:
+      self.connect()
+    if method in self.fn_spec:
+      data = self._get_kwargs(method, args, kwargs)
+      route = method if method == "forward" else f"method_{method}"
+      bin_route = method
+    else:
+      data = {"rpc_name": method}
+      if len(args) > 0:
+        data["key"] = args[0]
+      if len(args) > 1:
+        data["value"] = args[1]
+      route = bin_route = "nbx_py_rpc"
+
+    if self.binary:
+      r = self._request(
+        "post",
+        f"bin_{bin_route}",
+        data = b"".join(U.py_to_frames(data)),
+        headers = {"Content-Type": BIN_CONTENT_TYPE},
+        stream = True,
+      )
+      with r:
+        if r.headers.get("Content-Type", "") != BIN_CONTENT_TYPE:
+          raise ServingError(f"Call to '{method}' failed ({r.status_code}): {r.text}", r.status_code)
+        out = U.py_from_stream(r.raw)
+    else:
+      data = {k: v if k == "rpc_name" else U.py_to_bs64(v) for k, v in data.items()}
+      r = self._request("post", route, json = data)
+      try:
+        out = r.json()
+      except Exception:
+        raise ServingError(f"Call to '{method}' failed ({r.status_code}): {r.text}", r.status_code)
+      if "value" in out:
+        out["value"] = U.py_from_bs64(out["value"])
+
+    if not out.get("success", False):
+      raise ServingError(out.get("message", out.get("error", str(out))), r.status_code)
+    return out.get("value", None)
+
+  def map(self, inputs: Iterable[Any], method: str = "forward", workers: int = None) -> List[Any]:
+    """Call `method` once per input (one positional argument each) over `workers` threads, by default the
+    `pool_size`. Returns the outputs in the same order as the inputs."""
+    if self.fn_spec is None:
+      self.connect()
+    with ThreadPoolExecutor(workers or self.pool_size, thread_name_prefix = "nbx-serving-client") as pool:
+      return list(pool.map(lambda x: self.call(method, x), inputs))
+
+
+class AsyncServingClient:
+  def __init__(
+    self,
+    client: ServingClient = None,
+    url: str = "",
+    *,
+    max_concurrency: int = 64,
+    **kwargs,
+  ):
+    """
+    Args:
+      client (ServingClient): wrap an existing client, else one is made from `url` and `kwargs`
+      url (str): URL of the serving
+      max_concurrency (int): calls in flight at the same time, the rest wait without holding a thread
+      **kwargs: passed to `ServingClient`, the `pool_size` defaults to `max_concurrency`
+    """
+    if max_concurrency < 1:
+      raise ValueError("max_concurrency must be >= 1")
+    if client is None:
+      if not url:
+        raise ValueError("Either client or url is required")
+      kwargs.setdefault("pool_size", max_concurrency)
+      client = ServingClient(url, **kwargs)
+    self.client = client
+    self.max_concurrency = max_concurrency
+    self._pool = ThreadPoolExecutor(max_workers = max_concurrency, thread_name_prefix = "nbx-aserving")
+    self._sem = None # created lazily so it binds to the running loop
+
+  def __repr__(self):
+    return f"Async{self.client!r}"
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *_):
+    self.close()
+
+  def close(self):
+    self._pool.shutdown(wait = False)
+    self.client.close()
+
+  async def _run(self, fn, *args, **kwargs) -> Any:
+    if self._sem is None:
+      self._sem = asyncio.Semaphore(self.max_concurrency)
+    async with self._sem:
+      loop = asyncio.get_running_loop()
+      return await loop.run_in_executor(self._pool, partial(fn, *args, **kwargs))
+
+  async def connect(self) -> 'AsyncServingClient':
+    await self._run(self.client.connect)
+    return self
+
+  async def call(self, method: str, *args, **kwargs) -> Any:
+    return await self._run(self.client.call, method, *args, **kwargs)
+
+  async def __call__(self, *args, **kwargs):
+    return await self.call("forward", *args, **kwargs)
+
+  async def amap(
+    self,
+    inputs: Iterable[Any],
+    method: str = "forward",
+    max_concurrency: int = None,
+    return_exceptions: bool = False,
+  ) -> List[Any]:
+    """Call `method` once per input (one positional argument each), at most `max_concurrency` at a time (by
+    default the client's). The inputs are pulled as the calls finish so a generator of millions is fine. Returns
+    the outputs in the same order as the inputs, with `return_exceptions` the failed ones are the exception
+    instead of raising the first one."""
+    max_concurrency = min(max_concurrency or self.max_concurrency, self.max_concurrency)
+    _next = enumerate(inputs) # shared by the workers, `next` always runs on the loop so it is safe
+    results = {}
+    failed = []
+
+    async def _worker():
+      for i, x in _next:
+        if failed and not return_exceptions:
+          return
+        try:
+          results[i] = await self.call(method, x)
+        except Exception as e:
+          if not return_exceptions:
+            failed.append(e)
+            return
+          results[i] = e
+
+    await asyncio.gather(*[_worker() for _ in range(max_concurrency)])
+    if failed:
+      raise failed[0]
+    return [results[i] for i in range(len(results))]
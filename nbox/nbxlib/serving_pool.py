@@ -0,0 +1,320 @@
+"""
+Running the operator calls of a serving without blocking the event loop. Every route of a served operator goes
+through one `OperatorExecutor`:
+
+- `async def` functions are awaited on the event loop like any FastAPI handler
+- sync functions (most model inference) run on a pool of threads, or of forked processes for pure python CPU
+  bound code that holds the GIL, so one slow request does not stall the others
+- at most `max_concurrency` calls run at a time and `max_queue` more can wait, after that the request is
+  answered with a 429 straight away instead of piling up in memory
+- with `max_batch_size` the requests are gathered for up to `max_batch_size` items or `max_wait_ms`, the function
+  is called once with the batch and the outputs are sent back to each caller (`MicroBatcher`)
+
+```python
+def predict(x):
+  # x is a list with one item per request
+  out = model(torch.stack([torch.tensor(i) for i in x]))
+  return out.tolist() # one output per request
+
+serve_operator(Operator.from_fn(predict), "nbox", max_batch_size = 32, max_wait_ms = 5)
+```
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import os
+import asyncio
+import inspect
+import multiprocessing
+from collections import deque
+from functools import partial
+from typing import Any, Callable, Dict, List
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from nbox.utils import logger
+
+
+class ExecutorType:
+  THREAD = "thread"
+  PROCESS = "process"
+
+  def all():
+    return [ExecutorType.THREAD, ExecutorType.PROCESS]
+
+
+class ServingConfig:
+  def __init__(
+    self,
+    executor: str = ExecutorType.THREAD,
+    max_workers: int = 0,
+    max_concurrency: int = 0,
+    max_queue: int = 64,
+    max_batch_size: int = 0,
+    max_wait_ms: float = 5.,
+    batch_methods: List[str] = [],
+    pad_to: List[int] = [],
+    collate_fn: Callable[[List[Dict[str, Any]]], Dict[str, Any]] = None,
+    scatter_fn: Callable[[Any, List[Dict[str, Any]]], List[Any]] = None,
+    workers: int = 1,
+    worker_init: bool = False,
+    graceful_timeout: float = 30.,
+  ):
+    """Configuration for serving an operator.
+
+    Args:
+      executor (str): where the sync functions run, one of `ExecutorType.all()`. `process` forks the workers
+        after the operator is loaded so the model is shared copy-on-write, the inputs and outputs are pickled and
+        any change to the operator's state in one process is not seen by the others
+      max_workers (int): size of the pool in each server worker, defaults to the number of CPUs split over the `workers`
+      max_concurrency (int): calls running at the same time across all the routes, defaults to `max_workers`
+      max_queue (int): calls waiting for a free slot, more than this get a 429. When batching this counts the
+        batches so up to `(max_concurrency + max_queue) * max_batch_size` requests can be gathered
+      max_batch_size (int): batch the requests to a function in up to these many items, 0 to not batch. The
+        function gets the same arguments with a list of values (see `collate_fn`) and returns a list of outputs
+      max_wait_ms (float): max time the first request in a batch waits for more to come in
+      batch_methods (List[str]): names of the functions to batch eg. `["predict"]`, all if empty
+      pad_to (List[int]): batch sizes the function supports eg. `[1, 8, 32]` for a compiled model, a batch is padded
+        to the next size by repeating its last request and the extra outputs are dropped
+      collate_fn (Callable): `collate_fn(requests) -> kwargs`, builds the function arguments from the list of
+        request arguments. The default gives a list per argument, this is where the inputs are padded or stacked
+      scatter_fn (Callable): `scatter_fn(out, requests) -> outputs`, splits the function output back to one per
+        request (the extra ones from `pad_to` are dropped), the default is `list(out)`
+      workers (int): server processes forked after the operator is loaded, see `PreforkServer`
+      worker_init (bool): call `remote_init` again in each server worker after the fork, it has already run once
+        in the parent when the operator was loaded (so the weights are shared) and this is for the things that cannot
+        cross a fork eg. CUDA contexts or DB connections
+      graceful_timeout (float): seconds a stopping server worker gets to finish the in-flight requests
+    """
+    if executor not in ExecutorType.all():
+      raise ValueError(f"Invalid executor: {executor}, must be one of {ExecutorType.all()}")
+    if max_workers < 0 or max_concurrency < 0 or max_queue < 0 or max_batch_size < 0:
+      raise ValueError("max_workers, max_concurrency, max_queue and max_batch_size cannot be negative")
+    if workers < 1:
+      raise ValueError("workers must be at least 1")
+    if max_batch_size and max_wait_ms < 0:
+      raise ValueError("max_wait_ms cannot be negative")
+    self.executor = executor
+    self.max_workers = max_workers or max(1, (os.cpu_count() or 1) // workers)
+    self.max_concurrency = max_concurrency or self.max_workers
+    self.max_queue = max_queue
+    self.max_batch_size = max_batch_size
+    self.max_wait_ms = max_wait_ms
+    self.batch_methods = list(batch_methods)
+    self.pad_to = sorted(pad_to)
+    self.collate_fn = collate_fn or default_collate
+    self.scatter_fn = scatter_fn or default_scatter
+    self.workers = workers
+    self.worker_init = worker_init
+    self.graceful_timeout = graceful_timeout
+
+  def __repr__(self):
+    batching = ""
+    if self.max_batch_size:
+      batching = f", max_batch_size={self.max_batch_size}, max_wait_ms={self.max_wait_ms}"
+    return f"ServingConfig(workers={self.workers}, executor='{self.executor}', max_workers={self.max_workers}, " \
+      f"max_concurrency={self.max_concurrency}, max_queue={self.max_queue}{batching})"
+
+  def batches(self, fn: Callable) -> bool:
+    """`True` if the calls to `fn` are batched"""
+    if not self.max_batch_size:
+      return False
+    return not self.batch_methods or getattr(fn, "__name__", "") in self.batch_methods
+
+
+def default_collate(requests: List[Dict[str, Any]]) -> Dict[str, Any]:
+  return {k: [r[k] for r in requests] for k in requests[0]}
+
+
+def default_scatter(out: Any, requests: List[Dict[str, Any]]) -> List[Any]:
+  return list(out)
+
+
+class ServingBusy(Exception):
+  """raised when the operator is running `max_concurrency` calls and `max_queue` more are waiting"""
+
+
+# functions that can run in the forked processes, the children get this list when they are forked so the
+# functions (and the model they hold) are never pickled
+_FORK_FNS: List[Callable] = []
+
+def _call_forked(idx: int, kwargs: Dict[str, Any]):
+  return _FORK_FNS[idx](**kwargs)
+
+
+class OperatorExecutor:
+  def __init__(self, config: ServingConfig = None):
+    self.config = config or ServingConfig()
+    self._pool = None
+    self._threads = None
+    self._sem = None
+    self._waiting = 0
+    self._fork_idx = {} # id(fn) -> index in _FORK_FNS
+    self._batchers = {} # id(fn) -> MicroBatcher
+
+  def __repr__(self):
+    return f"OperatorExecutor({self.config}, waiting={self._waiting})"
+
+  def register(self, fn: Callable):
+    """Call this for each function when building the routes, the process pool is forked in `start` so everything
+    has to be registered by then"""
+    if self.config.executor == ExecutorType.PROCESS and not is_async(fn) and id(fn) not in self._fork_idx:
+      if self._pool is not None:
+        raise RuntimeError("Cannot register functions after the process pool has started")
+      self._fork_idx[id(fn)] = len(_FORK_FNS)
+      _FORK_FNS.append(fn)
+    if self.config.batches(fn) and id(fn) not in self._batchers:
+      self._batchers[id(fn)] = MicroBatcher(self, fn)
+
+  def start(self):
+    """Fork the process pool and wait till all its workers are up. `serve_operator` runs this in a startup hook so
+    the fork happens before the first request, before the thread pool exists and once in each server worker"""
+    if not self._fork_idx or self._pool is not None:
+      return
+    if "fork" not in multiprocessing.get_all_start_methods():
+      logger.warning("fork is not available on this platform, running the operator in threads")
+      self._fork_idx = {}
+      return
+    self._pool = ProcessPoolExecutor(self.config.max_workers, mp_context = multiprocessing.get_context("fork"))
+    # the workers are forked on the first submit, do it here so no request waits for it
+    for fut in [self._pool.submit(os.getpid) for _ in range(self.config.max_workers)]:
+      fut.result()
+    logger.info(f"Forked the serving pool: {self.config}")
+
+  def _get_pool(self, fn: Callable):
+    if self._fork_idx and self._pool is None:
+      self.start() # the routes were not served by `serve_operator`
+    if id(fn) in self._fork_idx:
+      return self._pool
+    # everything that is not registered runs in the parent, eg. `NbxPyRpc` that changes the operator's state
+    if self._threads is None:
+      self._threads = ThreadPoolExecutor(self.config.max_workers, thread_name_prefix = "nbx-serving")
+    return self._threads
+
+  def _get_sem(self) -> asyncio.Semaphore:
+    # created lazily so it belongs to the loop the server runs in
+    if self._sem is None:
+      self._sem = asyncio.Semaphore(self.config.max_concurrency)
+    return self._sem
+
+  async def run(self, fn: Callable, kwargs: Dict[str, Any]):
+    """Run `fn(**kwargs)` within the limits, raises `ServingBusy` if the queue is full"""
+    batcher = self._batchers.get(id(fn))
+    if batcher is not None:
+      return await batcher.submit(kwargs)
+    sem = self._get_sem()
+    if sem.locked() and self._waiting >= self.config.max_queue:
+      raise ServingBusy(f"{self.config.max_concurrency} requests running and {self._waiting} waiting")
+    self._waiting += 1
+    try:
+      await sem.acquire()
+    finally:
+      self._waiting -= 1
+    try:
+      return await self._call(fn, kwargs)
+    finally:
+      sem.release()
+
+  async def _call(self, fn: Callable, kwargs: Dict[str, Any]):
+    if is_async(fn):
+      return await fn(**kwargs)
+    loop = asyncio.get_running_loop()
+    pool = self._get_pool(fn)
+    if id(fn) in self._fork_idx:
+      out = await loop.run_in_executor(pool, _call_forked, self._fork_idx[id(fn)], kwargs)
+    else:
+      out = await loop.run_in_executor(pool, partial(fn, **kwargs))
+    if inspect.isawaitable(out):
+      # a sync wrapper that returned a coroutine
+      out = await out
+    return out
+
+  def shutdown(self):
+    for pool in (self._pool, self._threads):
+      if pool is not None:
+        pool.shutdown(wait = False)
+    self._pool = self._threads = None
+
+
+def is_async(fn: Callable) -> bool:
+  return inspect.iscoroutinefunction(fn) or inspect.iscoroutinefunction(getattr(fn, "__call__", None))
+
+
+class MicroBatcher:
+  def __init__(self, executor: OperatorExecutor, fn: Callable):
+    """Gathers the calls to `fn` into batches, see `ServingConfig` for the knobs. A batch is only closed once there
+    is a free slot to run it in, so under load the batches fill up instead of queueing many small ones."""
+    self.executor = executor
+    self.fn = fn
+    self.config = executor.config
+    self.batches = 0
+    self.items = 0
+
+    self._pending = deque() # (kwargs, future, arrived)
+    self._wake = None
+    self._task = None
+
+  def __repr__(self):
+    avg = self.items / self.batches if self.batches else 0
+    return f"MicroBatcher(fn={getattr(self.fn, '__name__', self.fn)}, pending={len(self._pending)}, avg_batch={avg:.1f})"
+
+  async def submit(self, kwargs: Dict[str, Any]):
+    """Add one call to the next batch and wait for its output"""
+    # a burst has to fill the free slots too before anything is really waiting
+    limit = self.config.max_batch_size * (self.config.max_concurrency + self.config.max_queue)
+    if len(self._pending) >= limit:
+      raise ServingBusy(f"{len(self._pending)} requests waiting to be batched")
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    self._pending.append((kwargs, fut, loop.time()))
+    if self._wake is None:
+      self._wake = asyncio.Event()
+    self._wake.set()
+    if self._task is None or self._task.done():
+      self._task = loop.create_task(self._collect())
+    return await fut
+
+  async def _collect(self):
+    loop = asyncio.get_running_loop()
+    sem = self.executor._get_sem()
+    max_wait = self.config.max_wait_ms / 1000
+    while self._pending:
+      await sem.acquire()
+      # fill till the batch is full or the oldest request has waited long enough
+      while self._pending and len(self._pending) < self.config.max_batch_size:
+        remaining = self._pending[0][2] + max_wait - loop.time()
+        if remaining <= 0:
+          break
+        self._wake.clear()
+        try:
+          await asyncio.wait_for(self._wake.wait(), remaining)
+        except asyncio.TimeoutError:
+          break
+      n = min(len(self._pending), self.config.max_batch_size)
+      batch = [self._pending.popleft() for _ in range(n)]
+      batch = [x for x in batch if not x[1].done()] # the caller went away
+      if not batch:
+        sem.release()
+        continue
+      loop.create_task(self._run_batch(batch, sem))
+
+  async def _run_batch(self, batch, sem: asyncio.Semaphore):
+    n = len(batch)
+    try:
+      requests = [kwargs for kwargs, _, _ in batch]
+      size = next((s for s in self.config.pad_to if s >= n), n)
+      requests += [requests[-1]] * (size - n)
+      out = await self.executor._call(self.fn, self.config.collate_fn(requests))
+      outs = list(self.config.scatter_fn(out, requests))
+      if len(outs) < n:
+        raise ValueError(f"Batched call to '{getattr(self.fn, '__name__', self.fn)}' returned {len(outs)} outputs for {n} inputs")
+      for (_, fut, _), o in zip(batch, outs):
+        if not fut.done():
+          fut.set_result(o)
+    except Exception as e:
+      for _, fut, _ in batch:
+        if not fut.done():
+          fut.set_exception(e)
+    finally:
+      sem.release()
+      self.batches += 1
+      self.items += n
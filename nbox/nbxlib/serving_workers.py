@@ -0,0 +1,239 @@
+"""
+Multi-worker serving with pre-fork. The operator is loaded once in the parent process, the socket is bound once
+and then `workers` processes are forked from it, each running its own uvicorn server on the shared socket. The
+model weights loaded in the parent are shared copy-on-write so 16 workers do not take 16x the memory.
+
+- Workers that die are forked again from the parent
+- `kill -HUP <parent pid>` does a rolling restart: a new worker is forked and once it is ready an old one is
+  stopped gracefully (in-flight requests finish), one at a time so the serving never goes down. The new workers are
+  forked from the same parent so they run the same code and weights that were loaded at the start, to pick up new
+  ones restart the whole server
+- Threads do not survive a fork. The `Tracker`s (with `LmaoAsgiMiddleware`) and `Relics` clients made before
+  `serve` start over in each worker: their background threads and pools are started again and every worker
+  writes its own WAL. Anything else with threads, sockets or locks made in the parent goes in `worker_init`
+- `SIGTERM` or `SIGINT` stop all the workers gracefully and then the parent
+
+```python
+serve_operator(op, "nbox", workers = 8, worker_init = True)
+```
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import os
+import time
+import select
+import signal
+import socket
+from typing import Callable, Dict
+
+from nbox.utils import logger
+
+
+class PreforkServer:
+  def __init__(
+    self,
+    app,
+    host: str,
+    port: int,
+    workers: int,
+    worker_init: Callable = None,
+    graceful_timeout: float = 30.,
+    ready_timeout: float = 120.,
+    log_config: Dict = None,
+  ):
+    """
+    Args:
+      app: the ASGI app, built before the fork so every worker gets the same routes
+      host (str): host to bind on
+      port (int): port to bind on
+      workers (int): number of worker processes
+      worker_init (Callable): called in each worker after the fork, eg. `op.remote_init` for things that cannot
+        be shared across processes like CUDA contexts or DB connections
+      graceful_timeout (float): seconds a stopping worker gets to finish the in-flight requests
+      ready_timeout (float): seconds a new worker gets to start serving, including `worker_init`
+      log_config (Dict): uvicorn log config
+    """
+    if not hasattr(os, "fork"):
+      raise RuntimeError("Multi-worker serving needs os.fork, it is not available on this platform")
+    if workers < 1:
+      raise ValueError("workers must be at least 1")
+    self.app = app
+    self.host = host
+    self.port = port
+    self.workers = workers
+    self.worker_init = worker_init
+    self.graceful_timeout = graceful_timeout
+    self.ready_timeout = ready_timeout
+    self.log_config = log_config
+
+    self._sock = None
+    self._ready_fd = None # write end of the pipe in the worker
+    self._workers = {} # pid -> read end of the pipe
+    self._stopping = False
+    self._reload = False
+
+    # the lifespan startup runs when the worker is about to accept connections
+    self.app.router.on_startup.append(self._notify_ready)
+
+  def __repr__(self):
+    return f"PreforkServer({self.host}:{self.port}, workers={list(self._workers)})"
+
+  def serve(self):
+    """Bind the socket, fork the workers and look after them till a `SIGTERM` or `SIGINT`"""
+    self._sock = self._bind()
+    signal.signal(signal.SIGTERM, self._on_stop)
+    signal.signal(signal.SIGINT, self._on_stop)
+    signal.signal(signal.SIGHUP, self._on_reload)
+    logger.info(f"Starting {self.workers} workers on {self.host}:{self.port} (parent pid: {os.getpid()})")
+    try:
+      for _ in range(self.workers):
+        self._spawn()
+      while not self._stopping:
+        self._reap()
+        if self._reload:
+          self._reload = False
+          self._rolling_restart()
+        time.sleep(0.2)
+    finally:
+      self._stop_all()
+      self._sock.close()
+      logger.info("All workers stopped")
+
+  def reload(self):
+    """Rolling restart of all the workers, same as a `SIGHUP`. The workers are forked again from this process so
+    code or weights changed on the disk are not loaded"""
+    self._reload = True
+
+  def _on_stop(self, signum, frame):
+    self._stopping = True
+
+  def _on_reload(self, signum, frame):
+    self._reload = True
+
+  def _bind(self) -> socket.socket:
+    family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((self.host, self.port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+  def _spawn(self) -> int:
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      os.close(r)
+      self._run_worker(w) # never returns
+    os.close(w)
+    self._workers[pid] = r
+    logger.info(f"Started worker {pid}")
+    return pid
+
+  def _run_worker(self, ready_fd: int):
+    import uvicorn
+
+    code = 0
+    try:
+      # the parent's handlers and book-keeping are not for the workers, uvicorn sets its own
+      for s in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+        signal.signal(s, signal.SIG_DFL)
+      for fd in self._workers.values():
+        os.close(fd)
+      self._workers = {}
+      self._ready_fd = ready_fd
+      if self.worker_init is not None:
+        self.worker_init()
+      config = uvicorn.Config(self.app, host = self.host, port = self.port, log_config = self.log_config)
+      uvicorn.Server(config).run(sockets = [self._sock])
+    except BaseException as e:
+      logger.error(f"Worker {os.getpid()} failed: {e}")
+      code = 1
+    finally:
+      # skip the parent's atexit handlers, they belong to the parent
+      os._exit(code)
+
+  def _notify_ready(self):
+    if self._ready_fd is not None:
+      os.write(self._ready_fd, b"1")
+      os.close(self._ready_fd)
+      self._ready_fd = None
+
+  def _wait_ready(self, pid: int) -> bool:
+    r = self._workers[pid]
+    deadline = time.monotonic() + self.ready_timeout
+    while not self._stopping and time.monotonic() < deadline:
+      readable, _, _ = select.select([r], [], [], 0.2)
+      if readable:
+        return os.read(r, 1) == b"1" # EOF if the worker died
+    return False
+
+  def _forget(self, pid: int):
+    os.close(self._workers.pop(pid))
+
+  def _reap(self):
+    # fork again the workers that died on their own
+    while True:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except ChildProcessError:
+        return
+      if pid == 0:
+        return
+      if pid not in self._workers:
+        continue
+      self._forget(pid)
+      if self._stopping:
+        continue
+      code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+      logger.warning(f"Worker {pid} exited with code {code}, starting a new one")
+      time.sleep(1.) # do not spin if the workers crash on start
+      self._spawn()
+
+  def _rolling_restart(self):
+    old = list(self._workers)
+    logger.info(f"Rolling restart of {len(old)} workers")
+    for pid in old:
+      if self._stopping:
+        return
+      new = self._spawn()
+      if not self._wait_ready(new):
+        logger.error(f"New worker {new} did not get ready in {self.ready_timeout}s, stopping the restart")
+        self._stop(new)
+        return
+      self._stop(pid)
+    logger.info("Rolling restart done")
+
+  def _stop(self, pid: int):
+    """graceful stop with a `SIGTERM`, `SIGKILL` after `graceful_timeout`"""
+    try:
+      os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+      pass
+    deadline = time.monotonic() + self.graceful_timeout
+    while True:
+      try:
+        done, _ = os.waitpid(pid, os.WNOHANG)
+      except ChildProcessError:
+        break # already reaped
+      if done:
+        break
+      if time.monotonic() > deadline:
+        logger.warning(f"Worker {pid} did not stop in {self.graceful_timeout}s, killing it")
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        break
+      time.sleep(0.05)
+    if pid in self._workers:
+      self._forget(pid)
+
+  def _stop_all(self):
+    pids = list(self._workers)
+    for pid in pids:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except ProcessLookupError:
+        pass
+    for pid in pids:
+      self._stop(pid)
@@ -107,7 +107,6 @@ import os
 import re
 import inspect
 import asyncio
-import requests
 from tqdm import tqdm
 from tabulate import tabulate
 from functools import partial
@@ -130,7 +129,7 @@ from nbox.jobs import Schedule, Job, Serve, _get_job_data
 from nbox.messages import write_binary_to_file
 from nbox.relics import Relics
 from nbox.init import nbox_ws_v1
-from nbox.subway import SpecSubway
+from nbox.nbxlib.serving_client import ServingClient
 
 
 # alias
@@ -343,141 +342,51 @@ class Operator():
     return _op
 
   @classmethod
-  def from_serving(cls, url: str, token: str):
+  def from_serving(cls, url: str, token: str, binary: bool = True, **client_kwargs):
     """Latch to an existing serving operator
 
     Args:
       url (str): The URL of the serving
       token (str): The token to access the deployment, get it from settings.
+      binary (bool): send the arguments and get the outputs as pickle frames (`U.py_to_frames`) if the serving
+        supports it, numpy arrays and tensors go as raw bytes instead of base64 inside JSON
+      **client_kwargs: passed to `ServingClient` eg. `pool_size`, `retries`, `timeout`
     """
     logger.debug(f"Latching to serving: {url}")
 
     # now we can run a NBX-Let either on a Pod or on the Build instance, so we can check the URL
     # once and make a judgement based on that
 
-    session = requests.Session()
     if re.match("https:\/\/api\.nimblebox\.ai\/(\w+)\/", url):
       # this is deployment on a Pod
-      session.headers.update({"NBX-KEY": token})
+      headers = {"NBX-KEY": token}
       serving_id = url.split("/")[-1]
     elif re.match("https:\/\/(\w+)-(\w+)\.build([\.rc]+)*\.nimblebox\.ai\/", url):
       # this is deployment on a Build instance, there's a catch though without knowing the
-      session.headers.update({
+      headers = {
         "NBX-TOKEN": token,
         "X-NBX-USERNAME": secret.username,
-      })
+      }
       serving_id = url
     else:
       raise ValueError(f"Invalid URL: {url}")
 
-    openapi_url = f"{url}openapi.json" # url has as trailing slash
-    r = session.get(openapi_url)
-    try:
-      data = r.json()
-    except:
-      logger.error(r.content)
-      raise
-
-    REQ = type("REQ", (object,), {})
-
-    # create a function to input spec mapper and so the generic forward method can be 
-    fn_spec = {}
-    for p, v in data["paths"].items():
-      if p.startswith("/method_"):
-        fn_name = p[8:]
-        v = v["post"]
-        # op_id = v["operationId"]
-        ref_path = v["requestBody"]["content"]["application/json"]["schema"]["$ref"].split("/")[1:]
-        out = data
-        for p in ref_path:
-          out = out[p]
-        args = out["properties"]
-        fn_spec[fn_name] = args
-      elif p == "/forward":
-        fn_name = "forward"
-        v = v["post"]
-        # op_id = v["operationId"]
-        ref_path = v["requestBody"]["content"]["application/json"]["schema"]["$ref"].split("/")[1:]
-        out = data
-        for p in ref_path:
-          out = out[p]
-        args = out["properties"]
-        fn_spec[fn_name] = args
-
-    serving_stub = SpecSubway.from_openapi(data, _url = url, _session = session)
-
-    # define the forward function for this serving operator, the objective is that this will be able to handle
-    # args, kwargs just like how it works on the local machine
-    def forward(method, *args, **kwargs):
-      if method in fn_spec:
-        # check in the kwargs if we have any arguments to pass
-        args_dict = {k: v.get("default", REQ) for k, v in fn_spec[method].items()}
-        _data = {} # the json that will be sent over
-        for i, (k, v) in enumerate(args_dict.items()):
-          if len(args) == i:
-            break
-          _data[k] = args[i]
-        for k, v in kwargs.items():
-          _data[k] = v
-
-        # client-side check for unknown vars
-        unknown_args = set()
-        for k, v in _data.items():
-          if k not in args_dict:
-            unknown_args.add(k)
-        if len(unknown_args):
-          raise ValueError(f"Unknown arguments: {unknown_args}")
-
-        missing_args = set()
-        for k, v in args_dict.items():
-          if k not in _data and v == REQ:
-            missing_args.add(k)
-        if len(missing_args):
-          raise ValueError(f"Missing required arguments: {missing_args}")
-
-        # this is a simple method call
-        if method == "forward":
-          fn = "forward"
-        elif method in fn_spec:
-          fn = f"method_{method}"
-
-        # serialize everything to b64
-        for k, v in _data.items():
-          _data[k] = U.py_to_bs64(v)
-      else:
-        _data = {"rpc_name": method, "key": U.py_to_bs64(args[0])}
-        if len(args) > 1:
-          _data["value"] = U.py_to_bs64(args[1])
-        fn = "nbx_py_rpc"
-
-      # now we can call the function
-      data = serving_stub.u(fn)(**_data)
-
-      # convert to usable values
-      if not data["success"]:
-        raise Exception(data["message"])
-      value = U.py_from_bs64(data["value"])
-      return value
-
-    # call the stub and get details of the operator
-    try:
-      data = serving_stub.who_are_you()
-    except AttributeError as e:
-      logger.error(f"Error: {e}")
-      logger.error("Unable to connect to the serving, you are probably not connected to a nbox serving")
-      raise ValueError("Unable to connect to the serving, you are probably not connected to a nbox serving")
+    # the client loads the function spec from the OpenAPI and the details from `/who_are_you`, the calls can
+    # come from many threads at once and share the keep-alive connections
+    client = ServingClient(url, headers, binary = binary, **client_kwargs).connect()
 
     # create the class and override some values to make more sense
     _op = cls()
-    _op.__qualname__ = "serving_" + data["name"]
+    _op.__qualname__ = "serving_" + client.name
 
-    _op.forward = forward
+    _op.forward = client.call
     _op._op_type = ospec.OperatorType.SERVING
     _op._op_spec = ospec._ServingSpec(
       serving_id = serving_id,
-      rpc_fn_name = data["name"],
-      fn_spec = fn_spec,
+      rpc_fn_name = client.name,
+      fn_spec = client.fn_spec,
       workspace_id = "unknown--",
+      client = client,
     )
     return _op
 
@@ -866,107 +775,45 @@ get_schedule = lambda: None
       logger.info("model_url: " + model_url)
       return self.from_serving(model_url, token = token)
 
-  def map(self, inputs: Union[List[Any], Tuple[Any]], workers: int = -1) -> Iterable[Any]:
+  def imap(self, inputs: Iterable[Any], workers: int = -1, chunksize: int = 0, ordered: bool = True) -> Iterable[Any]:
+    """Like `map` for the operators on this machine but yields the outputs as they are ready, in the order of the
+    inputs or with `ordered = False` as soon as they are done. The inputs can be a generator, they are pulled as
+    the workers free up so millions of inputs do not have to fit in memory."""
+    if self._op_type not in [ospec.OperatorType.UNSET, ospec.OperatorType.WRAP_FN]:
+      raise NotImplementedError(f"imap is only for the operators on this machine, use map for: {self._op_type}")
+    from nbox.nbxlib.local_map import LocalMapPool
+
+    def _imap():
+      # the pool lives as long as the caller iterates
+      with LocalMapPool(self, workers, chunksize) as pool:
+        yield from (pool.imap(inputs) if ordered else pool.imap_unordered(inputs))
+    return _imap()
+
+  def map(self, inputs: Union[List[Any], Tuple[Any]], workers: int = -1, chunksize: int = 0) -> Iterable[Any]:
     """Take the same logic and apply it to a list of inputs, different from star_map in that it
     takes in different logic and applied different inputs. Returns results in the same order as
     inputs.
-    
-    In the current version runs as many workers as are the inputs."""
+
+    Operators on this machine run on a pool of `workers` processes (all the CPUs by default), see `LocalMapPool`
+    and `imap` to get the outputs as they come. Jobs run as many workers as are the inputs."""
     if self._op_type == ospec.OperatorType.SERVING:
-      raise NotImplementedError("What does a map call really mean for an API endpoint? Like parallel calls, try mapping a function.")
+      # parallel calls over the pooled client, use `AsyncServingClient.amap` from an event loop
+      return self._op_spec.client.map(inputs, workers = None if workers == -1 else workers)
     elif self._op_type == ospec.OperatorType.WRAP_CLS:
       raise NotImplementedError("What does a map call really mean for a class?")
 
     # this another big ass function that manages this call for all the different types of ospec.OperatorTypes
-    if len(inputs) > 10:
-      raise RuntimeError(f"Too many maps: {len(inputs)}, current limit is 10")
-    workers = len(inputs) if workers == -1 else workers
-    inputs = [[x] for x in inputs]
-
     # the main if/else tree
     if self._op_type in [ospec.OperatorType.UNSET, ospec.OperatorType.WRAP_FN]:
-      import sys
-      from subprocess import Popen
-      FOLDER = ".nbx-para-logs"
-      os.makedirs(FOLDER, exist_ok = True)
-
-      # here's how this thing does a map on local machines:
-      # * we create an exe.py object in the current folder, serialise and store all the inputs in the local relics
-      #   start a process manager that waits till all the processes are done and files are ready for consumption
-      #   all the logs (stdout, stderr) of the execution will be written in separate files.
-      # * the current parent process only cares about ensuring that the process runs correctly, and not about the
-      #   logic to be executed by the workers.
-      # * instead of writing to the RelicsLocal we directly write to file which helps us avoid lack of locks in relics.
-      #   all the files will be written in the .nbx-para-logs folder.
-
-      # create the exe.py file
-      fp, folder, file, name = ospec.get_operator_location(self)
-      exe_file = U.join(folder, "exe.py")
-      init = ''
-      if self._op_type == ospec.OperatorType.UNSET:
-        init = '()'
-      with open(exe_file, "w") as f:
-        f.write(f"""
-import os
-os.environ["PYTHONUNBUFFERED"] = "true" # so print comes when it should come
-from nbox.lib.dist import LocalNBXLet
-from {file.split('.')[0]} import {name}
-
-if __name__ == "__main__":
-  tag = os.getenv("NBOX_TAG_ID", None)
-  if tag is None:
-    raise ValueError("NBOX_TAG_ID not set")
-  op = LocalNBXLet({name}{init}, os.path.join("{FOLDER}",tag+"_input"), os.path.join("{FOLDER}",tag+"_output"))
-  print(op)
-  op()
-""".strip())
-
-      run_tags = [U.get_random_name(True).split("-")[0] for _ in range(len(inputs))]
-      U.threaded_map(
-        lambda tag, inp: U.to_pickle(inp, U.join(FOLDER, tag + "_input")),
-        [[x,inp] for x,inp in zip(run_tags, inputs)],
-        _name = "write_inputs",
-      )
-
-      processes = []
-      run_tag_to_input_idx = {}
-      proc_ids = []
-      open_files = []
-      for idx, tag in enumerate(run_tags):
-        run_tag_to_input_idx[tag] = idx
-        stdout = open(f".nbx-para-logs/{tag}.log", "w")
-        proc = Popen(
-          args = [sys.executable, exe_file],
-          bufsize = 2 << 9, # 1024 bytes buffer when writing the files
-          env = {"NBOX_TAG_ID": tag},
-          stdout = stdout,
-          stderr = stdout,
-          shell = False
-        )
-        processes.append(proc)
-        proc_ids.append(proc.pid)
-        open_files.append(stdout)
-
-      # wait till all the processes are done
-      while True:
-        sleep(1)
-        status = [p.poll() for p in processes]
-        success = [x == 0 for x in status]
-        errored = [x is not None and x != 0 for x in status]
-        completed = sum([s is not None for s in status])
-        logger.debug(f"total: {len(status)}, success: {sum(success)}, errored: {sum(errored)}, completed: {completed}")
-        if completed == len(inputs):
-          break
-      
-      # get the results
-      results = U.threaded_map(lambda x: U.from_pickle(U.join(FOLDER, x + "_output")), [[x] for x in run_tags], _name = "read_outputs")
-
-      # clean up
-      for f in open_files:
-        f.close()
-      return results
+      from nbox.nbxlib.local_map import LocalMapPool
+      with LocalMapPool(self, workers, chunksize) as pool:
+        return pool.map(inputs)
 
     elif self._op_type == ospec.OperatorType.JOB:
+      # each input is a run on the platform
+      if len(inputs) > 10:
+        raise RuntimeError(f"Too many maps: {len(inputs)}, current limit is 10")
+      inputs = [[x] for x in inputs]
       from nbox.lib.dist import RAW_DIST_RELIC_NAME
 
       # now this is simple enough, we need to implement a waiting queue that's it
@@ -1,9 +1,12 @@
+import time
+import asyncio
+import collections
 from uuid import uuid4
-import json
 
 from nbox import logger, lo, Project
 from nbox.utils import SimplerTimes
 from nbox.plugins.base import import_error
+from nbox.lmao_v4.aggregate import LatencyHistogram
 
 try:
   from fastapi import FastAPI, Response, Request
@@ -34,30 +37,140 @@ async def _decorator_middleware(request: Request, call_next):
   )
 
 class LmaoAsgiMiddleware(Middleware):
-  def __init__(self, app, tracker):
+  def __init__(
+    self,
+    app,
+    tracker,
+    summary_interval: float = 10.,
+    log_requests: bool = False,
+    batch_size: int = 256,
+    max_queue: int = 100_000,
+  ):
+    """Request telemetry that never waits on the tracker. The request only appends a tuple to a deque (atomic under
+    the GIL, no lock), a background task drains it every second and keeps p50/p95/p99 latency histograms per
+    route, one summary row per route is logged every `summary_interval` seconds.
+
+    Args:
+      app: the ASGI app
+      tracker: the live `Tracker`, `None` to only log at debug level
+      summary_interval (float): seconds between the summaries
+      log_requests (bool): also log every request (id, path, status, latency), in batches of `batch_size`
+      max_queue (int): max requests waiting for the background task, the oldest are dropped after this
+    """
     self.app = app
     self.tracker = tracker
+    self.summary_interval = summary_interval
+    self.log_requests = log_requests
+    self.batch_size = batch_size
 
-  # TODO: @yashbonde add a buffer uploading mechanism for the logs once gRPC is ready
+    self._records = collections.deque(maxlen = max_queue)
+    self._hists = {} # path -> (LatencyHistogram, errors)
+    self._task = None
+    self._stop = None
+    self._last_summary = time.monotonic()
 
   async def __call__(self, scope, receive, send):
+    if scope['type'] == 'lifespan':
+      # flush what is left when the server shuts down
+      async def _receive():
+        message = await receive()
+        if message["type"] == "lifespan.shutdown":
+          await self.aclose()
+        return message
+      await self.app(scope, _receive, send)
+      return
+
     _to_log = scope['type'] == 'http' and scope["path"] not in ["/", "/metadata"]
-    if _to_log:
-      trace_id = str(uuid4())
-      scope["nbx_trace_id"] = trace_id
-      st = SimplerTimes.get_now_ns()
-    await self.app(scope, receive, send)
-    if _to_log:
-      data = {
-        "id": trace_id,
-        "path": scope["path"],
-        "latency": SimplerTimes.get_now_ns() - st
-      }
-      logger.debug(lo("api_log:", data = data))
+    if not _to_log:
+      await self.app(scope, receive, send)
+      return
+
+    if self._task is None:
+      self._stop = asyncio.Event()
+      self._task = asyncio.get_running_loop().create_task(self._drain_forever())
+    trace_id = str(uuid4())
+    scope["nbx_trace_id"] = trace_id
+    st = SimplerTimes.get_now_ns()
+    status = [500]
+
+    async def _send(message):
+      if message["type"] == "http.response.start":
+        status[0] = message["status"]
+      await send(message)
+
+    try:
+      await self.app(scope, receive, _send)
+    finally:
+      self._records.append((trace_id, scope["path"], status[0], SimplerTimes.get_now_ns() - st))
+
+  async def _drain_forever(self):
+    loop = asyncio.get_running_loop()
+    while not self._stop.is_set():
+      try:
+        await asyncio.wait_for(self._stop.wait(), 1.)
+      except asyncio.TimeoutError:
+        pass
+      try:
+        await self._drain(loop)
+      except Exception as e:
+        logger.warning(f"Could not log the request telemetry: {e}")
+
+  async def _drain(self, loop, force: bool = False):
+    records = []
+    while self._records:
+      records.append(self._records.popleft())
+    for _, path, status, latency in records:
+      if path not in self._hists:
+        self._hists[path] = [LatencyHistogram(), 0]
+      h = self._hists[path]
+      h[0].add(latency)
+      h[1] += status >= 500
+
+    # the tracker calls serialize and write to the WAL, keep them off the event loop
+    if records and self.log_requests:
+      logger.debug(lo("api_log:", data = {"requests": len(records)}))
       if self.tracker:
-        self.tracker.log({
-          "data": json.dumps(data),
-        })
+        await loop.run_in_executor(None, self._log_requests, records)
+
+    if not force and time.monotonic() - self._last_summary < self.summary_interval:
+      return
+    self._last_summary = time.monotonic()
+    rows = [(path, h, errors) for path, (h, errors) in self._hists.items() if h.count]
+    if not rows:
+      return
+    summary = {
+      "path": [path for path, _, _ in rows],
+      "count": [h.count for _, h, _ in rows],
+      "errors": [errors for _, _, errors in rows],
+      "latency": {
+        "mean": [h.sum / h.count for _, h, _ in rows],
+        "p50": [h.quantile(0.5) for _, h, _ in rows],
+        "p95": [h.quantile(0.95) for _, h, _ in rows],
+        "p99": [h.quantile(0.99) for _, h, _ in rows],
+        "max": [h.max for _, h, _ in rows],
+      },
+    }
+    for h in self._hists.values():
+      h[0].reset()
+      h[1] = 0
+    logger.debug(lo("api_summary:", data = summary))
+    if self.tracker:
+      await loop.run_in_executor(None, self.tracker.log_many, summary)
+
+  def _log_requests(self, records):
+    for i in range(0, len(records), self.batch_size):
+      ids, paths, statuses, latencies = zip(*records[i:i + self.batch_size])
+      self.tracker.log_many({"id": list(ids), "path": list(paths), "status": list(statuses), "latency": list(latencies)})
+
+  async def aclose(self):
+    """log everything that is left, called on the lifespan shutdown"""
+    if self._task is not None:
+      self._stop.set()
+      await self._task # let the running drain finish
+      self._task = None
+    await self._drain(asyncio.get_running_loop(), force = True)
+    if self.tracker:
+      await asyncio.get_running_loop().run_in_executor(None, self.tracker.flush, 5.)
 
 
 def add_live_tracker(project: Project, app:FastAPI, metadata = {}) -> FastAPI:
@@ -2,6 +2,9 @@
 This file contains the code for all the compatibility with the [huggingface platform](https://huggingface.co/)
 """
 
+import re
+from typing import Any, Dict, Union
+
 from nbox import logger, lo, Project
 from nbox.utils import SimplerTimes
 from nbox.plugins.base import import_error
@@ -14,6 +17,36 @@ except ImportError:
   raise import_error("transformers")
 
 
+def _all_reduce_mean(logs: Dict[str, Any]) -> Dict[str, Any]:
+  """mean of the number values across all the ranks, a no-op if not running distributed. This is a collective so
+  every rank has to call it with the same keys."""
+  try:
+    import torch
+    import torch.distributed as dist
+  except ImportError:
+    return logs
+  if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+    return logs
+  keys = sorted(k for k, v in logs.items() if type(v) in (int, float))
+  if not keys:
+    return logs
+  device = torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else torch.device("cpu")
+  t = torch.tensor([float(logs[k]) for k in keys], dtype = torch.float64, device = device)
+  dist.all_reduce(t, op = dist.ReduceOp.SUM)
+  t /= dist.get_world_size()
+  return {**logs, **dict(zip(keys, t.tolist()))}
+
+
+_invalid_key = re.compile(r"[^a-zA-Z0-9_\-\.]")
+
+def _clean_logs(logs: Dict[str, Any]) -> Dict[str, Union[int, float, str]]:
+  # the tracker only takes numbers and strings and keys with letters digits and '_-.'
+  return {
+    _invalid_key.sub("_", k): v for k, v in logs.items()
+    if type(v) in (int, float, str)
+  }
+
+
 class NimbleBoxTrainerCallback(TrainerCallback):
   """
   This `TrainerCallback` talks to the [NimbleBox server](https://nimblebox.ai) to log training metrics and checkpoints.
@@ -21,116 +54,165 @@ class NimbleBoxTrainerCallback(TrainerCallback):
   This will automatically detect if you are running on NimbleBox pods and will automatically pick the appropriate
   values from the environment variables such as your project ID, Run ID, etc. If you are running this outside of the
   NimbleBox, you can read more in our [docs](https://nimblebox.ai/docs).
+
+  Only the main process (rank zero) talks to NimbleBox. Every event takes a `bool` or an `int`, an `int` N means
+  every N-th call of that event, eg. `on_step_end = 100` logs the throughput every 100 steps. The logs are only put
+  in the tracker's queue and sent from a background thread so the training step never waits on the network.
   """
 
   def __init__(
     self,
-    on_init_end: bool = True,
-    on_train_begin: bool = True,
-    on_train_end: bool = True,
-    on_epoch_begin: bool = False,
-    on_epoch_end: bool = False,
-    on_step_begin: bool = False,
-    on_substep_end: bool = False,
-    on_step_end: bool = False,
-    on_evaluate: bool = True,
-    on_predict: bool = False,
-    on_save: bool = True,
-    on_log: bool = True,
-    on_prediction_step: bool = False,
+    on_init_end: Union[bool, int] = True,
+    on_train_begin: Union[bool, int] = True,
+    on_train_end: Union[bool, int] = True,
+    on_epoch_begin: Union[bool, int] = False,
+    on_epoch_end: Union[bool, int] = False,
+    on_step_begin: Union[bool, int] = False,
+    on_substep_end: Union[bool, int] = False,
+    on_step_end: Union[bool, int] = False,
+    on_evaluate: Union[bool, int] = True,
+    on_predict: Union[bool, int] = False,
+    on_save: Union[bool, int] = True,
+    on_log: Union[bool, int] = True,
+    on_prediction_step: Union[bool, int] = False,
     *,
+    all_reduce: bool = False,
     debug: bool = False,
   ) -> None:
+    """
+    Args:
+      on_*: `True` for every call, `False` to skip or `N` for every N-th call of the event
+      all_reduce (bool): average the metrics in `on_log` across all the ranks before logging. The Trainer already
+        gathers the training loss, use this for the metrics that are only computed on the local rank
+      debug (bool): log every event at debug level
+    """
     self._initialized = False
     self.debug = debug
-    self._on_init_end = on_init_end
-    self._on_train_begin = on_train_begin
-    self._on_train_end = on_train_end
-    self._on_epoch_begin = on_epoch_begin
-    self._on_epoch_end = on_epoch_end
-    self._on_step_begin = on_step_begin
-    self._on_substep_end = on_substep_end
-    self._on_step_end = on_step_end
-    self._on_evaluate = on_evaluate
-    self._on_predict = on_predict
-    self._on_save = on_save
-    self._on_log = on_log
-    self._on_prediction_step = on_prediction_step
-
-  def setup(self, args, state, model, tokenizer, **kwargs):
-    if self._initialized:
+    self.all_reduce = all_reduce
+    self._every = {
+      "on_init_end": int(on_init_end),
+      "on_train_begin": int(on_train_begin),
+      "on_train_end": int(on_train_end),
+      "on_epoch_begin": int(on_epoch_begin),
+      "on_epoch_end": int(on_epoch_end),
+      "on_step_begin": int(on_step_begin),
+      "on_substep_end": int(on_substep_end),
+      "on_step_end": int(on_step_end),
+      "on_evaluate": int(on_evaluate),
+      "on_predict": int(on_predict),
+      "on_save": int(on_save),
+      "on_log": int(on_log),
+      "on_prediction_step": int(on_prediction_step),
+    }
+    self._calls = {k: 0 for k in self._every}
+    self._tracker = None
+    self._args = None # the `TrainingArguments` seen last, put in the tracker's metadata
+    self._last_step = (0, 0.) # (global_step, time) of the last `on_step_end` log
+
+  def _due(self, event: str) -> bool:
+    # counted on every rank so all the ranks agree on which calls are logged
+    every = self._every[event]
+    if not every:
+      return False
+    self._calls[event] += 1
+    return (self._calls[event] - 1) % every == 0
+
+  def _should(self, event: str, state: TrainerState, due: bool = None) -> bool:
+    if not (self._due(event) if due is None else due):
+      return False
+    if self.debug:
+      logger.debug(f"{event}: step {state.global_step}")
+    return state.is_world_process_zero
+
+  def _get_tracker(self, state: TrainerState, args: TrainingArguments = None):
+    # created on the first use on rank zero, so it does not depend on `on_init_end` being logged or even called
+    # eg. when the callback is added with `trainer.add_callback` after the Trainer is created
+    if self._tracker is None and state.is_world_process_zero:
+      metadata = {"hf_training_args": args.to_dict()} if args is not None else {}
+      self._tracker = Project().get_exp_tracker(metadata = metadata)
+      self._initialized = True
+    return self._tracker
+
+  def _log(self, logs: Dict[str, Any], state: TrainerState):
+    tracker = self._get_tracker(state, self._args)
+    if tracker is None:
       return
-    if state.is_world_process_zero:
-      self.p = Project()
+    logs = _clean_logs(logs)
+    logs.setdefault("step", state.global_step)
+    tracker.log(logs)
 
   def on_init_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
-    if not (state.is_world_process_zero or self._on_init_end):
+    self._args = args
+    if not self._should("on_init_end", state) or self._initialized:
       return
     logger.info("on_init_end: initialization of the Trainer is complete. Will load all the training arguments.")
-    metadata = {
-      "hf_training_args": args.to_dict()
-    }
-    self._tracker = self.p.get_exp_tracker(metadata = metadata)
+    self._get_tracker(state, args)
 
   def on_train_begin(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
-    if not (state.is_world_process_zero or self._on_train_begin):
+    self._args = args
+    self._last_step = (state.global_step, SimplerTimes.get_now_float())
+    if not self._should("on_train_begin", state):
       return
-    logger.debug("on_train_begin: training is about to begin.")
+    self._log({"max_steps": state.max_steps, "num_train_epochs": state.num_train_epochs}, state)
 
   def on_train_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
-    if not (state.is_world_process_zero or self._on_train_end):
+    if not self._should("on_train_end", state):
+      return
+    tracker = self._get_tracker(state, args)
+    if tracker is None:
       return
     logger.debug("on_train_end: training is complete.")
-    self._tracker.end()
+    tracker.end() # flushes everything that is queued
 
   def on_epoch_begin(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
-    if not (state.is_world_process_zero or self._on_epoch_begin):
-      return
-    logger.debug("on_epoch_begin: epoch is about to begin.")
+    self._should("on_epoch_begin", state)
 
   def on_epoch_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
-    if not (state.is_world_process_zero or self._on_epoch_end):
+    if not self._should("on_epoch_end", state):
       return
-    logger.debug("on_epoch_end: epoch is complete.")
+    self._log({"epoch": state.epoch}, state)
 
   def on_step_begin(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
-    if not (state.is_world_process_zero or self._on_step_begin):
-      return
-    logger.debug("on_step_begin: step is about to begin.")
+    self._should("on_step_begin", state)
 
   def on_substep_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
-    if not (state.is_world_process_zero or self._on_substep_end):
-      return
-    logger.debug("on_substep_end: substep is complete.")
+    self._should("on_substep_end", state)
 
   def on_step_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
-    if not (state.is_world_process_zero or self._on_step_end):
+    if not self._should("on_step_end", state):
       return
-    logger.debug("on_step_end: step is complete.")
+    now = SimplerTimes.get_now_float()
+    last_step, last_time = self._last_step
+    self._last_step = (state.global_step, now)
+    logs = {"epoch": state.epoch or 0.}
+    if state.global_step > last_step and now > last_time:
+      logs["steps_per_second"] = (state.global_step - last_step) / (now - last_time)
+    self._log(logs, state)
 
   def on_evaluate(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
-    if not (state.is_world_process_zero or self._on_evaluate):
-      return
-    logger.debug("on_evaluate: evaluation is complete.")
+    # the metrics come in `on_log` as well
+    self._should("on_evaluate", state)
 
   def on_predict(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, metrics, **kwargs):
-    if not (state.is_world_process_zero or self._on_predict):
+    if not self._should("on_predict", state) or not metrics:
       return
-    logger.debug("on_predict: prediction is complete.")
+    self._log(metrics, state)
 
   def on_save(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
-    if not (state.is_world_process_zero or self._on_save):
+    if not self._should("on_save", state):
       return
-    logger.debug("on_save: checkpoint is saved.")
+    self._log({"checkpoint_step": state.global_step}, state)
 
   def on_log(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, model=None, tokenizer=None, logs=None, **kwargs):
-    if not (state.is_world_process_zero or self._on_log):
+    if logs is None:
+      return
+    due = self._due("on_log")
+    if due and self.all_reduce:
+      # before the rank check, every rank has to be part of the all-reduce
+      logs = _all_reduce_mean(logs)
+    if not self._should("on_log", state, due):
       return
-    if logs is not None:
-      logger.debug("on_log: logging is complete.")
-      self._tracker.log(logs)
+    self._log(logs, state)
 
   def on_prediction_step(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
-    if not (state.is_world_process_zero or self._on_prediction_step):
-      return
-    logger.debug("on_prediction_step")
+    self._should("on_prediction_step", state)
@@ -1,4 +1,10 @@
 from nbox.relics.relics_rpc_client import RelicStore_Stub
 from nbox.relics.proto import relics_pb2, relics_rpc_pb2, common_pb2
 from nbox.relics.client import Relics, UserAgentType
-from nbox.relics.utils import get_relic_file, get_relics_stub, print_relics
\ No newline at end of file
+from nbox.relics.async_client import AsyncRelics
+from nbox.relics.transfer import TransferConfig, TransferEngine, ChecksumError
+from nbox.relics.cache import RelicsCache
+from nbox.relics.listing import RelicsIndex
+from nbox.relics.utils import get_relic_file, get_relics_stub, print_relics
+from nbox.relics.backend import RelicsBackend
+from nbox.relics.local import LocalRelicsBackend, LocalObjectServer
@@ -0,0 +1,172 @@
+"""
+asyncio counterpart of the `Relics` client, for services that drive hundreds of concurrent fetches from an event
+loop. It wraps a `Relics` object so the behaviour (prefix, cache, listings, retries, checksums) is exactly the same
+as the sync client.
+
+- Each file transfer, presign and listing is submitted on its own to the shared file pool of the `TransferEngine`
+  and awaited from the loop, so however many calls are running there are never more than `max_workers` transfer
+  threads (plus the part pool of the large files). The blocking HTTP calls themselves are the same `requests`
+  calls the sync client makes
+- `max_concurrency` caps the number of these units in flight, the rest wait on a semaphore without holding a thread
+- Folders are walked from the loop, one listing per sub-folder, instead of with a pool per call
+- `sync` drives its own transfers on the shared pool, the call itself runs on a small pool of `sync_workers`
+
+```python
+relic = AsyncRelics("my-relic")
+await asyncio.gather(*[relic.get_from(f"./data/{i}", f"data/{i}") for i in range(1000)])
+```
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import asyncio
+from functools import partial
+from typing import Any, Awaitable, Callable, Iterable, List
+from concurrent.futures import ThreadPoolExecutor
+
+from nbox.relics.client import Relics
+from nbox.relics.transfer import TransferConfig
+from nbox.relics.proto.relics_pb2 import RelicFile
+
+
+class AsyncRelics():
+  def __init__(
+    self,
+    relic_name: str = "",
+    id: str = "",
+    prefix: str = "",
+    *,
+    relics: Relics = None,
+    max_concurrency: int = 64,
+    sync_workers: int = 2,
+    **kwargs,
+  ):
+    """
+    Args:
+      relic_name (str): The name of the relic.
+      id (str): The id of the relic.
+      prefix (str): The prefix to use for all files in this relic.
+      relics (Relics): Wrap an existing client instead of creating a new one.
+      max_concurrency (int): Number of transfers, presigns and listings that can be in flight at the same time,
+        the threads are bounded by `max_workers` of the transfer config.
+      sync_workers (int): Number of `sync` calls that can run at the same time.
+      **kwargs: passed to `Relics`, by default the progress bars are turned off.
+    """
+    if max_concurrency < 1 or sync_workers < 1:
+      raise ValueError("max_concurrency and sync_workers must be >= 1")
+    if relics is None:
+      kwargs.setdefault("transfer_config", TransferConfig(progress = False))
+      relics = Relics(relic_name, id, prefix, **kwargs)
+    self.relics = relics
+    self.max_concurrency = max_concurrency
+    self.sync_workers = sync_workers
+    self._sync_pool = None
+    self._sem = None # created lazily so it binds to the running loop
+
+  def __repr__(self):
+    return f"Async{self.relics!r}"
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *_):
+    self.close()
+
+  def close(self):
+    # the file pool belongs to the `TransferEngine` and can be shared with the sync client
+    if self._sync_pool is not None:
+      self._sync_pool.shutdown(wait = False)
+
+  async def _call(self, fn: Callable, *args, **kwargs) -> Any:
+    # one unit of work on the shared file pool, `fn` must not wait on that pool itself
+    if self._sem is None:
+      self._sem = asyncio.Semaphore(self.max_concurrency)
+    async with self._sem:
+      return await asyncio.wrap_future(self.relics.transfer.submit(fn, *args, **kwargs))
+
+  async def _all(self, aws: Iterable[Awaitable]) -> List[Any]:
+    # like `TransferEngine.run`, the first error cancels everything that has not started
+    tasks = [asyncio.ensure_future(x) for x in aws]
+    try:
+      return await asyncio.gather(*tasks)
+    except BaseException:
+      for t in tasks:
+        t.cancel()
+      await asyncio.gather(*tasks, return_exceptions = True)
+      raise
+
+  async def _upload(self, items, on_done: Callable = None):
+    batch_size = self.relics._presign_batch_size()
+
+    def _put(lp, out):
+      self.relics._upload_presigned(lp, out)
+      if on_done is not None:
+        on_done(lp)
+
+    async def _batch(batch):
+      links = await self._call(self.relics._get_upload_links, [rf for _, rf in batch])
+      await self._all(self._call(_put, lp, out) for (lp, _), out in zip(batch, links))
+
+    await self._all(_batch(items[i : i + batch_size]) for i in range(0, len(items), batch_size))
+
+  async def _walk(self, prefix: str) -> List[RelicFile]:
+    index = self.relics.index
+    files = await self._call(index.list, prefix)
+    subs = [s for s in (index.sub_prefix(f, prefix) for f in files) if s is not None]
+    for sub_files in await self._all(self._walk(s) for s in subs):
+      files = files + sub_files
+    return files
+
+  async def put(self, local_path: str) -> None:
+    return await self._call(self.relics.put, local_path)
+
+  async def put_to(self, local_path: str, remote_path: str) -> None:
+    items, journal = await self._call(self.relics._put_to_items, local_path, remote_path)
+    await self._upload(items, on_done = journal.mark)
+    journal.remove()
+
+  async def get(self, local_path: str) -> None:
+    return await self._call(self.relics.get, local_path)
+
+  async def get_from(self, local_path: str, remote_path: str, unzip: bool = False) -> None:
+    if self.relics.relic is None:
+      raise ValueError("Relic does not exist, pass create=True")
+    file_ = await self._call(self.relics.index.stat, self.relics._full_path(remote_path))
+    if file_ is None:
+      raise ValueError(f"File {remote_path} does not exist in the relic")
+    files = []
+    if file_.type == RelicFile.RelicType.FOLDER:
+      files = await self._walk(self.relics._full_path(remote_path + "/"))
+    items = self.relics._get_from_items(local_path, remote_path, file_, files)
+    await self._all(self._call(self.relics._get_relic_file, *x) for x in items)
+
+  async def rm(self, remote_path: str) -> None:
+    return await self._call(self.relics.rm, remote_path)
+
+  async def has(self, path: str) -> bool:
+    # answered from the listings already in memory when possible, no thread hop
+    found, f = self.relics.index.lookup(self.relics._full_path(path))
+    if found:
+      return f is not None
+    return await self._call(self.relics.has, path)
+
+  async def ls(self, path: str = "", recurse: bool = False) -> List[RelicFile]:
+    if self.relics.relic is None:
+      raise ValueError("Relic does not exist, pass create=True")
+    p = self.relics._full_path(path)
+    if recurse:
+      return await self._walk(p)
+    return await self._call(self.relics.index.list, p)
+
+  async def sync(self, local_path: str, remote_path: str, **kwargs):
+    # `sync` waits on its transfers in the shared pool so it cannot run in there
+    if self._sync_pool is None:
+      self._sync_pool = ThreadPoolExecutor(max_workers = self.sync_workers, thread_name_prefix = "nbx-arelics-sync")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self._sync_pool, partial(self.relics.sync, local_path, remote_path, **kwargs))
+
+  async def put_object(self, key: str, py_object) -> None:
+    return await self._call(self.relics.put_object, key, py_object)
+
+  async def get_object(self, key: str):
+    return await self._call(self.relics.get_object, key)
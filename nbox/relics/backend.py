@@ -0,0 +1,54 @@
+"""
+The backend is everything `Relics` talks to for the metadata, i.e. creating relics, registering files, getting the
+presigned URLs and listing. The bytes themselves always move over plain HTTP to the presigned URLs. The hosted
+RelicStore (`RelicStore_Stub`) is the default backend, anything with the same methods can be passed as
+`Relics(backend = ...)`, eg. the `LocalRelicsBackend` in `nbox.relics.local` for offline use and benchmarking.
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+from nbox.relics.proto.common_pb2 import Acknowledge
+from nbox.relics.proto.relics_pb2 import Relic, RelicFile, RelicFiles
+from nbox.relics.proto.relics_rpc_pb2 import (
+  CreateRelicRequest,
+  ListRelicsRequest,
+  ListRelicsResponse,
+  ListRelicFilesRequest,
+  ListRelicFilesResponse,
+)
+
+
+class RelicsBackend:
+  """The interface `Relics` expects from a backend, these are the same methods (and messages) as the
+  `RelicStore_Stub`. A method returns `None` when the call fails, same as the stub."""
+
+  def create_relic(self, _CreateRelicRequest: CreateRelicRequest) -> Relic:
+    raise NotImplementedError()
+
+  def list_relics(self, _ListRelicsRequest: ListRelicsRequest) -> ListRelicsResponse:
+    raise NotImplementedError()
+
+  def delete_relic(self, _Relic: Relic) -> Acknowledge:
+    raise NotImplementedError()
+
+  def get_relic_details(self, _Relic: Relic) -> Relic:
+    """returns `None` if the relic does not exist"""
+    raise NotImplementedError()
+
+  def create_file(self, _RelicFile: RelicFile) -> RelicFile:
+    """register the file and return it with the presigned POST `url` and form fields in `body`"""
+    raise NotImplementedError()
+
+  # optional: create_multi_files(_RelicFiles: RelicFiles) -> RelicFiles, same as `create_file` for many files in
+  # one call and the files come back in the same order. `Relics` uses it for batching the uploads if it exists.
+  # `RelicStore_Stub` does not have it (there is no batch RPC on the hosted store), so there it is one call per file.
+
+  def list_relic_files(self, _ListRelicFilesRequest: ListRelicFilesRequest) -> ListRelicFilesResponse:
+    raise NotImplementedError()
+
+  def delete_multi_files(self, _RelicFiles: RelicFiles) -> Acknowledge:
+    raise NotImplementedError()
+
+  def download_file(self, _RelicFile: RelicFile) -> RelicFile:
+    """return the file with the presigned GET `url`, the `url` is empty if the file does not exist"""
+    raise NotImplementedError()
@@ -0,0 +1,234 @@
+"""
+Local read-through cache for Relics. Files are stored by the hash of what identifies a remote version of the
+object, i.e. the relic id, the path and the ETag of the object (read with a one byte GET before the download).
+So a new upload on the same path is a new key, even within the same second and with the same size, and stale
+entries simply age out.
+
+- The cache is off by default (`Relics(..., cache = True)` to turn it on), it keeps a second copy of everything
+  that is downloaded so it takes up to `max_size` (10 GiB by default) of extra disk
+- Multiple processes can share the folder, entries are written to a temp file and atomically renamed in place
+  and the total size is kept in a `.size` file that is updated under a file lock
+- Recency is tracked with the file mtime (touched on every hit) and the least recently used entries are evicted
+  once the total goes above `max_size`, only then the folder is walked
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import os
+import shutil
+import hashlib
+from uuid import uuid4
+from typing import List
+from contextlib import contextmanager
+
+try:
+  import fcntl
+except ImportError:
+  # windows, eviction becomes best effort
+  fcntl = None
+
+from nbox.utils import logger, env
+
+
+GiB = 1 << 30
+
+
+class _TeeReader:
+  def __init__(self, stream, f):
+    self.stream = stream
+    self.f = f
+
+  def readinto(self, b) -> int:
+    n = self.stream.readinto(b)
+    if n:
+      self.f.write(memoryview(b)[:n])
+    return n
+
+  def read(self, n: int = -1) -> bytes:
+    data = self.stream.read(n)
+    self.f.write(data)
+    return data
+
+
+class RelicsCache:
+  def __init__(self, folder: str = "", max_size: int = 0):
+    """
+    Args:
+      folder (str): where to keep the cached objects, defaults to `~/.nbx/.cache/relics`
+      max_size (int): size cap in bytes, defaults to `NBOX_RELICS_CACHE_SIZE` or 10 GiB
+    """
+    self.folder = folder or os.path.join(env.NBOX_HOME_DIR(), ".cache", "relics")
+    self.max_size = int(max_size or env.NBOX_RELICS_CACHE_SIZE(10 * GiB))
+    os.makedirs(self.folder, exist_ok = True)
+    self._lock_fp = os.path.join(self.folder, ".lock")
+    self._size_fp = os.path.join(self.folder, ".size")
+
+  def __repr__(self):
+    return f"RelicsCache({self.folder}, max_size={self.max_size})"
+
+  @staticmethod
+  def key(relic_id: str, path: str, etag: str) -> str:
+    """The cache key, returns empty string when there is no `etag` to trust a hit"""
+    if not etag:
+      return ""
+    return hashlib.sha256(f"{relic_id}:{path.strip('/')}:{etag}".encode("utf-8")).hexdigest()
+
+  def path(self, key: str) -> str:
+    return os.path.join(self.folder, key[:2], key)
+
+  def get(self, key: str) -> str:
+    """Return the filepath of the cached object or empty string on a miss"""
+    if not key:
+      return ""
+    fp = self.path(key)
+    try:
+      os.utime(fp) # mark as recently used
+    except FileNotFoundError:
+      return ""
+    return fp
+
+  def copy_to(self, key: str, local_path: str) -> bool:
+    """Copy the cached object to `local_path`, returns `False` on a miss (or if it was evicted meanwhile)"""
+    fp = self.get(key)
+    if not fp:
+      return False
+    try:
+      shutil.copyfile(fp, local_path)
+    except FileNotFoundError:
+      return False
+    logger.debug(f"Relics cache hit: {local_path}")
+    return True
+
+  def put(self, key: str, local_path: str):
+    """Store a copy of the file at `local_path` under `key`"""
+    if not key:
+      return
+    fp = self.path(key)
+    os.makedirs(os.path.dirname(fp), exist_ok = True)
+    tmp = f"{fp}.{uuid4().hex}.tmp"
+    try:
+      shutil.copyfile(local_path, tmp)
+      self._commit(tmp, fp)
+    finally:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+  def write(self, key: str, frames: List[memoryview]):
+    """Store the bytes in `frames` under `key`, this is how an upload writes through to the cache"""
+    if not key:
+      return
+    fp = self.path(key)
+    os.makedirs(os.path.dirname(fp), exist_ok = True)
+    tmp = f"{fp}.{uuid4().hex}.tmp"
+    try:
+      with open(tmp, "wb") as f:
+        for x in frames:
+          f.write(x)
+      self._commit(tmp, fp)
+    finally:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+  @contextmanager
+  def tee(self, key: str, stream):
+    """Wrap a file-like `stream` so that everything read from it is also written to the cache under `key`. The
+    entry is committed only if the block exits without an error."""
+    if not key:
+      yield stream
+      return
+    fp = self.path(key)
+    os.makedirs(os.path.dirname(fp), exist_ok = True)
+    tmp = f"{fp}.{uuid4().hex}.tmp"
+    f = open(tmp, "wb")
+    try:
+      yield _TeeReader(stream, f)
+      f.close()
+      self._commit(tmp, fp)
+    finally:
+      f.close()
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+  @contextmanager
+  def _lock(self):
+    if fcntl is None:
+      yield
+      return
+    with open(self._lock_fp, "a") as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+  def _read_size(self) -> int:
+    try:
+      with open(self._size_fp) as f:
+        return int(f.read())
+    except (FileNotFoundError, ValueError):
+      return -1
+
+  def _write_size(self, total: int):
+    tmp = f"{self._size_fp}.{uuid4().hex}.tmp"
+    with open(tmp, "w") as f:
+      f.write(str(total))
+    os.replace(tmp, self._size_fp)
+
+  def _commit(self, tmp: str, fp: str):
+    """Move the new entry in place and add it to the running total, evict if the total is over `max_size`"""
+    with self._lock():
+      new_size = os.path.getsize(tmp)
+      try:
+        old_size = os.path.getsize(fp)
+      except FileNotFoundError:
+        old_size = 0
+      os.replace(tmp, fp)
+      total = self._read_size()
+      if total < 0:
+        self._evict() # first use of the folder, this counts what is already there
+        return
+      total += new_size - old_size
+      if total > self.max_size:
+        self._evict()
+      else:
+        self._write_size(total)
+
+  def evict(self):
+    """Remove the least recently used entries till the cache is below `max_size`"""
+    with self._lock():
+      self._evict()
+
+  def _evict(self):
+    # walks the folder, only when there is no running total yet or it goes over the cap
+    entries = []
+    total = 0
+    for root, _, files in os.walk(self.folder):
+      for f in files:
+        if f.startswith(".") or f.endswith(".tmp"):
+          continue
+        fp = os.path.join(root, f)
+        try:
+          st = os.stat(fp)
+        except FileNotFoundError:
+          continue
+        entries.append((st.st_mtime, st.st_size, fp))
+        total += st.st_size
+    if total > self.max_size:
+      for _, size, fp in sorted(entries):
+        try:
+          os.remove(fp)
+        except FileNotFoundError:
+          pass
+        total -= size
+        logger.debug(f"Relics cache evicted: {fp}")
+        if total <= self.max_size:
+          break
+    self._write_size(total)
+
+  def clear(self):
+    with self._lock():
+      for x in os.listdir(self.folder):
+        fp = os.path.join(self.folder, x)
+        if os.path.isdir(fp):
+          shutil.rmtree(fp, ignore_errors = True)
+      self._write_size(0)
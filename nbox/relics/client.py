@@ -1,13 +1,16 @@
 import os
 import time
-import cloudpickle
-import requests
-from hashlib import md5
-from tqdm import trange
+import json
+import tempfile
+import threading
+from contextlib import nullcontext
+from typing import Any, Callable, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
 from subprocess import Popen
 from nbox.auth import secret
-from nbox.utils import logger, env, get_files_in_folder
+import nbox.utils as U
+from nbox.utils import logger, get_files_in_folder
 from nbox.relics.proto.relics_rpc_pb2 import (
   CreateRelicRequest,
   ListRelicFilesRequest,
@@ -18,8 +21,39 @@ from nbox.relics.proto.relics_pb2 import (
   RelicFiles,
   Relic as RelicProto,
   BucketMetadata,
+  Backend,
+  BackendInfo,
 )
 from nbox.relics.utils import print_relics, get_relics_stub, get_relic_file
+from nbox.relics.transfer import TransferConfig, TransferEngine, UploadJournal, MD5Reader, file_md5
+from nbox.relics.cache import RelicsCache
+from nbox.relics.listing import RelicsIndex
+from nbox.relics.backend import RelicsBackend
+from nbox.relics.sync import SyncDirection, ManifestEntry, MANIFEST_NAME, build_local_manifest, diff_manifests
+
+
+class _Prefetcher:
+  """Runs `fn(batch)` for the `batches` in order on a small pool, keeping at most `lookahead` batches ahead of
+  the highest one asked for. Presigned links expire so they are not fetched too far ahead of the transfers."""
+  def __init__(self, fn: Callable, batches: List[Any], lookahead: int = 2, max_workers: int = 2):
+    self.fn = fn
+    self.batches = batches
+    self.lookahead = lookahead
+    self._pool = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = "nbx-relics-presign")
+    self._futures = []
+    self._lock = threading.Lock()
+
+  def get(self, idx: int) -> Any:
+    with self._lock:
+      while len(self._futures) < min(len(self.batches), idx + 1 + self.lookahead):
+        self._futures.append(self._pool.submit(self.fn, self.batches[len(self._futures)]))
+      fut = self._futures[idx]
+    return fut.result()
+
+  def close(self):
+    for fut in self._futures:
+      fut.cancel()
+    self._pool.shutdown(wait = False)
 
 
 class UserAgentType:
@@ -44,16 +78,27 @@ class Relics():
     region: str = "",
     nbx_resource_id: str = "",
     nbx_integration_token: str = "",
+    transfer_config: TransferConfig = None,
+    cache: bool = False,
+    ls_ttl: float = 10.,
+    backend: RelicsBackend = None,
   ):
     """
-    The client for NBX-Relics. Auto switches to different user/agents for upload download
+    The client for NBX-Relics. Files are moved concurrently over pooled connections by the `TransferEngine`.
 
     Args:
       relic_name (str): The name of the relic.
       create (bool): Create the relic if it does not exist.
       prefix (str): The prefix to use for all files in this relic. If provided all the files are uploaded and downloaded with this prefix.
+      transfer_config (TransferConfig): Number of workers, part size and memory cap for the transfers.
+      cache (bool): Keep a local copy of the downloaded files and skip the download when the remote is unchanged.
+        Takes up to `NBOX_RELICS_CACHE_SIZE` (10 GiB by default) of extra disk, see `RelicsCache`.
+      ls_ttl (float): Seconds for which the listings are reused by `ls`, `has` and `get_from`, 0 to disable.
+      backend (RelicsBackend): Where the relic metadata lives, by default the hosted RelicStore. Pass a
+        `LocalRelicsBackend` to run offline.
     """
-    self.workspace_id = secret.workspace_id
+    # offline (NBOX_NO_AUTH) there is no secret, the local backend does not care about the workspace
+    self.workspace_id = secret.workspace_id if secret is not None else "local"
 
     if not relic_name and not id:
       raise ValueError("Either relic_name or id must be provided")
@@ -61,9 +106,9 @@ class Relics():
       raise ValueError("Only one of relic_name or id must be provided")
 
     self.relic_name = relic_name
-    self.username = secret.username # if its in the job then this part will automatically be filled
+    self.username = secret.username if secret is not None else "" # if its in the job then this part will automatically be filled
     self.prefix = prefix.strip("/")
-    self.stub = get_relics_stub()
+    self.stub = backend or get_relics_stub()
     rp = RelicProto(workspace_id=self.workspace_id)
     if id:
       rp.id = id
@@ -86,10 +131,13 @@ class Relics():
           bucket_meta = BucketMetadata(
             bucket_name = bucket_name,
             region = region,
-            backend = BucketMetadata.Backend.AWS_S3,
+            backend = Backend.AWS_S3,
+          ),
+          auth = BackendInfo(
+            backend = Backend.AWS_S3,
+            nbx_resource_id = nbx_resource_id,
+            nbx_access_key = nbx_integration_token,
           ),
-          nbx_resource_id = nbx_resource_id,
-          nbx_integration_token = nbx_integration_token,
         ))
         logger.debug(f"Created new relic {self.relic}")
       else:
@@ -99,6 +147,9 @@ class Relics():
 
     self.uat = UserAgentType.PYTHON_REQUESTS
     self.relic_name = self.relic.name
+    self.transfer = TransferEngine(transfer_config)
+    self.cache = RelicsCache() if cache else None
+    self.index = RelicsIndex(self._list_page, ttl = ls_ttl, max_workers = self.transfer.config.max_workers)
 
   def set_user_agent(self, user_agent_type: str):
     if user_agent_type not in UserAgentType.all():
@@ -111,12 +162,39 @@ class Relics():
       (f", prefix='{self.prefix}'" if self.prefix else "") + \
       ")"
 
-  def _upload_relic_file(self, local_path: str, relic_file: RelicFile):
+  def _full_path(self, path: str) -> str:
+    """path in the relic with the prefix, the trailing slash (if any) is kept because it means the folder"""
+    if path.startswith("./"):
+      path = path[2:]
+    path = path.lstrip("/")
+    return f"{self.prefix}/{path}" if self.prefix else path
+
+  def _relative_name(self, name: str) -> str:
+    """name from a listing without the prefix, the inverse of `_full_path`"""
+    name = name.lstrip("/")
+    if self.prefix and name.startswith(self.prefix + "/"):
+      name = name[len(self.prefix) + 1:]
+    return name
+
+  def _list_page(self, prefix: str, page_no: int = 0) -> ListRelicFilesResponse:
+    for _ in range(2):
+      out = self.stub.list_relic_files(ListRelicFilesRequest(
+        workspace_id = self.workspace_id,
+        relic_id = self.relic.id,
+        prefix = prefix,
+        page_no = page_no,
+      ))
+      if out != None:
+        break
+      time.sleep(1)
+    if out is None:
+      raise Exception(f"Could not list files at '{prefix}'")
+    return out
+
+  def _get_upload_link(self, relic_file: RelicFile) -> RelicFile:
+    """register the file in the relic and get the presigned POST for it"""
     if self.prefix:
       relic_file.name = f"{self.prefix}/{relic_file.name}"
-
-    # ideally this is a lot like what happens in nbox
-    logger.debug(f"Uploading {local_path} to {relic_file.name}")
     for _ in range(2):
       out = self.stub.create_file(_RelicFile = relic_file,)
       if out != None:
@@ -125,92 +203,150 @@ class Relics():
 
     if not out.url:
       raise Exception("Could not get link")
+    self.index.invalidate(relic_file.name)
+    return out
 
+  def _get_upload_links(self, relic_files: List[RelicFile]) -> List[RelicFile]:
+    """presign a batch of files in a single call if the backend has `create_multi_files`, the hosted store
+    does not so there each file is its own batch"""
+    create_multi_files = getattr(self.stub, "create_multi_files", None)
+    if create_multi_files is None:
+      return [self._get_upload_link(rf) for rf in relic_files]
+    rf = RelicFiles(workspace_id = self.workspace_id)
+    for relic_file in relic_files:
+      if self.prefix:
+        relic_file.name = f"{self.prefix}/{relic_file.name}"
+      rf.files.append(relic_file)
+    for _ in range(2):
+      out = create_multi_files(rf)
+      if out != None:
+        break
+      time.sleep(1)
+    if out is None or len(out.files) != len(relic_files) or not all(f.url for f in out.files):
+      raise Exception("Could not get links")
+    for relic_file in relic_files:
+      self.index.invalidate(relic_file.name)
+    return list(out.files)
+
+  def _get_download_link(self, relic_file: RelicFile) -> RelicFile:
+    """get the presigned GET for a file in the relic"""
+    if self.relic is None:
+      raise ValueError("Relic does not exist, pass create=True")
+    if self.prefix:
+      relic_file.name = self.prefix + "/" + relic_file.name
+    for _ in range(2):
+      out = self.stub.download_file(_RelicFile = relic_file,)
+      if out != None:
+        break
+      time.sleep(1)
+
+    if not out.url:
+      raise Exception("Could not get link, are you sure this file exists?")
+    return out
+
+  def _upload_relic_file(self, local_path: str, relic_file: RelicFile):
+    # ideally this is a lot like what happens in nbox
+    logger.debug(f"Uploading {local_path} to {relic_file.name}")
+    out = self._get_upload_link(relic_file)
+    self._upload_presigned(local_path, out)
+
+  def _upload_presigned(self, local_path: str, out: RelicFile):
     # do merge 'out' and 'relic_file' here because "url" might get stored in MongoDB
     # relic_file.MergeFrom(out)
-    ten_mb = 10 ** 7
-    uat = self.uat
-    old_uat = uat
-    if out.size > ten_mb:
-      logger.debug(f"File {local_path} is larger than 10 MiB ({out.size} bytes)")
-      logger.debug(f"Switching to user/agent: cURL for this upload")
-      uat = UserAgentType.CURL
-
-    if uat == UserAgentType.PYTHON_REQUESTS:
+    if self.uat == UserAgentType.PYTHON_REQUESTS:
       logger.debug(f"URL: {out.url}")
       logger.debug(f"body: {out.body}")
-      r = requests.post(
-        url = out.url,
-        data = out.body,
-        files = {"file": (out.body["key"], open(local_path, "rb"))}
-      )
+      r = self.transfer.upload_file(local_path, out.url, dict(out.body))
       logger.debug(f"Upload status: {r.status_code}")
-      r.raise_for_status()
-    elif uat == UserAgentType.CURL:
+    elif self.uat == UserAgentType.CURL:
       # TIL: https://stackoverflow.com/a/58237351
       # the fields in the post can be sent in any order
 
       import shlex
-      shell_com = f'curl -X POST -F key={out.body["key"]} '
+      shell_com = f'curl -f -X POST -F key={out.body["key"]} '
       for k,v in out.body.items():
         if k == "key":
           continue
         shell_com += f'-F {k}={v} '
       shell_com += f'-F file="@{local_path}" {out.url}'
       logger.debug(f"Running shell command: {shell_com}")
-      Popen(shlex.split(shell_com)).wait()
-
-    if old_uat != uat:
-      logger.debug(f"Restoring user/agent to {old_uat}")
-      self.set_user_agent(old_uat)
-
-  def _download_relic_file(self, local_path: str, relic_file: RelicFile):
-    if self.relic is None:
-      raise ValueError("Relic does not exist, pass create=True")
-    if self.prefix:
-      relic_file.name = self.prefix + "/" + relic_file.name
+      code = Popen(shlex.split(shell_com)).wait()
+      if code != 0:
+        raise Exception(f"curl failed with exit code {code} when uploading {local_path}")
+
+  def _presign_batch_size(self) -> int:
+    return self.transfer.config.presign_batch_size if hasattr(self.stub, "create_multi_files") else 1
+
+  def _upload_relic_files(self, items: List[Tuple[str, RelicFile]], desc: str = "", on_done: Callable = None):
+    """Upload many `(local_path, relic_file)`, the presigned links are fetched a few batches ahead of the
+    transfers. Batches of more than one file need `create_multi_files` on the backend, the hosted store does
+    not have it so there this is one presign per file, running concurrently like `put_to` always did.
+    `on_done(local_path)` is called after each file is uploaded."""
+    config = self.transfer.config
+    batch_size = self._presign_batch_size()
+    batches = [items[i : i + batch_size] for i in range(0, len(items), batch_size)]
+    links = _Prefetcher(
+      lambda b: self._get_upload_links([rf for _, rf in b]),
+      batches,
+      lookahead = max(2, config.max_workers // batch_size + 1),
+      max_workers = 2 if batch_size > 1 else config.max_workers,
+    )
+
+    def _upload(b, j):
+      lp = batches[b][j][0]
+      self._upload_presigned(lp, links.get(b)[j])
+      if on_done is not None:
+        on_done(lp)
+
+    try:
+      self.transfer.run(
+        _upload,
+        [(b, j) for b in range(len(batches)) for j in range(len(batches[b]))],
+        sizes = [rf.size for _, rf in items],
+        desc = desc,
+      )
+    finally:
+      links.close()
 
+  def _download_relic_file(self, local_path: str, relic_file: RelicFile, out: RelicFile = None, etag: str = ""):
     # ideally this is a lot like what happens in nbox
     logger.debug(f"Downloading {local_path} from S3 ...")
-    for _ in range(2):
-      out = self.stub.download_file(_RelicFile = relic_file,)
-      if out != None:
-        break
-      time.sleep(1)
-
-    if not out.url:
-      raise Exception("Could not get link, are you sure this file exists?")
-
-    # same logic as in upload but for download
-    ten_mb = 10 ** 7
-    uat = self.uat
-    if out.size > ten_mb:
-      logger.warning(f"File {local_path} is larger than 10 MiB ({out.size} bytes), this might take a while")
-      logger.warning(f"Switching to user/agent: cURL for this download")
-      uat = UserAgentType.CURL
+    if out is None:
+      out = self._get_download_link(relic_file)
 
-    if uat == UserAgentType.PYTHON_REQUESTS:
+    if self.uat == UserAgentType.PYTHON_REQUESTS:
       # do not perform merge here because "url" might get stored in MongoDB
       # relic_file.MergeFrom(out)
       logger.debug(f"URL: {out.url}")
-      with requests.get(out.url, stream=True) as r:
-        r.raise_for_status()
-        total_size = 0
-        with open(local_path, 'wb') as f:
-          for chunk in r.iter_content(chunk_size=8192):
-            # If you have chunk encoded response uncomment if
-            # and set chunk_size parameter to None.
-            #if chunk:
-            f.write(chunk)
-            total_size += len(chunk)
-    elif uat == UserAgentType.CURL:
+      total_size = self.transfer.download_file(out.url, local_path, out.size, etag)
+    elif self.uat == UserAgentType.CURL:
       import shlex
-      shell_com = f'curl -o {local_path} {out.url}'
+      # -C - continues from where a previous broken download left off
+      shell_com = f'curl -f -C - -o {local_path} {out.url}'
       logger.debug(f"Running shell command: {shell_com}")
-      Popen(shlex.split(shell_com)).wait()
+      code = Popen(shlex.split(shell_com)).wait()
+      if code != 0:
+        raise Exception(f"curl failed with exit code {code} when downloading {local_path}")
       total_size = os.path.getsize(local_path)
+      if out.size and total_size != out.size:
+        raise Exception(f"Size mismatch for {local_path}: got {total_size}, expected {out.size}")
     logger.debug(f"Download '{local_path}' status: OK ({total_size//1000} KiB)")
 
+  def _get_relic_file(self, local_path: str, relic_file: RelicFile, remote: RelicFile):
+    """Read-through the local cache, the ETag of the object tells if the cached copy is still the latest one.
+    `remote` is the listing entry."""
+    if self.cache is None:
+      return self._download_relic_file(local_path, relic_file)
+    out = self._get_download_link(relic_file)
+    etag = self.transfer.etag(out.url)
+    key = self.cache.key(self.relic.id, remote.name, etag)
+    if self.cache.copy_to(key, local_path):
+      return
+    # pinned to the ETag, a newer upload in between fails the download instead of being cached under the old key
+    self._download_relic_file(local_path, relic_file, out, etag)
+    if key:
+      self.cache.put(key, local_path)
+
   """
   At it's core the Relic is supposed to be a file system and not a client. Thus you cannot download something
   from a relic, but rather you tell the path you want to read and it will return the file. This is because of the
@@ -231,6 +367,14 @@ class Relics():
     self._upload_relic_file(local_path, relic_file)
 
   def put_to(self, local_path: str, remote_path: str) -> None:
+    """Put the file or the entire folder at `local_path` to `remote_path` in the relic. Files are uploaded
+    concurrently, the number of workers and memory are controlled by `transfer_config`."""
+    items, journal = self._put_to_items(local_path, remote_path)
+    self._upload_relic_files(items, desc = f"{local_path} => {remote_path}", on_done = journal.mark)
+    journal.remove()
+
+  def _put_to_items(self, local_path: str, remote_path: str) -> Tuple[List[Tuple[str, RelicFile]], UploadJournal]:
+    """the `(local_path, relic_file)` that `put_to` still has to upload and the journal to mark them in"""
     if self.relic is None:
       raise ValueError("Relic does not exist, pass create=True")
     logger.debug(f"Putting '{local_path}' to '{remote_path}'")
@@ -243,14 +387,19 @@ class Relics():
     all_f = list(all_f.items())
     logger.info(f"Found {len(all_f)} files, starting upload ...")
 
-    pbar = trange(len(all_f))
-    for i in pbar:
-      lp, rp = all_f[i]
+    # the journal lets a failed put_to be called again without uploading the files that already made it
+    journal = UploadJournal(self.relic.id, local_path, remote_path)
+    items = []
+    for lp, rp in all_f:
+      if journal.is_done(lp):
+        continue
       relic_file = get_relic_file(lp, self.username, self.workspace_id)
       relic_file.relic_name = self.relic_name
       relic_file.name = rp # override the name
-      pbar.set_description(f"{lp} => {rp}, ({relic_file.size//1000} KiB)")
-      self._upload_relic_file(lp, relic_file)
+      items.append((lp, relic_file))
+    if len(items) != len(all_f):
+      logger.info(f"Resuming upload, {len(all_f) - len(items)} files were already uploaded")
+    return items, journal
 
   def get(self, local_path: str):
     """Get the file at this path from the relic"""
@@ -263,6 +412,8 @@ class Relics():
     self._download_relic_file(local_path, relic_file)
 
   def get_from(self, local_path: str, remote_path: str, unzip: bool = False) -> None:
+    """Get the file or the entire folder at `remote_path` in the relic to `local_path`. Files are downloaded
+    concurrently and large files are fetched as parallel byte ranges."""
     if unzip:
       logger.warning("Unzipping is inefficient, use Popen or CLI instead")
 
@@ -270,33 +421,46 @@ class Relics():
       raise ValueError("Relic does not exist, pass create=True")
     logger.debug(f"Getting '{local_path}' from '{remote_path}'")
 
-    file_ = list(filter(
-      lambda x: x.name == remote_path, self.ls(remote_path)
-    ))
-    if not file_:
+    file_ = self.index.stat(self._full_path(remote_path))
+    if file_ is None:
       raise ValueError(f"File {remote_path} does not exist in the relic")
-    file_ = file_[0]
+    files = []
     if file_.type == RelicFile.RelicType.FOLDER:
       files = self.ls(remote_path + "/", recurse=True)
+    items = self._get_from_items(local_path, remote_path, file_, files)
+    self.transfer.run(
+      self._get_relic_file,
+      items,
+      sizes = [x[2].size for x in items],
+      desc = f"{remote_path} => {local_path}",
+    )
+
+  def _get_from_items(self, local_path: str, remote_path: str, file_: RelicFile, files: List[RelicFile]):
+    """the `(local_path, relic_file, listed_file)` that `get_from` downloads, `files` is the recursive listing
+    when `file_` is a folder"""
+    if file_.type == RelicFile.RelicType.FOLDER:
       if not os.path.exists(local_path):
         os.makedirs(local_path)
       all_files = []
       for fx in files:
-        lp = os.path.join(local_path, fx.name)
+        lp = os.path.join(local_path, self._relative_name(fx.name))
         all_files.append((lp.replace(remote_path+"/", ""), fx))
     else:
       all_files = [(local_path, file_)]
 
+    items = []
     for (lp, fx) in all_files:
       if fx.type == RelicFile.RelicType.FOLDER:
         continue
       relic_file = RelicFile(
-        name = fx.name.strip("./"),
+        name = self._relative_name(fx.name), # the prefix is added back when getting the link
         relic_name = self.relic_name,
         workspace_id = self.workspace_id
       )
-      os.makedirs(os.path.dirname(relic_file.name), exist_ok=True)
-      self._download_relic_file(lp, relic_file)
+      if os.path.dirname(lp):
+        os.makedirs(os.path.dirname(lp), exist_ok=True)
+      items.append((lp, relic_file, fx))
+    return items
 
   def rm(self, remote_path: str):
     """Delete the file at this path from the relic"""
@@ -315,30 +479,124 @@ class Relics():
         break
       time.sleep(1)
 
+    self.index.invalidate(relic_file.name)
     if not out.success:
       logger.error(out.message)
       raise ValueError("Could not delete file")
 
   def has(self, path: str) -> bool:
-    prefix, file_name = os.path.split(path)
-    for _ in range(2):
-      out = self.stub.list_relic_files(
-        ListRelicFilesRequest(
-          workspace_id=self.workspace_id,
-          relic_name=self.relic_name,
-          prefix=prefix,
-          file_name=file_name
-        )
-      )
-      if out != None:
-        break
-      time.sleep(1)
+    """Check if the file exists in the relic, this is answered from the listings already made by this client
+    and only lists the parent folder when it has not been listed in the last `ls_ttl` seconds"""
+    if self.relic is None:
+      raise ValueError("Relic does not exist, pass create=True")
+    return self.index.stat(self._full_path(path)) is not None
 
-    for f in out.files:
-      if f.name.strip("/") == path.strip("/"):
-        return True
-    return False
+  def sync(self, local_path: str, remote_path: str, direction: str = SyncDirection.UP, delete: bool = False, dry_run: bool = False):
+    """Sync a local folder with a folder in the relic, transferring only the files that have changed.
 
+    Args:
+      local_path (str): the local folder
+      remote_path (str): the folder in the relic
+      direction (str): "up" to mirror local to the relic, "down" to mirror the relic to local
+      delete (bool): remove the files on the destination that are not there on the source
+      dry_run (bool): only return what would be done
+
+    Returns:
+      Dict[str, List[str]]: relative paths that were `transferred` and `deleted`
+    """
+    if self.relic is None:
+      raise ValueError("Relic does not exist, pass create=True")
+    if direction not in SyncDirection.all():
+      raise ValueError(f"Invalid direction: {direction}, must be one of {SyncDirection.all()}")
+    remote_path = remote_path.strip("/")
+    logger.info(f"Syncing '{local_path}' {'=>' if direction == SyncDirection.UP else '<='} '{remote_path}'")
+
+    # remote manifest from the listing, merged with the MD5s from the manifest file if there is one
+    listing = {}
+    for f in self.ls(remote_path + "/", recurse = True):
+      if f.type == RelicFile.RelicType.FOLDER:
+        continue
+      name = f.name.strip("/")
+      if self.prefix and name.startswith(self.prefix + "/"):
+        name = name[len(self.prefix) + 1:]
+      if remote_path and name.startswith(remote_path + "/"):
+        name = name[len(remote_path) + 1:]
+      listing[name] = f
+    stored = {}
+    if MANIFEST_NAME in listing:
+      with tempfile.TemporaryDirectory() as td:
+        fp = os.path.join(td, MANIFEST_NAME)
+        self._get_relic_file(fp, RelicFile(
+          name = f"{remote_path}/{MANIFEST_NAME}".strip("/"),
+          relic_name = self.relic_name,
+          workspace_id = self.workspace_id,
+        ), listing.pop(MANIFEST_NAME))
+        with open(fp, "r") as f:
+          stored = {k: ManifestEntry.from_dict(v) for k, v in json.load(f).items()}
+    remote = {}
+    for name, f in listing.items():
+      entry = stored.get(name)
+      if entry is not None and entry.size == f.size:
+        remote[name] = ManifestEntry(f.size, entry.mtime, entry.md5)
+      else:
+        remote[name] = ManifestEntry(f.size, f.last_modified)
+
+    local = build_local_manifest(local_path)
+    to_transfer, to_delete = diff_manifests(local_path, local, remote, direction)
+    if not delete:
+      to_delete = []
+    logger.info(f"{len(to_transfer)} files to transfer, {len(to_delete)} to delete, " \
+      f"{len(local if direction == SyncDirection.UP else remote) - len(to_transfer)} unchanged")
+    if dry_run:
+      return {"transferred": to_transfer, "deleted": to_delete}
+
+    if direction == SyncDirection.UP:
+      items = []
+      for rel in to_transfer:
+        lp = os.path.join(local_path, rel)
+        relic_file = get_relic_file(lp, self.username, self.workspace_id)
+        relic_file.relic_name = self.relic_name
+        relic_file.name = f"{remote_path}/{rel}".strip("/")
+        items.append((lp, relic_file))
+      self._upload_relic_files(items, desc = "sync up")
+      for rel in to_delete:
+        self.rm(f"{remote_path}/{rel}".strip("/"))
+
+      # update the manifest, files that were skipped keep what was there
+      for rel in to_transfer:
+        local[rel].md5 = local[rel].md5 or file_md5(os.path.join(local_path, rel))
+      manifest = {}
+      for rel, entry in local.items():
+        if rel not in to_transfer and not entry.md5 and rel in stored:
+          entry = stored[rel]
+        manifest[rel] = entry.to_dict()
+      with tempfile.TemporaryDirectory() as td:
+        fp = os.path.join(td, MANIFEST_NAME)
+        with open(fp, "w") as f:
+          json.dump(manifest, f)
+        self.put_to(fp, f"{remote_path}/{MANIFEST_NAME}".strip("/"))
+    else:
+      items = []
+      for rel in to_transfer:
+        lp = os.path.join(local_path, rel)
+        if os.path.dirname(lp):
+          os.makedirs(os.path.dirname(lp), exist_ok = True)
+        relic_file = RelicFile(
+          name = f"{remote_path}/{rel}".strip("/"),
+          relic_name = self.relic_name,
+          workspace_id = self.workspace_id,
+        )
+        items.append((lp, relic_file, listing[rel]))
+      self.transfer.run(self._get_relic_file, items, sizes = [x[2].size for x in items], desc = "sync down")
+      # set the local mtime to the remote one so that the next sync passes the quick check
+      for rel in to_transfer:
+        mtime = remote[rel].mtime
+        if mtime:
+          os.utime(os.path.join(local_path, rel), (mtime, mtime))
+      for rel in to_delete:
+        os.remove(os.path.join(local_path, rel))
+
+    return {"transferred": to_transfer, "deleted": to_delete}
 
   """
   There are other convinience methods provided to keep consistency between the different types of relics. Note
@@ -347,26 +605,57 @@ class Relics():
   """
 
   def put_object(self, key: str, py_object):
-    """wrapper function for putting a python object"""
-    # we will cache the object in the local file system
-    cache_dir = os.path.join(env.NBOX_HOME_DIR(), ".cache")
-    if not os.path.exists(cache_dir):
-      os.makedirs(cache_dir)
-    _key = os.path.join(cache_dir, md5(key.encode()).hexdigest())
-    with open(_key, "wb") as f:
-      cloudpickle.dump(py_object, f)
-    self.put_to(_key, key)
+    """wrapper function for putting a python object, it is pickled (protocol 5) straight into the upload body
+    and large buffers like numpy arrays are sent without any copies."""
+    if self.relic is None:
+      raise ValueError("Relic does not exist, pass create=True")
+    frames = U.py_to_frames(py_object)
+    now = U.SimplerTimes.get_now_i64()
+    relic_file = get_relic_file(key, self.username, self.workspace_id)
+    relic_file.relic_name = self.relic_name
+    relic_file.size = max(1, U.frames_size(frames))
+    relic_file.created_on = now
+    relic_file.last_modified = now
+    relic_file.content_type = "application/octet-stream"
+    logger.debug(f"Putting object: {key} ({relic_file.size} bytes)")
+    out = self._get_upload_link(relic_file)
+    r = self.transfer.upload_frames(frames, out.url, dict(out.body), name = key)
+    if self.cache is not None:
+      # the new version goes in the cache right away, a get_object after this does not download it again
+      etag = r.headers.get("ETag", "").strip('"')
+      self.cache.write(self.cache.key(self.relic.id, relic_file.name, etag), frames)
 
   def get_object(self, key: str):
-    """wrapper function for getting a python object"""
-    cache_dir = os.path.join(env.NBOX_HOME_DIR(), ".cache")
-    if not os.path.exists(cache_dir):
-      os.makedirs(cache_dir)
-    _key = os.path.join(cache_dir, md5(key.encode()).hexdigest())
-    self.get_from(_key, key)
-    with open(_key, "rb") as f:
-      out = cloudpickle.load(f)
-    return out
+    """wrapper function for getting a python object, it is unpickled straight from the download stream. If the
+    object is in the local cache it is loaded from there."""
+    if self.relic is None:
+      raise ValueError("Relic does not exist, pass create=True")
+    name = key.strip("./")
+    remote = self.index.stat(self._full_path(name))
+    if remote is None:
+      raise ValueError(f"File {key} does not exist in the relic")
+
+    relic_file = RelicFile(name = name, relic_name = self.relic_name, workspace_id = self.workspace_id)
+    out = self._get_download_link(relic_file)
+    cache_key = etag = ""
+    if self.cache is not None:
+      etag = self.transfer.etag(out.url)
+      cache_key = self.cache.key(self.relic.id, remote.name, etag)
+      fp = self.cache.get(cache_key)
+      if fp:
+        logger.debug(f"Relics cache hit: {key}")
+        with open(fp, "rb") as f:
+          return U.py_from_stream(f)
+
+    with self.transfer.open_stream(out.url, etag) as r:
+      reader = MD5Reader(r.raw)
+      # the bytes are written to the cache as they are read, never read back from the disk
+      with self.cache.tee(cache_key, reader) if self.cache is not None else nullcontext(reader) as stream:
+        obj = U.py_from_stream(stream)
+        stream.read() # anything after the object still counts for the checksum
+        # checked before the block exits so a corrupt object is never committed to the cache
+        self.transfer.verify_md5(r.headers, reader.md5.hexdigest(), key)
+    return obj
 
   """
   Some APIs are more on the level of the relic itself.
@@ -378,34 +667,19 @@ class Relics():
       raise ValueError("Relic does not exist, nothing to delete")
     logger.warning(f"Deleting relic {self.relic_name}")
     self.stub.delete_relic(self.relic)
+    self.index.clear()
 
   def ls(self, path: str = "", recurse: bool = False):
-    """Iterate over all the files at the path"""
+    """Iterate over all the files at the path, with `recurse` the sub-folders are listed concurrently. Listings
+    are reused for `ls_ttl` seconds."""
     if self.relic is None:
       raise ValueError("Relic does not exist, pass create=True")
     logger.debug(f"Listing files in relic {self.relic_name}:{self.prefix}:{path}")
-    for _ in range(2):
-      p = self.prefix
-      if path:
-        p += "/" + path
-      out = self.stub.list_relic_files(ListRelicFilesRequest(
-        workspace_id = self.workspace_id,
-        relic_id = self.relic.id,
-        prefix = p
-      ))
-      if out != None:
-        break
-      time.sleep(1)
-
-    for f in out.files:
-      yield f
-
+    p = self._full_path(path)
     if recurse:
-      for f in out.files:
-        if f.name == path:
-          continue
-        if f.type == RelicFile.RelicType.FOLDER:
-          yield from self.ls(f.name + "/", recurse=recurse)
+      yield from self.index.walk(p)
+    else:
+      yield from self.index.list(p)
 
   def list_files(self, path: str = "", recurse: bool = False) -> ListRelicFilesResponse:
     return self.ls(path, recurse)
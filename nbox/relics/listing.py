@@ -0,0 +1,183 @@
+"""
+Listing engine for Relics. All the listings go through a `RelicsIndex` which keeps the results in a short lived
+in-memory prefix tree, so `ls`, `has` and `get_from` share the same listings instead of each going to the server.
+
+- Folders in a recursive listing are listed concurrently, and when the server pages a listing the rest of the
+  pages are fetched concurrently once the first one tells the total
+- Every node in the tree remembers when its children were last listed, so `has` is a walk down the tree and only
+  goes to the server when the parent folder was never listed or the listing is older than `ttl` seconds
+- Writes from this client (`put*`, `rm`, `sync`) invalidate the affected paths, writes from somewhere else are
+  seen after at most `ttl` seconds
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import time
+import threading
+from typing import Callable, Dict, List
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from nbox.utils import logger
+from nbox.relics.proto.relics_pb2 import RelicFile
+from nbox.relics.proto.relics_rpc_pb2 import ListRelicFilesResponse
+
+
+def _norm(path: str) -> str:
+  return path.strip("/")
+
+
+class _Node:
+  __slots__ = ["children", "file", "seen_at", "listed_at"]
+
+  def __init__(self):
+    self.children: Dict[str, "_Node"] = {}
+    self.file: RelicFile = None
+    self.seen_at = 0.   # when this file came in a listing
+    self.listed_at = 0. # when all the children of this node were listed, 0 if never
+
+
+class RelicsIndex:
+  def __init__(self, list_page: Callable, ttl: float = 10., max_workers: int = 8):
+    """
+    Args:
+      list_page (Callable): `list_page(prefix, page_no) -> ListRelicFilesResponse`, does the actual RPC
+      ttl (float): seconds for which a listing is reused, 0 disables the caching
+      max_workers (int): number of listings that run concurrently
+    """
+    self.list_page = list_page
+    self.ttl = ttl
+    self.max_workers = max_workers
+    self._lock = threading.Lock()
+    self._root = _Node()
+    self._listings: Dict[str, tuple] = {} # prefix -> (time, files)
+
+  def __repr__(self):
+    return f"RelicsIndex(ttl={self.ttl}, listings={len(self._listings)})"
+
+  def _fresh(self, t: float) -> bool:
+    return self.ttl > 0 and t > 0 and time.monotonic() - t < self.ttl
+
+  # the tree
+
+  def _insert(self, prefix: str, files: List[RelicFile], now: float):
+    with self._lock:
+      for f in files:
+        node = self._root
+        for part in _norm(f.name).split("/"):
+          node = node.children.setdefault(part, _Node())
+        node.file = f
+        node.seen_at = now
+      # only a listing of the full folder tells that there are no other children
+      if prefix == "" or prefix.endswith("/"):
+        node = self._root
+        for part in filter(None, _norm(prefix).split("/")):
+          node = node.children.setdefault(part, _Node())
+        node.listed_at = now
+      self._listings[prefix] = (now, files)
+
+  def lookup(self, path: str):
+    """Returns `(found, file)`, `found` is `False` when the tree cannot answer without going to the server"""
+    with self._lock:
+      node = self._root
+      for part in _norm(path).split("/"):
+        child = node.children.get(part)
+        if child is None:
+          return self._fresh(node.listed_at), None
+        node = child
+      if node.file is not None and self._fresh(node.seen_at):
+        return True, node.file
+      return False, None
+
+  def invalidate(self, path: str = ""):
+    """Forget everything known about the `path`, its parents and its children"""
+    path = _norm(path)
+    with self._lock:
+      if not path:
+        self._root = _Node()
+        self._listings.clear()
+        return
+      node = self._root
+      parts = path.split("/")
+      for part in parts[:-1]:
+        node.listed_at = 0.
+        node = node.children.get(part)
+        if node is None:
+          break
+      else:
+        node.listed_at = 0.
+        node.children.pop(parts[-1], None)
+      for p in list(self._listings):
+        np = _norm(p)
+        if path.startswith(np) or np.startswith(path):
+          del self._listings[p]
+
+  def clear(self):
+    self.invalidate("")
+
+  # listing
+
+  def _fetch(self, prefix: str) -> List[RelicFile]:
+    out: ListRelicFilesResponse = self.list_page(prefix, 0)
+    files = {f.name: f for f in out.files}
+    page_size = len(out.files)
+    if page_size and out.total_files > len(files):
+      n_pages = -(-out.total_files // page_size)
+      with ThreadPoolExecutor(min(self.max_workers, n_pages)) as pool:
+        for page in pool.map(lambda i: self.list_page(prefix, i), range(1, n_pages)):
+          files.update({f.name: f for f in page.files})
+      # server may count the pages from 1, keep going till nothing new comes back
+      page_no = n_pages
+      while len(files) < out.total_files:
+        page = self.list_page(prefix, page_no)
+        before = len(files)
+        files.update({f.name: f for f in page.files})
+        if len(files) == before:
+          break
+        page_no += 1
+    return list(files.values())
+
+  def list(self, prefix: str) -> List[RelicFile]:
+    """Files at the `prefix` (same semantics as the `list_relic_files` RPC), from the cache if fresh"""
+    with self._lock:
+      t, files = self._listings.get(prefix, (0., None))
+    if files is not None and self._fresh(t):
+      return files
+    now = time.monotonic()
+    logger.debug(f"Listing relic prefix: '{prefix}'")
+    files = self._fetch(prefix)
+    self._insert(prefix, files, now)
+    return files
+
+  def walk(self, prefix: str):
+    """Iterate over everything under the `prefix`, the sub-folders are listed concurrently"""
+    with ThreadPoolExecutor(self.max_workers) as pool:
+      futures = {pool.submit(self.list, prefix): prefix}
+      while futures:
+        done, _ = wait(futures, return_when = FIRST_COMPLETED)
+        for fut in done:
+          p = futures.pop(fut)
+          for f in fut.result():
+            yield f
+            sub = self.sub_prefix(f, p)
+            if sub is not None:
+              futures[pool.submit(self.list, sub)] = sub
+
+  @staticmethod
+  def sub_prefix(f: RelicFile, prefix: str) -> str:
+    """The prefix to list next when walking, `None` if `f` from the listing of `prefix` is not a sub-folder"""
+    if f.type == RelicFile.RelicType.FOLDER and _norm(f.name) != _norm(prefix):
+      return _norm(f.name) + "/"
+    return None
+
+  def stat(self, path: str) -> RelicFile:
+    """The listing entry for the `path` or `None` if it does not exist. This only lists the parent folder if the
+    tree does not already know the answer."""
+    path = _norm(path)
+    found, f = self.lookup(path)
+    if found:
+      return f
+    parent = path.rsplit("/", 1)[0] + "/" if "/" in path else ""
+    for f in self.list(parent):
+      if _norm(f.name) == path:
+        return f
+    return None
@@ -0,0 +1,386 @@
+"""
+A `RelicsBackend` that keeps the relics in a folder on the local machine, with a small S3 stand-in server for the
+presigned URLs. `Relics` runs against it fully offline and the bytes still go over HTTP through the same
+`TransferEngine` code path (multipart POST, ranged GET, ETags) as with S3, so it can be used for tests and for
+measuring the transfer throughput.
+
+```python
+backend = LocalRelicsBackend("/tmp/relics")
+relic = Relics("my-relic", create = True, backend = backend)
+relic.put_to("./data", "data")
+```
+
+- `latency` adds a sleep to every metadata call, to see how the client behaves with a real network in between
+- `page_size` makes `list_relic_files` paginate like the hosted server
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import threading
+from uuid import uuid4
+from urllib.parse import quote, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from nbox.utils import logger, SimplerTimes
+from nbox.relics.backend import RelicsBackend
+from nbox.relics.proto.common_pb2 import Acknowledge
+from nbox.relics.proto.relics_pb2 import Relic, RelicFile, RelicFiles
+from nbox.relics.proto.relics_rpc_pb2 import (
+  CreateRelicRequest,
+  ListRelicsRequest,
+  ListRelicsResponse,
+  ListRelicFilesRequest,
+  ListRelicFilesResponse,
+)
+
+
+def _safe_path(root: str, key: str) -> str:
+  fp = os.path.abspath(os.path.join(root, key.strip("/")))
+  if not fp.startswith(os.path.abspath(root) + os.sep):
+    raise ValueError(f"Invalid key: {key}")
+  return fp
+
+
+class _ObjectHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1" # keep-alive, same as S3
+  server: "LocalObjectServer"
+
+  def log_message(self, format, *args):
+    logger.debug(f"LocalObjectServer: {format % args}")
+
+  def _reply(self, code: int, headers: dict = {}, body: bytes = b""):
+    self.send_response(code)
+    for k, v in headers.items():
+      self.send_header(k, v)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    if body:
+      self.wfile.write(body)
+
+  def _readline(self, remaining: int):
+    line = self.rfile.readline(min(remaining, 1 << 16))
+    return line, remaining - len(line)
+
+  def do_POST(self):
+    """S3 style presigned POST, form fields first and the file last. The file is streamed to the disk."""
+    m = re.search(r'boundary="?([^";]+)"?', self.headers.get("Content-Type", ""))
+    if not m or "Content-Length" not in self.headers:
+      return self._reply(400, body = b"expected multipart/form-data with Content-Length")
+    delim = b"--" + m.group(1).encode("utf-8")
+    remaining = int(self.headers["Content-Length"])
+
+    fields = {}
+    line, remaining = self._readline(remaining)
+    if not line.startswith(delim):
+      return self._reply(400, body = b"malformed body")
+    while True:
+      disposition = ""
+      while True:
+        line, remaining = self._readline(remaining)
+        if line in (b"\r\n", b""):
+          break
+        if line.lower().startswith(b"content-disposition"):
+          disposition = line.decode("utf-8")
+      name = re.search(r'name="([^"]*)"', disposition)
+      if name is None:
+        return self._reply(400, body = b"malformed body")
+      if "filename=" in disposition:
+        break
+      value = []
+      while True:
+        line, remaining = self._readline(remaining)
+        if not line or line.startswith(delim):
+          break
+        value.append(line)
+      fields[name.group(1)] = b"".join(value)[:-2].decode("utf-8")
+      if not line or line.startswith(delim + b"--"):
+        return self._reply(400, body = b"no file in the form")
+
+    key = fields.get("key", "")
+    try:
+      fp = _safe_path(self.server.root, key)
+    except ValueError as e:
+      return self._reply(400, body = str(e).encode("utf-8"))
+    os.makedirs(os.path.dirname(fp), exist_ok = True)
+
+    # everything till the closing boundary is the file, hold back enough bytes to cut it off at the end
+    closing = b"\r\n" + delim
+    hold = len(closing) + 4
+    tmp = f"{fp}.{uuid4().hex}.tmp"
+    md5 = hashlib.md5()
+    tail = b""
+    with open(tmp, "wb") as f:
+      while remaining > 0:
+        chunk = self.rfile.read(min(remaining, 1 << 20))
+        if not chunk:
+          break
+        remaining -= len(chunk)
+        buf = tail + chunk
+        out, tail = buf[:-hold], buf[-hold:]
+        f.write(out)
+        md5.update(out)
+      idx = tail.rfind(closing)
+      if idx < 0:
+        os.remove(tmp)
+        return self._reply(400, body = b"malformed body")
+      f.write(tail[:idx])
+      md5.update(tail[:idx])
+    os.replace(tmp, fp)
+    etag = md5.hexdigest()
+    self.server.etags[fp] = (os.stat(fp).st_mtime_ns, etag)
+    self._reply(204, {"ETag": f'"{etag}"'})
+
+  def do_GET(self):
+    """presigned GET with support for a single byte range"""
+    try:
+      fp = _safe_path(self.server.root, unquote(self.path.split("?")[0]))
+    except ValueError:
+      return self._reply(400)
+    if not os.path.isfile(fp):
+      return self._reply(404, body = b"NoSuchKey")
+    size = os.path.getsize(fp)
+    start, end, code = 0, size - 1, 200
+    m = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+    if m:
+      start = int(m.group(1))
+      end = min(int(m.group(2)) if m.group(2) else size - 1, size - 1)
+      if start > end:
+        return self._reply(416, {"Content-Range": f"bytes */{size}"})
+      code = 206
+    self.send_response(code)
+    self.send_header("ETag", f'"{self.server.etag(fp)}"')
+    self.send_header("Accept-Ranges", "bytes")
+    self.send_header("Content-Length", str(end - start + 1))
+    if code == 206:
+      self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+    self.end_headers()
+    self.wfile.flush()
+    with open(fp, "rb") as f:
+      if end >= start:
+        self.connection.sendfile(f, start, end - start + 1)
+
+
+class LocalObjectServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, root: str, host: str = "127.0.0.1", port: int = 0):
+    """S3 stand-in that serves the presigned POST and GET for the files under `root`, runs in a daemon thread.
+    `port = 0` picks a free port."""
+    self.root = root
+    self.etags = {} # filepath -> (mtime_ns, md5)
+    super().__init__((host, port), _ObjectHandler)
+    self._thread = threading.Thread(target = self.serve_forever, daemon = True)
+    self._thread.start()
+
+  @property
+  def url(self) -> str:
+    host, port = self.server_address[:2]
+    return f"http://{host}:{port}"
+
+  def etag(self, fp: str) -> str:
+    mtime = os.stat(fp).st_mtime_ns
+    cached = self.etags.get(fp)
+    if cached is None or cached[0] != mtime:
+      h = hashlib.md5()
+      with open(fp, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+          h.update(chunk)
+      cached = (mtime, h.hexdigest())
+      self.etags[fp] = cached
+    return cached[1]
+
+  def close(self):
+    self.shutdown()
+    self.server_close()
+
+
+class LocalRelicsBackend(RelicsBackend):
+  def __init__(self, root: str = "", latency: float = 0., page_size: int = 0, host: str = "127.0.0.1", port: int = 0):
+    """
+    Args:
+      root (str): the folder where the relics are kept, a temporary folder if not given
+      latency (float): seconds to sleep in each metadata call
+      page_size (int): number of files per page in `list_relic_files`, 0 returns everything in one page
+      host (str): host for the object server
+      port (int): port for the object server, 0 picks a free port
+    """
+    if not root:
+      import tempfile
+      root = tempfile.mkdtemp(prefix = "nbx-relics-")
+    self.root = os.path.abspath(root)
+    self.latency = latency
+    self.page_size = page_size
+    os.makedirs(self.root, exist_ok = True)
+    self.server = LocalObjectServer(self.root, host, port)
+    self._lock = threading.Lock()
+    self._ids = {} # relic name -> id
+    logger.debug(f"LocalRelicsBackend at {self.root}, objects served from {self.server.url}")
+
+  def __repr__(self):
+    return f"LocalRelicsBackend({self.root}, {self.server.url})"
+
+  def close(self):
+    self.server.close()
+
+  def _wait(self):
+    if self.latency:
+      time.sleep(self.latency)
+
+  # relics are folders with a relic.json and the files under files/
+
+  def _relics(self):
+    for x in os.listdir(self.root):
+      fp = os.path.join(self.root, x, "relic.json")
+      if os.path.exists(fp):
+        with open(fp, "r") as f:
+          yield Relic(**json.load(f))
+
+  def _find_relic(self, id: str = "", name: str = "") -> Relic:
+    for r in self._relics():
+      if (id and r.id == id) or (not id and name and r.name == name):
+        return r
+    return None
+
+  def _files_root(self, relic_id: str) -> str:
+    return os.path.join(self.root, relic_id, "files")
+
+  def _relic_id(self, relic_file: RelicFile) -> str:
+    if relic_file.relic_id:
+      return relic_file.relic_id
+    if relic_file.relic_name not in self._ids:
+      r = self._find_relic(name = relic_file.relic_name)
+      if r is None:
+        return ""
+      self._ids[r.name] = r.id
+    return self._ids[relic_file.relic_name]
+
+  def create_relic(self, _CreateRelicRequest: CreateRelicRequest) -> Relic:
+    self._wait()
+    with self._lock:
+      if self._find_relic(name = _CreateRelicRequest.name) is not None:
+        return None
+      now = SimplerTimes.get_now_i64()
+      relic = dict(
+        id = uuid4().hex,
+        name = _CreateRelicRequest.name,
+        workspace_id = _CreateRelicRequest.workspace_id,
+        created_on = now,
+        last_modified = now,
+      )
+      os.makedirs(os.path.join(self.root, relic["id"], "files"))
+      with open(os.path.join(self.root, relic["id"], "relic.json"), "w") as f:
+        json.dump(relic, f)
+    return Relic(**relic)
+
+  def list_relics(self, _ListRelicsRequest: ListRelicsRequest) -> ListRelicsResponse:
+    self._wait()
+    relics = list(self._relics())
+    return ListRelicsResponse(relics = relics, total_relics = len(relics))
+
+  def delete_relic(self, _Relic: Relic) -> Acknowledge:
+    self._wait()
+    r = self._find_relic(_Relic.id, _Relic.name)
+    if r is None:
+      return Acknowledge(success = False, message = "Relic not found")
+    shutil.rmtree(os.path.join(self.root, r.id), ignore_errors = True)
+    self._ids.pop(r.name, None)
+    return Acknowledge(success = True)
+
+  def get_relic_details(self, _Relic: Relic) -> Relic:
+    self._wait()
+    return self._find_relic(_Relic.id, _Relic.name)
+
+  def create_file(self, _RelicFile: RelicFile) -> RelicFile:
+    self._wait()
+    return self._create_file(_RelicFile)
+
+  def _create_file(self, _RelicFile: RelicFile) -> RelicFile:
+    relic_id = self._relic_id(_RelicFile)
+    if not relic_id:
+      return None
+    out = RelicFile()
+    out.CopyFrom(_RelicFile)
+    out.relic_id = relic_id
+    out.url = self.server.url + "/"
+    out.body["key"] = f"{relic_id}/files/{_RelicFile.name.strip('/')}"
+    return out
+
+  def create_multi_files(self, _RelicFiles: RelicFiles) -> RelicFiles:
+    self._wait() # one round trip for the entire batch
+    out = RelicFiles(workspace_id = _RelicFiles.workspace_id)
+    for f in _RelicFiles.files:
+      rf = self._create_file(f)
+      if rf is None:
+        return None
+      out.files.append(rf)
+    return out
+
+  def download_file(self, _RelicFile: RelicFile) -> RelicFile:
+    self._wait()
+    relic_id = self._relic_id(_RelicFile)
+    out = RelicFile()
+    out.CopyFrom(_RelicFile)
+    if not relic_id:
+      return out
+    name = _RelicFile.name.strip("/")
+    fp = os.path.join(self._files_root(relic_id), name)
+    if os.path.isfile(fp):
+      out.relic_id = relic_id
+      out.size = os.path.getsize(fp)
+      out.url = f"{self.server.url}/{quote(f'{relic_id}/files/{name}')}"
+    return out
+
+  def _entry(self, files_root: str, fp: str) -> RelicFile:
+    st = os.stat(fp)
+    is_dir = os.path.isdir(fp)
+    return RelicFile(
+      name = os.path.relpath(fp, files_root).replace(os.sep, "/"),
+      type = RelicFile.RelicType.FOLDER if is_dir else RelicFile.RelicType.FILE,
+      size = 0 if is_dir else st.st_size,
+      created_on = int(st.st_mtime),
+      last_modified = int(st.st_mtime),
+    )
+
+  def list_relic_files(self, _ListRelicFilesRequest: ListRelicFilesRequest) -> ListRelicFilesResponse:
+    """same semantics as S3 list with a delimiter, `a/` lists the children of `a` and `a` lists everything in
+    the parent of `a` that starts with `a`"""
+    self._wait()
+    req = _ListRelicFilesRequest
+    relic_id = req.relic_id or self._relic_id(RelicFile(relic_name = req.relic_name))
+    if not relic_id:
+      return None
+    files_root = self._files_root(relic_id)
+    prefix = req.prefix.lstrip("/")
+    folder, _, start = prefix.rpartition("/")
+    folder_fp = os.path.join(files_root, folder)
+    entries = []
+    if os.path.isdir(folder_fp):
+      for x in sorted(os.listdir(folder_fp)):
+        if x.endswith(".tmp") or not x.startswith(start):
+          continue
+        if req.file_name and x != req.file_name:
+          continue
+        entries.append(self._entry(files_root, os.path.join(folder_fp, x)))
+    total = len(entries)
+    if self.page_size:
+      entries = entries[req.page_no * self.page_size : (req.page_no + 1) * self.page_size]
+    return ListRelicFilesResponse(files = entries, total_files = total)
+
+  def delete_multi_files(self, _RelicFiles: RelicFiles) -> Acknowledge:
+    self._wait()
+    for f in _RelicFiles.files:
+      relic_id = self._relic_id(f)
+      if not relic_id:
+        return Acknowledge(success = False, message = "Relic not found")
+      fp = os.path.join(self._files_root(relic_id), f.name.strip("/"))
+      if os.path.isdir(fp):
+        shutil.rmtree(fp, ignore_errors = True)
+      elif os.path.exists(fp):
+        os.remove(fp)
+    return Acknowledge(success = True)
@@ -0,0 +1,96 @@
+"""
+Delta sync for Relics, like `rsync` but for a folder on the local machine and a folder in the relic. Both sides
+are turned into a manifest `{relative_path: (size, mtime, md5)}` and only the files that differ are moved.
+
+- The remote side has the `size` and `last_modified` in the listing, the MD5s are kept in a small manifest file
+  (`.nbx_manifest.json`) in the remote folder which is updated on every upload
+- The quick check is `size` + `mtime`, the MD5 is computed only when the sizes match and the times do not
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import os
+from typing import Dict, List, Tuple
+
+from nbox.utils import get_files_in_folder
+from nbox.relics.transfer import file_md5
+
+MANIFEST_NAME = ".nbx_manifest.json"
+
+
+class SyncDirection:
+  UP = "up"     # local -> relic
+  DOWN = "down" # relic -> local
+
+  def all():
+    return [SyncDirection.UP, SyncDirection.DOWN]
+
+
+class ManifestEntry:
+  __slots__ = ["size", "mtime", "md5"]
+
+  def __init__(self, size: int, mtime: int, md5: str = ""):
+    self.size = size
+    self.mtime = mtime
+    self.md5 = md5
+
+  def __repr__(self):
+    return f"ManifestEntry(size={self.size}, mtime={self.mtime}, md5='{self.md5}')"
+
+  def to_dict(self):
+    return {"size": self.size, "mtime": self.mtime, "md5": self.md5}
+
+  @classmethod
+  def from_dict(cls, data):
+    return cls(data.get("size", 0), data.get("mtime", 0), data.get("md5", ""))
+
+
+def build_local_manifest(folder: str) -> Dict[str, ManifestEntry]:
+  """Manifest of all the files in the `folder`, MD5s are computed lazily by `diff_manifests`"""
+  manifest = {}
+  if not os.path.isdir(folder):
+    return manifest
+  for fp in get_files_in_folder(folder, abs_path = False):
+    rel = os.path.relpath(fp, folder).replace(os.sep, "/")
+    if rel == MANIFEST_NAME:
+      continue
+    st = os.stat(fp)
+    manifest[rel] = ManifestEntry(st.st_size, int(st.st_mtime))
+  return manifest
+
+
+def _same(local_fp: str, local: ManifestEntry, remote: ManifestEntry) -> bool:
+  if local.size != remote.size:
+    return False
+  if local.mtime == remote.mtime:
+    return True
+  if not remote.md5:
+    return False
+  if not local.md5:
+    local.md5 = file_md5(local_fp)
+  return local.md5 == remote.md5
+
+
+def diff_manifests(
+  folder: str,
+  local: Dict[str, ManifestEntry],
+  remote: Dict[str, ManifestEntry],
+  direction: str,
+) -> Tuple[List[str], List[str]]:
+  """Compare the two manifests and return `(to_transfer, to_delete)` as lists of relative paths. `to_delete`
+  are the extra files on the destination side."""
+  if direction == SyncDirection.UP:
+    src, dst = local, remote
+  else:
+    src, dst = remote, local
+  to_transfer = []
+  for rel, entry in src.items():
+    other = dst.get(rel)
+    if other is None:
+      to_transfer.append(rel)
+      continue
+    l, r = (entry, other) if direction == SyncDirection.UP else (other, entry)
+    if not _same(os.path.join(folder, rel), l, r):
+      to_transfer.append(rel)
+  to_delete = [rel for rel in dst if rel not in src]
+  return sorted(to_transfer), sorted(to_delete)
@@ -0,0 +1,629 @@
+"""
+Transfer engine for Relics. The RelicStore only hands out presigned URLs, the bytes themselves move directly
+between this machine and the bucket. This file has all the machinery for moving those bytes fast:
+
+- `TransferConfig`: knobs for the number of workers, part size and the memory cap
+- `get_transfer_session`: a pooled `requests.Session` shared by all transfers so connections are kept alive
+- `TransferEngine`: runs many file transfers concurrently with a shared byte budget, large downloads are split
+  into byte ranges that are written straight into a preallocated file
+- `UploadJournal` and the `.nbxpart.json` sidecars: record what has completed so that an interrupted transfer
+  picks up where it left off, every transfer is checked against the size and the MD5 ETag of the object
+
+{% CallOut variant="success" label="If you find yourself using this reach out to NimbleBox support." /%}
+"""
+
+import os
+import re
+import time
+import random
+import json
+import hashlib
+import weakref
+import threading
+import requests
+from uuid import uuid4
+from tqdm import tqdm
+from functools import lru_cache
+from typing import Callable, List, Tuple, Any
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+
+from nbox.utils import logger, env
+
+
+MiB = 1 << 20
+
+
+class TransferConfig:
+  def __init__(
+    self,
+    max_workers: int = 8,
+    part_size: int = 8 * MiB,
+    multipart_threshold: int = 16 * MiB,
+    max_memory: int = 256 * MiB,
+    max_retries: int = 3,
+    backoff: float = 0.5,
+    max_backoff: float = 10.,
+    verify: bool = True,
+    progress: bool = True,
+    presign_batch_size: int = 100,
+  ):
+    """Configuration for the `TransferEngine`.
+
+    Args:
+      max_workers (int): number of files (or parts) in flight at any point in time
+      part_size (int): size of each chunk that is read from disk and sent over the wire
+      multipart_threshold (int): files larger than this are streamed part by part instead of being buffered
+      max_memory (int): upper bound on the bytes buffered in memory across all the workers
+      max_retries (int): number of attempts for each transfer before giving up
+      backoff (float): seconds to wait before the first retry, doubled on every retry
+      max_backoff (float): max seconds between two retries
+      verify (bool): check the MD5 of the transferred bytes against the ETag of the object when available
+      progress (bool): show a progress bar for the transfers
+      presign_batch_size (int): number of files presigned in one call, only for backends with `create_multi_files`
+        (eg. `LocalRelicsBackend`). The hosted RelicStore has no batch RPC and presigns one file per call
+    """
+    if max_workers < 1:
+      raise ValueError("max_workers must be >= 1")
+    if part_size < 1 or multipart_threshold < 1 or max_memory < 1:
+      raise ValueError("part_size, multipart_threshold and max_memory must be positive")
+    self.max_workers = max_workers
+    self.part_size = part_size
+    self.multipart_threshold = multipart_threshold
+    self.max_memory = max_memory
+    self.max_retries = max(1, max_retries)
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.verify = verify
+    self.progress = progress
+    self.presign_batch_size = max(1, presign_batch_size)
+
+  def __repr__(self):
+    return f"TransferConfig(max_workers={self.max_workers}, part_size={self.part_size}, " \
+      f"multipart_threshold={self.multipart_threshold}, max_memory={self.max_memory})"
+
+
+@lru_cache()
+def get_transfer_session(pool_size: int = 32) -> requests.Session:
+  """Presigned URLs do not need any auth headers so all the transfers share one pooled session, this ensures
+  that TCP + TLS handshakes are paid once per connection and not once per file."""
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+  session.mount("http://", adapter)
+  session.mount("https://", adapter)
+  return session
+
+
+class ChecksumError(IOError):
+  """Raised when the transferred bytes do not match the size or checksum of the object"""
+
+
+def _etag_md5(headers) -> str:
+  """S3 ETag is the MD5 of the object only for single part uploads without KMS or customer keys, return it in
+  those cases else an empty string"""
+  if headers.get("x-amz-server-side-encryption", "") == "aws:kms":
+    return ""
+  if headers.get("x-amz-server-side-encryption-customer-algorithm", ""):
+    return ""
+  etag = headers.get("ETag", "").strip('"').lower()
+  if re.match(r"^[0-9a-f]{32}$", etag):
+    return etag
+  return ""
+
+
+class MD5Reader:
+  """File-like wrapper on a `stream` that keeps the MD5 of all the bytes read through it"""
+  def __init__(self, stream):
+    self.stream = stream
+    self.md5 = hashlib.md5()
+
+  def readinto(self, b) -> int:
+    n = self.stream.readinto(b)
+    if n:
+      self.md5.update(memoryview(b)[:n])
+    return n
+
+  def read(self, n: int = -1) -> bytes:
+    data = self.stream.read(n)
+    self.md5.update(data)
+    return data
+
+
+def _if_match(etag: str) -> dict:
+  # the GET fails with a 412 if the object changed after `etag` was read
+  return {"If-Match": f'"{etag}"'} if etag else {}
+
+
+def file_md5(fp: str, chunk_size: int = MiB) -> str:
+  h = hashlib.md5()
+  with open(fp, "rb") as f:
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def _write_json(fp: str, data: dict):
+  tmp = f"{fp}.{uuid4().hex}.tmp"
+  with open(tmp, "w") as f:
+    json.dump(data, f)
+  os.replace(tmp, fp)
+
+
+class _PartJournal:
+  """Sidecar next to a partially downloaded file that records which parts are on disk. It is bound to the
+  `identity` (ETag or size) of the remote object so a changed object is never resumed into."""
+  def __init__(self, fp: str, identity: str, size: int, part_size: int):
+    self.fp = fp
+    self.meta = {"identity": identity, "size": size, "part_size": part_size}
+    self.done = set()
+    self._lock = threading.Lock()
+    if os.path.exists(fp):
+      try:
+        with open(fp, "r") as f:
+          data = json.load(f)
+        if all(data.get(k) == v for k, v in self.meta.items()):
+          self.done = set(data.get("done", []))
+      except (ValueError, OSError):
+        pass
+
+  def mark(self, idx: int):
+    with self._lock:
+      self.done.add(idx)
+      _write_json(self.fp, {**self.meta, "done": sorted(self.done)})
+
+  def remove(self):
+    if os.path.exists(self.fp):
+      os.remove(self.fp)
+
+
+class UploadJournal:
+  def __init__(self, relic_id: str, local_path: str, remote_path: str):
+    """Records the files of a `put_to` that have been uploaded, so calling it again after a failure skips the
+    files that already made it. A presigned POST cannot be resumed midway so the granularity is one file. The
+    journal lives in `~/.nbx/.cache/journals` and is removed once everything is uploaded."""
+    folder = os.path.join(env.NBOX_HOME_DIR(), ".cache", "journals")
+    os.makedirs(folder, exist_ok = True)
+    _id = hashlib.md5(f"{relic_id}:{os.path.abspath(local_path)}:{remote_path}".encode("utf-8")).hexdigest()
+    self.fp = os.path.join(folder, _id + ".json")
+    self.files = {}
+    self._lock = threading.Lock()
+    if os.path.exists(self.fp):
+      try:
+        with open(self.fp, "r") as f:
+          self.files = json.load(f)
+      except (ValueError, OSError):
+        pass
+
+  @staticmethod
+  def _stat(local_path: str):
+    st = os.stat(local_path)
+    return [st.st_size, int(st.st_mtime)]
+
+  def is_done(self, local_path: str) -> bool:
+    return self.files.get(local_path) == self._stat(local_path)
+
+  def mark(self, local_path: str):
+    with self._lock:
+      self.files[local_path] = self._stat(local_path)
+      _write_json(self.fp, self.files)
+
+  def remove(self):
+    if os.path.exists(self.fp):
+      os.remove(self.fp)
+
+
+class _ByteBudget:
+  """Counting semaphore on bytes, caps how much data all the workers can hold in memory at once. A request
+  larger than the entire budget is let through when nothing else is held so that it never deadlocks."""
+  def __init__(self, capacity: int):
+    self.capacity = capacity
+    self.used = 0
+    self._cond = threading.Condition()
+
+  def acquire(self, n: int):
+    with self._cond:
+      while self.used and self.used + n > self.capacity:
+        self._cond.wait()
+      self.used += n
+
+  def release(self, n: int):
+    with self._cond:
+      self.used -= n
+      self._cond.notify_all()
+
+
+class _MultipartBody:
+  """A file-like `multipart/form-data` body for S3 style presigned POSTs. `requests` would otherwise read the
+  entire file in memory to build the body, this reads from the disk `part_size` at a time. The length is known
+  upfront because S3 does not accept chunked transfer encoding for POSTs.
+
+  Instead of a file the content can also be a list of in memory `frames` (eg. from `py_to_frames`), these are
+  sent one after the other without being joined."""
+  def __init__(self, fields: dict, local_path: str, part_size: int, frames: List[memoryview] = None):
+    self.boundary = uuid4().hex
+    self.part_size = part_size
+    self.local_path = local_path
+
+    head = b""
+    for k, v in fields.items():
+      head += f'--{self.boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode("utf-8")
+    # the file has to be the last field in the form, anything after it is ignored by S3
+    filename = os.path.basename(fields.get("key", local_path))
+    head += (
+      f'--{self.boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+      f'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode("utf-8")
+    tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+
+    self._frames = frames
+    self._frame_idx = 0
+    self._frame_offset = 0
+    self._f = None
+    size = sum(f.nbytes for f in frames) if frames is not None else os.path.getsize(local_path)
+    self._segments = [head, None, tail] # None is where the file goes
+    self._sizes = [len(head), size, len(tail)]
+    self._idx = 0
+    self._offset = 0
+    self.md5 = hashlib.md5() # of the file bytes as they are sent
+
+  @property
+  def content_type(self) -> str:
+    return f"multipart/form-data; boundary={self.boundary}"
+
+  def __len__(self):
+    return sum(self._sizes)
+
+  def _read_file(self, n: int) -> bytes:
+    if self._frames is not None:
+      out = []
+      while n > 0 and self._frame_idx < len(self._frames):
+        frame = self._frames[self._frame_idx]
+        chunk = frame[self._frame_offset : self._frame_offset + n]
+        out.append(chunk)
+        n -= chunk.nbytes
+        self._frame_offset += chunk.nbytes
+        if self._frame_offset == frame.nbytes:
+          self._frame_idx += 1
+          self._frame_offset = 0
+      return b"".join(out)
+    if self._f is None:
+      self._f = open(self.local_path, "rb")
+    return self._f.read(n)
+
+  def read(self, n: int = -1) -> bytes:
+    if n is None or n < 0:
+      n = len(self)
+    out = []
+    while n > 0 and self._idx < len(self._segments):
+      remaining = self._sizes[self._idx] - self._offset
+      if remaining == 0:
+        self._idx += 1
+        self._offset = 0
+        continue
+      take = min(n, remaining)
+      if self._segments[self._idx] is None:
+        chunk = self._read_file(take)
+        if len(chunk) != take:
+          raise IOError(f"File {self.local_path} changed size during upload")
+        self.md5.update(chunk)
+      else:
+        chunk = self._segments[self._idx][self._offset : self._offset + take]
+      out.append(chunk)
+      self._offset += take
+      n -= take
+    return b"".join(out)
+
+  def __iter__(self):
+    while True:
+      chunk = self.read(self.part_size)
+      if not chunk:
+        break
+      yield chunk
+
+  def close(self):
+    if self._f is not None:
+      self._f.close()
+      self._f = None
+
+
+_pwrite_lock = threading.Lock()
+
+def _pwrite(fd: int, data: bytes, offset: int):
+  """write `data` at `offset` without moving a shared file pointer, platforms without `os.pwrite` take a lock"""
+  if hasattr(os, "pwrite"):
+    view = memoryview(data)
+    while view:
+      n = os.pwrite(fd, view, offset)
+      view = view[n:]
+      offset += n
+    return
+  with _pwrite_lock:
+    os.lseek(fd, offset, os.SEEK_SET)
+    os.write(fd, data)
+
+
+# the engines with pools, the threads of the pools do not exist in a forked child
+_ENGINES = weakref.WeakSet()
+
+def _after_fork_in_child():
+  # the pooled connections are the parent's sockets
+  get_transfer_session.cache_clear()
+  for engine in list(_ENGINES):
+    engine._after_fork()
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child = _after_fork_in_child)
+
+
+class TransferEngine:
+  def __init__(self, config: TransferConfig = None):
+    """Moves bytes to and from presigned URLs, many files at a time. The engine is stateless apart from the
+    byte budget, so one instance can be shared by all the calls on a `Relics`."""
+    self.config = config or TransferConfig()
+    self.budget = _ByteBudget(self.config.max_memory)
+    self._pool = None
+    self._part_pool = None
+    self._part_pool_lock = threading.Lock()
+    _ENGINES.add(self)
+
+  def _after_fork(self):
+    # the copies of the pools think their workers are alive and would never run anything, start over
+    self.budget = _ByteBudget(self.config.max_memory)
+    self._pool = None
+    self._part_pool = None
+    self._part_pool_lock = threading.Lock()
+
+  @property
+  def session(self) -> requests.Session:
+    return get_transfer_session(max(32, self.config.max_workers * 2))
+
+  @property
+  def pool(self) -> ThreadPoolExecutor:
+    # one pool for the files of all the calls, `max_workers` files are in flight however many calls there are
+    with self._part_pool_lock:
+      if self._pool is None:
+        self._pool = ThreadPoolExecutor(max_workers = self.config.max_workers, thread_name_prefix = "nbx-relics")
+      return self._pool
+
+  def submit(self, fn: Callable, *args, **kwargs) -> Future:
+    """Run `fn` on the shared file pool, `fn` must not wait on other work in this pool (eg. call `run`)"""
+    return self.pool.submit(fn, *args, **kwargs)
+
+  @property
+  def part_pool(self) -> ThreadPoolExecutor:
+    # parts get their own pool, file level workers wait on the parts and sharing a pool could deadlock
+    with self._part_pool_lock:
+      if self._part_pool is None:
+        self._part_pool = ThreadPoolExecutor(max_workers = self.config.max_workers, thread_name_prefix = "nbx-relics-part")
+      return self._part_pool
+
+  def _wait_retry(self, attempt: int):
+    # exponential backoff with full jitter, nothing after the last attempt
+    if attempt + 1 < self.config.max_retries:
+      time.sleep(random.uniform(0, min(self.config.max_backoff, self.config.backoff * 2 ** attempt)))
+
+  def _post(self, url: str, fields: dict, local_path: str, frames: List[memoryview] = None) -> requests.Response:
+    last_exc = None
+    for attempt in range(self.config.max_retries):
+      body = _MultipartBody(fields, local_path, self.config.part_size, frames = frames)
+      try:
+        r = self.session.post(url, data = body, headers = {"Content-Type": body.content_type})
+        if r.status_code < 500:
+          r.raise_for_status()
+          etag = _etag_md5(r.headers)
+          if self.config.verify and etag and etag != body.md5.hexdigest():
+            raise ChecksumError(f"Checksum mismatch for {local_path}: sent {body.md5.hexdigest()}, stored {etag}")
+          return r
+        last_exc = requests.HTTPError(f"Upload failed with status: {r.status_code}", response = r)
+      except (requests.ConnectionError, requests.Timeout, ChecksumError) as e:
+        last_exc = e
+      finally:
+        body.close()
+      logger.debug(f"Upload attempt {attempt + 1}/{self.config.max_retries} failed for {local_path}: {last_exc}")
+      self._wait_retry(attempt)
+    raise last_exc
+
+  def upload_file(self, local_path: str, url: str, fields: dict) -> requests.Response:
+    """Upload a single file to a presigned POST `url` with form `fields`. Small files are buffered in memory
+    so retries do not touch the disk again, large files are streamed from the disk."""
+    size = os.path.getsize(local_path)
+    buffered = size <= self.config.multipart_threshold
+    held = size if buffered else self.config.part_size
+    self.budget.acquire(held)
+    try:
+      frames = None
+      if buffered:
+        with open(local_path, "rb") as f:
+          frames = [memoryview(f.read())]
+      return self._post(url, fields, local_path, frames)
+    finally:
+      self.budget.release(held)
+
+  def upload_frames(self, frames: List[memoryview], url: str, fields: dict, name: str = "") -> requests.Response:
+    """Upload in memory `frames` as one object, the frames are already in memory so they are not counted
+    against the byte budget and are never copied into a single buffer."""
+    return self._post(url, fields, name or fields.get("key", ""), frames)
+
+  def _get_range(self, url: str, fd: int, start: int, end: int, etag: str = ""):
+    """Download bytes `[start, end]` of `url` and write them at the same offset in the open file `fd`. On a
+    broken connection the retry continues from the last byte written."""
+    chunk_size = min(self.config.part_size, MiB)
+    offset = start
+    last_exc = None
+    for attempt in range(self.config.max_retries):
+      try:
+        with self.session.get(url, headers = {"Range": f"bytes={offset}-{end}", **_if_match(etag)}, stream = True) as r:
+          if r.status_code != 206:
+            r.raise_for_status()
+            raise requests.HTTPError(f"Expected a partial response (206), got: {r.status_code}", response = r)
+          for chunk in r.iter_content(chunk_size = chunk_size):
+            _pwrite(fd, chunk, offset)
+            offset += len(chunk)
+        if offset != end + 1:
+          raise IOError(f"Incomplete range, got {offset - start} of {end - start + 1} bytes")
+        return end - start + 1
+      except (requests.ConnectionError, requests.Timeout, IOError) as e:
+        status = getattr(getattr(e, "response", None), "status_code", None) or 0
+        if 400 <= status < 500:
+          raise # expired URL (403), gone (404) or the object changed (412), another attempt gets the same
+        last_exc = e
+        logger.debug(f"Range {start}-{end} attempt {attempt + 1}/{self.config.max_retries} failed: {e}")
+        self._wait_retry(attempt)
+    raise last_exc
+
+  def etag(self, url: str) -> str:
+    """ETag of the object at a presigned GET `url` as the server sends it (not always an MD5), read with a one
+    byte range so the object is not downloaded. Empty string if there is none."""
+    with self.session.get(url, headers = {"Range": "bytes=0-0"}, stream = True) as r:
+      if r.status_code == 416:
+        return "" # empty object
+      r.raise_for_status()
+      return r.headers.get("ETag", "").strip('"')
+
+  def verify_md5(self, headers, md5: str, name: str):
+    """Raise `ChecksumError` if `md5` of the bytes read does not match the ETag in the response `headers`"""
+    etag = _etag_md5(headers)
+    if self.config.verify and etag and etag != md5:
+      raise ChecksumError(f"Checksum mismatch for {name}: got {md5}, expected {etag}")
+
+  def open_stream(self, url: str, etag: str = "") -> requests.Response:
+    """Open a streamed GET on `url`, `response.raw` can be read like a file. Caller must close the response.
+    With `etag` the GET fails if the object is not that version anymore."""
+    r = self.session.get(url, headers = _if_match(etag), stream = True)
+    try:
+      r.raise_for_status()
+    except Exception:
+      r.close()
+      raise
+    r.raw.decode_content = True
+    return r
+
+  def _get_stream(self, url: str, local_path: str, size: int = 0, etag: str = "") -> int:
+    """Download the entire `url` in a single streamed GET, used for small files and when the server does not
+    support range requests. The MD5 is computed as the bytes arrive."""
+    last_exc = None
+    for attempt in range(self.config.max_retries):
+      try:
+        total_size = 0
+        md5 = hashlib.md5()
+        with self.session.get(url, headers = _if_match(etag), stream = True) as r:
+          r.raise_for_status()
+          md5_etag = _etag_md5(r.headers)
+          with open(local_path, "wb") as f:
+            for chunk in r.iter_content(chunk_size = min(self.config.part_size, MiB)):
+              f.write(chunk)
+              md5.update(chunk)
+              total_size += len(chunk)
+        if size and total_size != size:
+          raise ChecksumError(f"Size mismatch for {local_path}: got {total_size}, expected {size}")
+        if self.config.verify and md5_etag and md5_etag != md5.hexdigest():
+          raise ChecksumError(f"Checksum mismatch for {local_path}: got {md5.hexdigest()}, expected {md5_etag}")
+        return total_size
+      except (requests.ConnectionError, requests.Timeout, ChecksumError) as e:
+        last_exc = e
+        logger.debug(f"Download attempt {attempt + 1}/{self.config.max_retries} failed for {local_path}: {e}")
+        self._wait_retry(attempt)
+    raise last_exc
+
+  def download_file(self, url: str, local_path: str, size: int = 0, etag: str = "") -> int:
+    """Download a presigned `url` to `local_path` and return the number of bytes written. When `size` is known
+    and above the `multipart_threshold` the file is preallocated and the byte ranges are fetched concurrently,
+    each written straight at its offset.
+
+    Large files are written to `local_path.nbxpart` with a `.nbxpart.json` journal of the completed parts, if
+    the download breaks calling this again only fetches the missing parts. The file is moved to `local_path`
+    only after the size and checksum are verified. With `etag` (from `etag()`) the download fails instead of
+    mixing in the bytes of a newer version of the object."""
+    if not size or size <= self.config.multipart_threshold:
+      return self._get_stream(url, local_path, size, etag)
+
+    part_size = self.config.part_size
+    ranges = [(s, min(s + part_size, size) - 1) for s in range(0, size, part_size)]
+
+    # probe with a single byte, if the server ignores the Range header we fall back to a single stream
+    if_match = etag
+    with self.session.get(url, headers = {"Range": "bytes=0-0", **_if_match(if_match)}, stream = True) as r:
+      r.raise_for_status()
+      ranged = r.status_code == 206
+      etag = _etag_md5(r.headers)
+    if not ranged:
+      logger.debug(f"Server does not support range requests, streaming {local_path}")
+      return self._get_stream(url, local_path, size, if_match)
+
+    part_fp = local_path + ".nbxpart"
+    journal = _PartJournal(part_fp + ".json", etag or str(size), size, part_size)
+    if journal.done and not (os.path.exists(part_fp) and os.path.getsize(part_fp) == size):
+      journal.done = set()
+    if journal.done:
+      logger.info(f"Resuming {local_path}: {len(journal.done)}/{len(ranges)} parts already downloaded")
+
+    def _get_part(idx, fd, start, end):
+      n = self._get_range(url, fd, start, end, if_match)
+      journal.mark(idx)
+      return n
+
+    fd = os.open(part_fp, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+      os.ftruncate(fd, size)
+      futures = [
+        self.part_pool.submit(_get_part, i, fd, s, e)
+        for i, (s, e) in enumerate(ranges) if i not in journal.done
+      ]
+      try:
+        for f in futures:
+          f.result()
+      except Exception:
+        # parts already running still write to this fd, let them finish before it is closed
+        for f in futures:
+          f.cancel()
+        wait(futures)
+        raise
+      os.fsync(fd)
+      total_size = os.fstat(fd).st_size
+    finally:
+      os.close(fd)
+
+    # verify before putting the file in place, a corrupt file is thrown away along with the journal
+    try:
+      if total_size != size:
+        raise ChecksumError(f"Size mismatch for {local_path}: got {total_size}, expected {size}")
+      if self.config.verify and etag:
+        got = file_md5(part_fp)
+        if got != etag:
+          raise ChecksumError(f"Checksum mismatch for {local_path}: got {got}, expected {etag}")
+    except ChecksumError:
+      os.remove(part_fp)
+      journal.remove()
+      raise
+    os.replace(part_fp, local_path)
+    journal.remove()
+    return total_size
+
+  def run(self, fn: Callable, items: List[Tuple[Any, ...]], sizes: List[int] = None, desc: str = "") -> List[Any]:
+    """Run `fn(*item)` for all the `items` on the shared file pool and return the results in the same order.
+    `sizes` is only used for the progress bar. Do not call this from inside the pool."""
+    sizes = sizes or [1 for _ in items]
+    results = [None for _ in items]
+    pbar = tqdm(total = sum(sizes), desc = desc, unit = "B", unit_scale = True, unit_divisor = 1024, disable = not self.config.progress)
+    if len(items) == 1:
+      # no point in a pool for a single file, large files still get their parts from the part pool
+      try:
+        results[0] = fn(*items[0])
+        pbar.update(sizes[0])
+      finally:
+        pbar.close()
+      return results
+    futures = {self.pool.submit(fn, *x): i for i, x in enumerate(items)}
+    try:
+      for fut in as_completed(futures):
+        i = futures[fut]
+        results[i] = fut.result()
+        pbar.update(sizes[i])
+    except Exception:
+      for fut in futures:
+        fut.cancel()
+      wait(futures) # the ones already running finish before this returns, like the per call pool did
+      raise
+    finally:
+      pbar.close()
+    return results
@@ -18,6 +18,8 @@ This has a couple of cool things:
   bite me.
 - `to_pickle/from_pickle`: to be used in pair, `to_pickle(obj, "path")` and `from_pickle("path")`\
   to save and load python objects to disk.
+- `py_to_frames/py_from_stream/py_from_buffer`: pickle protocol 5 with out-of-band buffers, large buffers (eg. numpy)\
+  are sent and received as is without any copies.
 - `DBase`: सस्ता-protobuf (cheap protobuf), can be nested and `get_dict` will get for all\
   children
 - `PoolBranch`: Or how to use multiprocessing, but blocked so you don't have to give a shit\
@@ -36,6 +38,7 @@ import os
 import sys
 import json
 import uuid
+import struct
 import hashlib
 import requests
 import tempfile
@@ -69,6 +72,7 @@ class env:
   #. `NBOX_HOME_DIR`: By default `~/.nbx` folder, avoid changing this, user generally does not need to set this
   #. `NBOX_JSON_LOG`: Whether to print json-logs, user generally does not need to set this
   #. `NBOX_JOB_FOLDER`: Folder path for the job, user generally does not need to set this
+  #. `NBOX_RELICS_CACHE_SIZE`: Size cap (bytes) of the local Relics cache, by default 10 GiB
   """
   # things user can chose to set if they want
   NBOX_LOG_LEVEL = lambda x: os.getenv("NBOX_LOG_LEVEL", x)
@@ -85,6 +89,7 @@ class env:
   NBOX_HOME_DIR = lambda : os.environ.get("NBOX_HOME_DIR", os.path.join(os.path.expanduser("~"), ".nbx"))
   NBOX_JSON_LOG = lambda x: os.getenv("NBOX_JSON_LOG", x)
   NBOX_JOB_FOLDER = lambda x: os.getenv("NBOX_JOB_FOLDER", x)
+  NBOX_RELICS_CACHE_SIZE = lambda x: os.getenv("NBOX_RELICS_CACHE_SIZE", x)
 
   def set(key, value):
     os.environ[key] = value
@@ -252,6 +257,76 @@ def from_pickle(path):
   with open(path, "rb") as f:
     return cloudpickle.load(f)
 
+# pickle5 frames/
+#
+# layout: MAGIC | n_buffers (u64) | len(pickle) (u64) | len(buffer_i) (u64) ... | pickle | buffer_0 | buffer_1 ...
+# all the lengths are upfront so the reader can allocate each buffer once and read straight into it.
+
+PICKLE5_MAGIC = b"NBXPKL5\x00"
+
+def py_to_frames(x: Any) -> List[memoryview]:
+  """Serialise `x` with pickle protocol 5 and return the frames to be written one after the other. Contiguous
+  buffers (eg. numpy arrays) are not copied, the frames are views on the memory of `x`."""
+  buffers = []
+  def _cb(pb):
+    try:
+      buffers.append(pb.raw())
+      return False # out-of-band
+    except BufferError:
+      return True  # non-contiguous, let pickle copy it in-band
+  data = cloudpickle.dumps(x, protocol = 5, buffer_callback = _cb)
+  header = PICKLE5_MAGIC + struct.pack(f"<{2 + len(buffers)}Q", len(buffers), len(data), *[b.nbytes for b in buffers])
+  return [memoryview(header), memoryview(data)] + buffers
+
+def frames_size(frames: List[memoryview]) -> int:
+  return sum(f.nbytes for f in frames)
+
+def _read_exact(stream, n: int) -> bytearray:
+  buf = bytearray(n)
+  view = memoryview(buf)
+  while view:
+    r = stream.readinto(view)
+    if not r:
+      raise EOFError(f"Stream ended {view.nbytes} bytes early")
+    view = view[r:]
+  return buf
+
+def py_from_stream(stream) -> Any:
+  """Load an object from a file-like `stream` (anything with `readinto`) written with `py_to_frames`. Each
+  out-of-band buffer is read directly in its final memory. Streams that do not start with the magic are
+  treated as plain cloudpickle for backward compatibility."""
+  head = _read_exact(stream, len(PICKLE5_MAGIC))
+  if bytes(head) != PICKLE5_MAGIC:
+    return cloudpickle.loads(bytes(head) + stream.read())
+  n_buffers, n_data = struct.unpack("<2Q", _read_exact(stream, 16))
+  sizes = struct.unpack(f"<{n_buffers}Q", _read_exact(stream, 8 * n_buffers)) if n_buffers else ()
+  data = _read_exact(stream, n_data)
+  buffers = [_read_exact(stream, s) for s in sizes]
+  return cloudpickle.loads(data, buffers = buffers)
+
+def py_from_buffer(buf) -> Any:
+  """Load an object from a bytes-like `buf` written with `py_to_frames`. The out-of-band buffers are views on
+  `buf` so nothing is copied, pass a `bytearray` to get writable arrays back."""
+  view = memoryview(buf)
+  off = len(PICKLE5_MAGIC)
+  if bytes(view[:off]) != PICKLE5_MAGIC:
+    return cloudpickle.loads(view)
+  n_buffers, n_data = struct.unpack_from("<2Q", view, off)
+  off += 16
+  sizes = struct.unpack_from(f"<{n_buffers}Q", view, off)
+  off += 8 * n_buffers
+  data = view[off:off + n_data]
+  off += n_data
+  buffers = []
+  for s in sizes:
+    buffers.append(view[off:off + s])
+    off += s
+  if off != view.nbytes:
+    raise ValueError(f"Expected {off} bytes of frames, got {view.nbytes}")
+  return cloudpickle.loads(data, buffers = buffers)
+
+# /pickle5 frames
+
 def py_to_bs64(x: Any):
   return b64encode(cloudpickle.dumps(x)).decode("utf-8")
 
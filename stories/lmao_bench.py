@@ -0,0 +1,121 @@
+import os
+os.environ["NBOX_LOG_LEVEL"] = "warning"
+os.environ.setdefault("NBOX_NO_AUTH", "1") # everything here runs offline
+os.environ.setdefault("NBOX_NO_LOAD_GRPC", "1")
+os.environ.setdefault("NBOX_NO_LOAD_WS", "1")
+os.environ.setdefault("NBOX_NO_CHECK_VERSION", "1")
+
+import fire
+import time
+import shutil
+import tempfile
+import tabulate
+
+from nbox.lmao_v4 import LogShipper, BackpressurePolicy, LogWAL
+
+from utils import hr
+
+
+class _FakeEndpoint:
+  """stands in for `PutTrackerLog`, `latency` seconds per round trip and unreachable between `down` seconds"""
+  def __init__(self, latency: float, down = (0., 0.)):
+    self.latency = latency
+    self.down = down
+    self.start = time.monotonic()
+    self.received = 0
+
+  def is_down(self):
+    t = time.monotonic() - self.start
+    return self.down[0] <= t < self.down[1]
+
+  def send_one(self, item):
+    time.sleep(self.latency)
+    if self.is_down():
+      raise ConnectionError("endpoint is down")
+    self.received += 1
+
+  def send_batch(self, items):
+    # the batch goes out as concurrent calls, so it costs about one round trip
+    time.sleep(self.latency)
+    if self.is_down():
+      return items
+    self.received += len(items)
+    return []
+
+
+class LmaoBench:
+  def run(self, n: int = 5000, latency: float = 0.005, batch_size: int = 100, max_queue: int = 10_000, size: int = 200):
+    """Measure the time the training loop spends in `log` and the time till everything is delivered.
+
+    Args:
+      n (int): number of logs
+      latency (float): seconds per round trip to the endpoint
+      batch_size (int): `LogShipper.batch_size`
+      max_queue (int): `LogShipper.max_queue`
+      size (int): bytes in one serialized log, only for the WAL
+    """
+    td = tempfile.mkdtemp(prefix = "nbx-lmao-bench-")
+    payload = os.urandom(size)
+    rows = []
+
+    def _row(mode, log_took, drain_took, ep):
+      rows.append([mode, n, f"{log_took:.3f}", f"{n / log_took:.0f}", f"{drain_took:.3f}", ep.received])
+      print(rows[-1])
+
+    try:
+      hr("direct, one blocking call per log")
+      ep = _FakeEndpoint(latency)
+      st = time.time()
+      for i in range(n):
+        ep.send_one(i)
+      _row("direct", time.time() - st, 0., ep)
+
+      hr("shipper")
+      ep = _FakeEndpoint(latency)
+      shipper = LogShipper(ep.send_batch, batch_size = batch_size, flush_interval = 0.1, max_queue = max_queue)
+      st = time.time()
+      for i in range(n):
+        shipper.put(i)
+      log_took = time.time() - st
+      st = time.time(); shipper.close(); _row("shipper", log_took, time.time() - st, ep)
+
+      for mode, down in [("shipper + wal", (0., 0.)), ("shipper + wal, outage", (0., 1.))]:
+        hr(mode)
+        ep = _FakeEndpoint(latency, down)
+        wal = LogWAL(os.path.join(td, mode.replace(" ", "").replace(",", "-")))
+
+        def _send(items):
+          failed = ep.send_batch(items)
+          if not failed:
+            wal.ack(seq for seq, _ in items)
+          return failed
+
+        def _refill(last, k):
+          return wal.read(wal.watermark if last is None else last[0], k)
+
+        shipper = LogShipper(
+          _send,
+          batch_size = batch_size,
+          flush_interval = 0.1,
+          max_queue = max_queue,
+          policy = BackpressurePolicy.SPILL,
+          max_backoff = 0.5,
+          refill = _refill,
+        )
+        st = time.time()
+        for i in range(n):
+          shipper.put((wal.append(payload), payload))
+        log_took = time.time() - st
+        st = time.time(); shipper.close(timeout = 60.); _row(mode, log_took, time.time() - st, ep)
+        wal.close()
+    finally:
+      shutil.rmtree(td, ignore_errors = True)
+
+    hr("results")
+    print(tabulate.tabulate(rows, ["mode", "logs", "log() seconds", "logs/s", "drain seconds", "delivered"]))
+
+
+if __name__ == "__main__":
+  fire.Fire({
+    "lmao": LmaoBench
+  })
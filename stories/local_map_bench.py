@@ -0,0 +1,114 @@
+import os
+os.environ["NBOX_LOG_LEVEL"] = "warning"
+os.environ.setdefault("NBOX_NO_AUTH", "1") # everything here runs offline
+os.environ.setdefault("NBOX_NO_LOAD_GRPC", "1")
+os.environ.setdefault("NBOX_NO_LOAD_WS", "1")
+os.environ.setdefault("NBOX_NO_CHECK_VERSION", "1")
+
+import fire
+import time
+import shutil
+import tabulate
+import tempfile
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import nbox.utils as U
+from nbox import Operator
+from nbox.nbxlib.local_map import LocalMapPool
+
+from utils import hr
+
+MB = 1 << 20
+
+
+def checksum(x):
+  return float(x[::4096].sum())
+
+def echo(x):
+  return x
+
+
+def _pickle_file_call(fn, folder, tag):
+  # what the local map did before: each input and output is a pickle file on the disk
+  x = U.from_pickle(U.join(folder, tag + "_input"))
+  U.to_pickle(fn(x), U.join(folder, tag + "_output"))
+  return tag
+
+
+def _pickle_files(fn, inputs, workers):
+  folder = tempfile.mkdtemp(prefix = "nbx-para-logs-")
+  try:
+    with ProcessPoolExecutor(workers, mp_context = multiprocessing.get_context("fork")) as pool:
+      list(pool.map(int, range(workers))) # start the workers
+      st = time.perf_counter()
+      tags = [str(i) for i in range(len(inputs))]
+      for t, x in zip(tags, inputs):
+        U.to_pickle(x, U.join(folder, t + "_input"))
+      out = [U.from_pickle(U.join(folder, t + "_output")) for t in pool.map(_pickle_file_call, [fn] * len(tags), [folder] * len(tags), tags)]
+      return time.perf_counter() - st, out
+  finally:
+    shutil.rmtree(folder)
+
+
+def _local_map(fn, inputs, workers, shm_threshold):
+  with LocalMapPool(Operator.from_fn(fn), workers, chunksize = 1, shm_threshold = shm_threshold) as pool:
+    pool.map([np.zeros(1)] * workers) # start the workers
+    st = time.perf_counter()
+    out = pool.map(inputs)
+    return time.perf_counter() - st, out
+
+
+class LocalMapBench:
+  def run(
+    self,
+    sizes_mb = (1, 16, 128, 1024),
+    n: int = 8,
+    max_total_mb: int = 1024,
+    workers: int = 2,
+    roundtrip: bool = False,
+  ):
+    """Time `Operator.map` on this machine with one numpy array per input, sent over the old pickle files, the
+    pipe and shared memory.
+
+    Args:
+      sizes_mb: comma separated sizes of each input in MB
+      n (int): inputs per size, fewer for the big sizes so all of them fit in `max_total_mb`
+      max_total_mb (int): max MB of inputs for one size, keep it under a third of the free memory
+      workers (int): worker processes
+      roundtrip (bool): the operator returns the array instead of a checksum so the outputs are as big as the inputs
+    """
+    sizes_mb = [int(x) for x in sizes_mb.split(",")] if isinstance(sizes_mb, str) else list(sizes_mb)
+    fn = echo if roundtrip else checksum
+    transports = [
+      ("pickle files", lambda inputs: _pickle_files(fn, inputs, workers)),
+      ("pipe", lambda inputs: _local_map(fn, inputs, workers, 0)),
+      ("shared memory", lambda inputs: _local_map(fn, inputs, workers, 1)),
+    ]
+    rng = np.random.default_rng(4)
+    rows = []
+    for size in sizes_mb:
+      count = max(1, min(n, max_total_mb // size))
+      hr(f"{count} x {size} MB")
+      inputs = [rng.random(size * MB // 8) for _ in range(count)]
+      expected = [fn(x) for x in inputs]
+      for name, run in transports:
+        took, out = run(inputs)
+        if roundtrip:
+          assert all(np.array_equal(a, b) for a, b in zip(out, expected)), f"{name} gave wrong outputs"
+        else:
+          assert out == expected, f"{name} gave wrong outputs"
+        del out
+        rows.append([f"{size} MB", count, name, f"{took:.3f}", f"{count * size / took:.0f}"])
+        print(rows[-1])
+      del inputs, expected
+
+    hr("results")
+    print(tabulate.tabulate(rows, ["input", "inputs", "transport", "seconds", "MB/s"]))
+
+
+if __name__ == "__main__":
+  fire.Fire({
+    "local_map": LocalMapBench
+  })
@@ -0,0 +1,97 @@
+import os
+os.environ["NBOX_LOG_LEVEL"] = "warning"
+os.environ.setdefault("NBOX_NO_AUTH", "1") # everything here runs offline
+os.environ.setdefault("NBOX_NO_LOAD_GRPC", "1")
+os.environ.setdefault("NBOX_NO_LOAD_WS", "1")
+os.environ.setdefault("NBOX_NO_CHECK_VERSION", "1")
+
+import fire
+import shutil
+import random
+import tempfile
+import tabulate
+from time import time
+
+from nbox.relics import Relics, TransferConfig, LocalRelicsBackend
+
+from utils import hr
+
+KiB = 1 << 10
+MiB = 1 << 20
+
+# name -> list of file sizes
+DISTRIBUTIONS = {
+  "small": lambda: [4 * KiB] * 1000,
+  "mixed": lambda: [int(2 ** random.uniform(12, 23)) for _ in range(200)], # 4 KiB to 8 MiB, log uniform
+  "large": lambda: [64 * MiB] * 4,
+}
+
+
+def _make_files(folder: str, sizes):
+  for i, s in enumerate(sizes):
+    fp = os.path.join(folder, f"{i // 100:03d}", f"{i:05d}.bin")
+    os.makedirs(os.path.dirname(fp), exist_ok = True)
+    with open(fp, "wb") as f:
+      f.write(os.urandom(s))
+
+
+class RelicsBench:
+  def run(self, dist: str = "small,mixed,large", workers: int = 8, latency: float = 0., page_size: int = 0, seed: int = 4):
+    """Measure files/s and MB/s for `put_to`, `get_from`, `ls` and `put_object` against the local backend.
+
+    Args:
+      dist (str): comma separated names from `DISTRIBUTIONS`
+      workers (int): `TransferConfig.max_workers`
+      latency (float): seconds added to each metadata call, ~0.02 is close to a real deployment
+      page_size (int): paginate the listings like the hosted server
+    """
+    dist = dist.split(",") if isinstance(dist, str) else list(dist) # fire turns "a,b" into a tuple
+    random.seed(seed)
+    td = tempfile.mkdtemp(prefix = "nbx-relics-bench-")
+    cwd = os.getcwd()
+    backend = LocalRelicsBackend(os.path.join(td, "store"), latency = latency, page_size = page_size)
+    rows = []
+    try:
+      for name in dist:
+        sizes = DISTRIBUTIONS[name]()
+        n, total = len(sizes), sum(sizes)
+        hr(f"{name}: {n} files, {total / MiB:.1f} MiB")
+        # put_to keeps the local path in the remote names, so work with relative paths
+        os.makedirs(os.path.join(td, name))
+        os.chdir(os.path.join(td, name))
+        src, dst = "src", "dst"
+        _make_files(src, sizes)
+        relic = Relics(
+          f"bench-{name}",
+          create = True,
+          backend = backend,
+          cache = False,
+          transfer_config = TransferConfig(max_workers = workers, progress = False),
+        )
+
+        def _row(op, took, n_files, n_bytes):
+          rows.append([name, op, n_files, f"{took:.3f}", f"{n_files / took:.1f}", f"{n_bytes / MiB / took:.1f}"])
+          print(rows[-1])
+
+        st = time(); relic.put_to(src, "data"); _row("put_to", time() - st, n, total)
+        relic.index.clear()
+        st = time(); listed = list(relic.ls("data/", recurse = True)); _row("ls(recurse)", time() - st, len(listed), 0)
+        st = time(); relic.get_from(dst, "data"); _row("get_from", time() - st, n, total)
+        obj = [os.urandom(s) for s in sizes[:100]]
+        obj_size = sum(len(x) for x in obj)
+        st = time(); relic.put_object("obj", obj); _row("put_object", time() - st, 1, obj_size)
+        st = time(); relic.get_object("obj"); _row("get_object", time() - st, 1, obj_size)
+        relic.delete()
+    finally:
+      os.chdir(cwd)
+      backend.close()
+      shutil.rmtree(td, ignore_errors = True)
+
+    hr("results")
+    print(tabulate.tabulate(rows, ["dist", "op", "files", "seconds", "files/s", "MB/s"]))
+
+
+if __name__ == "__main__":
+  fire.Fire({
+    "relics": RelicsBench
+  })
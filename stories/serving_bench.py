@@ -0,0 +1,117 @@
+import os
+os.environ["NBOX_LOG_LEVEL"] = "warning"
+os.environ.setdefault("NBOX_NO_AUTH", "1") # everything here runs offline
+os.environ.setdefault("NBOX_NO_LOAD_GRPC", "1")
+os.environ.setdefault("NBOX_NO_LOAD_WS", "1")
+os.environ.setdefault("NBOX_NO_CHECK_VERSION", "1")
+
+import fire
+import time
+import requests
+import tabulate
+import threading
+import numpy as np
+from multiprocessing import Process
+from concurrent.futures import ThreadPoolExecutor
+
+from nbox import Operator
+from nbox.nbxlib.serving import serve_operator
+
+from utils import hr
+
+DIM = 256
+
+
+def _serve(port: int, call_ms: float, serve_kwargs):
+  W = np.random.default_rng(4).standard_normal((DIM, DIM)).astype(np.float32)
+
+  def predict(x):
+    # stands in for a model on an accelerator, every call has a fixed cost and each item is cheap. Works for one
+    # vector and for a batch (list of vectors) so the same function is served with and without batching
+    time.sleep(call_ms / 1000)
+    return (np.asarray(x, dtype = np.float32) @ W).sum(-1).tolist()
+
+  serve_operator(Operator.from_fn(predict), "nbox", host = "127.0.0.1", port = port, **serve_kwargs)
+
+
+def _wait_ready(port: int, timeout: float = 30.):
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    try:
+      if requests.get(f"http://127.0.0.1:{port}/", timeout = 1.).ok:
+        return
+    except requests.exceptions.ConnectionError:
+      time.sleep(0.1)
+  raise TimeoutError(f"Server on port {port} did not start in {timeout}s")
+
+
+def _load(port: int, n: int, clients: int):
+  url = f"http://127.0.0.1:{port}/forward_rest"
+  x = np.random.rand(DIM).tolist()
+  local = threading.local()
+
+  def _one(_):
+    if not hasattr(local, "session"):
+      local.session = requests.Session()
+    st = time.perf_counter()
+    r = local.session.post(url, json = {"x": x})
+    return time.perf_counter() - st, r.status_code
+
+  with ThreadPoolExecutor(clients) as pool:
+    list(pool.map(_one, range(clients))) # warm up the connections
+    st = time.perf_counter()
+    out = list(pool.map(_one, range(n)))
+    took = time.perf_counter() - st
+  latency = np.array([t for t, code in out if code == 200]) * 1000
+  errors = sum(code != 200 for _, code in out)
+  return took, latency, errors
+
+
+class ServingBench:
+  def run(
+    self,
+    n: int = 1000,
+    clients: int = 64,
+    call_ms: float = 20.,
+    batch_sizes = (0, 8, 32),
+    max_wait_ms: float = 5.,
+    max_workers: int = 1,
+    port: int = 8123,
+  ):
+    """Load test a served operator with and without micro-batching, every request is one vector.
+
+    Args:
+      n (int): number of requests
+      clients (int): concurrent clients
+      call_ms (float): fixed cost of one call to the model
+      batch_sizes: comma separated `max_batch_size` values to try, 0 is no batching
+      max_wait_ms (float): `max_wait_ms` when batching
+      max_workers (int): `max_workers` of the serving pool, 1 is like one model on one GPU
+      port (int): port to serve on
+    """
+    batch_sizes = [int(x) for x in batch_sizes.split(",")] if isinstance(batch_sizes, str) else list(batch_sizes)
+    rows = []
+    for bs in batch_sizes:
+      mode = f"batch {bs}" if bs else "no batching"
+      hr(mode)
+      serve_kwargs = {"max_workers": max_workers, "max_queue": n, "max_batch_size": bs, "max_wait_ms": max_wait_ms}
+      server = Process(target = _serve, args = (port, call_ms, serve_kwargs), daemon = True)
+      server.start()
+      try:
+        _wait_ready(port)
+        took, latency, errors = _load(port, n, clients)
+      finally:
+        server.terminate()
+        server.join()
+      p50, p99 = np.percentile(latency, [50, 99]) if len(latency) else (0., 0.)
+      rows.append([mode, n, f"{took:.2f}", f"{n / took:.0f}", f"{p50:.1f}", f"{p99:.1f}", errors])
+      print(rows[-1])
+
+    hr("results")
+    print(tabulate.tabulate(rows, ["mode", "requests", "seconds", "req/s", "p50 ms", "p99 ms", "errors"]))
+
+
+if __name__ == "__main__":
+  fire.Fire({
+    "serving": ServingBench
+  })